@@ -0,0 +1,346 @@
+'''
+gcodearc
+--------
+part of maniforge by Poikilos
+
+Arcs (G2 clockwise, G3 counterclockwise in the XY plane, like Marlin
+with ARC_SUPPORT): their geometry for estimates (See arc_length and
+arc_lengths), and ArcWelder, a stage (See gcodepipeline) that replaces
+runs of short G1 segments that are on a circle with one G2 or G3, so
+that fewer and shorter commands have to be sent (such as over a serial
+connection at BTT_TFT_C_VALUES['BAUDRATE']).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import math
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodepipeline import MoveState
+from maniforge.mfgcode import (
+    ParsedCommand,
+    np,
+)
+from maniforge.mfmath import show_places
+
+logger = getLogger(__name__)
+
+TAU = 2.0 * math.pi
+
+
+def radius_offset(start, end, radius, clockwise):
+    '''
+    Get the center of an arc given by R relative to start (like I & J)
+    the same way as Marlin: A negative radius means the longer way
+    around.
+
+    Sequential arguments:
+    start, end -- (x, y) positions.
+    radius -- The R parameter.
+    clockwise -- True for G2.
+    '''
+    dx = end[0] - start[0]
+    dy = end[1] - start[1]
+    d = math.hypot(dx, dy)
+    if d == 0:
+        return None
+    sign = -1.0 if (clockwise != (radius < 0)) else 1.0
+    h = math.sqrt(max(0.0, radius * radius - (d * 0.5) ** 2))
+    cx = (start[0] + end[0]) * 0.5 - sign * h * dy / d
+    cy = (start[1] + end[1]) * 0.5 + sign * h * dx / d
+    return cx - start[0], cy - start[1]
+
+
+def arc_sweep(start, end, offset, clockwise):
+    '''
+    Get the angle (radians) that an arc turns from start to end around
+    start + offset (2 pi if end is start, like Marlin).
+    '''
+    cx = start[0] + offset[0]
+    cy = start[1] + offset[1]
+    a0 = math.atan2(start[1] - cy, start[0] - cx)
+    a1 = math.atan2(end[1] - cy, end[0] - cx)
+    sweep = (a0 - a1) if clockwise else (a1 - a0)
+    sweep %= TAU
+    if sweep == 0:
+        sweep = TAU
+    return sweep
+
+
+def arc_length(start, end, offset=None, radius=None, clockwise=True,
+               dz=0.0):
+    '''
+    Get the length of a G2 or G3 move (a helix if dz is not 0).
+
+    Sequential arguments:
+    start, end -- (x, y) positions.
+
+    Keyword arguments:
+    offset -- The center relative to start (I, J).
+    radius -- The radius (R) if offset is None.
+    clockwise -- True for G2.
+    dz -- The Z distance.
+
+    Returns:
+    float: The length, or None if there is no center (neither offset
+        nor radius, or R with end at start).
+    '''
+    if offset is None:
+        if radius is None:
+            return None
+        offset = radius_offset(start, end, radius, clockwise)
+        if offset is None:
+            return None
+    r = math.hypot(offset[0], offset[1])
+    return math.hypot(r * arc_sweep(start, end, offset, clockwise), dz)
+
+
+def arc_lengths(x0, y0, x1, y1, i, j, r, clockwise, dz):
+    '''
+    Get the length of many arcs at once (like arc_length, but each
+    argument is a numpy array). The length is NaN where there is no
+    center.
+
+    Sequential arguments:
+    x0, y0 -- The start of each arc.
+    x1, y1 -- The end of each arc.
+    i, j -- The center relative to the start (NaN to use r).
+    r -- The radius (R) where i & j are NaN.
+    clockwise -- A bool array (True for G2).
+    dz -- The Z distance.
+    '''
+    dx = x1 - x0
+    dy = y1 - y0
+    d = np.hypot(dx, dy)
+    use_r = np.isnan(i) & np.isnan(j)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sign = np.where(clockwise != (r < 0), -1.0, 1.0)
+        h = np.sqrt(np.maximum(0.0, r * r - (d * 0.5) ** 2))
+        i = np.where(use_r, dx * 0.5 - sign * h * dy / d,
+                     np.nan_to_num(i))
+        j = np.where(use_r, dy * 0.5 + sign * h * dx / d,
+                     np.nan_to_num(j))
+    a0 = np.arctan2(-j, -i)
+    a1 = np.arctan2(y1 - (y0 + j), x1 - (x0 + i))
+    sweep = np.mod(np.where(clockwise, a0 - a1, a1 - a0), TAU)
+    sweep = np.where(sweep == 0, TAU, sweep)
+    return np.hypot(np.hypot(i, j) * sweep, dz)
+
+
+def fit_circle(p1, p2, p3):
+    '''
+    Get the circle (cx, cy, radius) through 3 (x, y) points, or None if
+    they are in a line.
+    '''
+    ax, ay = p1
+    bx, by = p2
+    cx, cy = p3
+    d = 2.0 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if d == 0:
+        return None
+    a2 = ax * ax + ay * ay
+    b2 = bx * bx + by * by
+    c2 = cx * cx + cy * cy
+    ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+    uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+    return ux, uy, math.hypot(ax - ux, ay - uy)
+
+
+def fit_arc(points, tolerance, max_radius=None):
+    '''
+    Check whether a polyline is on one arc.
+
+    Sequential arguments:
+    points -- The (x, y) positions from the start to the end of the
+        polyline (at least 3).
+    tolerance -- The farthest (in mm) that any point or the middle of
+        any segment may be from the arc.
+
+    Keyword arguments:
+    max_radius -- Don't fit a larger circle (nearly straight lines).
+
+    Returns:
+    tuple: (cx, cy, radius, clockwise, sweep) or None if the points
+        don't fit (including if they turn both ways or all the way
+        around).
+    '''
+    circle = fit_circle(points[0], points[len(points) // 2], points[-1])
+    if circle is None:
+        return None
+    cx, cy, radius = circle
+    if (max_radius is not None) and (radius > max_radius):
+        return None
+    direction = 0.0
+    sweep = 0.0
+    previous = None
+    for x, y in points:
+        vx = x - cx
+        vy = y - cy
+        if abs(math.hypot(vx, vy) - radius) > tolerance:
+            return None
+        if previous is not None:
+            px, py = previous
+            cross = px * vy - py * vx
+            if (cross == 0) or (cross * direction < 0):
+                return None
+            direction = cross
+            angle = math.atan2(abs(cross), px * vx + py * vy)
+            # The middle of the segment is closest to the center:
+            middle = math.hypot((px + vx) * 0.5, (py + vy) * 0.5)
+            if radius - middle > tolerance:
+                return None
+            sweep += angle
+        previous = (vx, vy)
+    if sweep >= TAU:
+        return None
+    return cx, cy, radius, (direction < 0), sweep
+
+
+class ArcWelder(object):
+    '''
+    Replace each run of at least min_segments consecutive G1 moves in
+    the XY plane that are all within tolerance of one arc with a G2 or
+    G3 (See fit_arc). The arc extrudes the total E of the segments (so
+    the amount of filament and any absolute E after it are unchanged),
+    and the firmware spreads it along the arc, so the E of each part of
+    the arc is proportional to its length like the segments.
+
+    Only moves in absolute XY mode (G90) without Z, I, J, R or a
+    comment are welded (See MoveState.segment), and in a run each F (if
+    any) is the same as on the first move and either every move
+    extrudes or none of them has E. A run starts from a known position,
+    so anything that MoveState.forget forgets (such as a tool change or
+    a Klipper-style macro, which may move the head) ends it, and the
+    next run starts after a move sets the position.
+
+    Keyword arguments:
+    tolerance -- The farthest (in mm) that the arc may be from any
+        point of the segments.
+    min_segments -- The fewest G1 moves to replace.
+    max_segments -- The most G1 moves to replace with one arc.
+    max_radius -- Don't make arcs larger than this (mm).
+    xy_places -- The decimal places of X, Y, I & J.
+    e_places -- The decimal places of E.
+
+    Public attributes:
+    arc_count -- How many G2 or G3 commands were made.
+    welded_count -- How many G1 commands they replaced.
+    input_count, output_count -- How many lines were read and written.
+    input_bytes, output_bytes -- The size of the lines read and written
+        (including newlines).
+    '''
+    def __init__(self, tolerance=0.05, min_segments=3, max_segments=200,
+                 max_radius=1000.0, xy_places=3, e_places=5):
+        self.tolerance = tolerance
+        self.min_segments = max(min_segments, 2)
+        self.max_segments = max_segments
+        self.max_radius = max_radius
+        self.xy_places = xy_places
+        self.e_places = e_places
+        self.arc_count = 0
+        self.welded_count = 0
+        self.input_count = 0
+        self.output_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def _can_join(self, run, command, segment):
+        # Check whether segment can follow the segments in run.
+        if not run:
+            return True
+        if len(run) >= self.max_segments:
+            return False
+        F = command.get('F')
+        if (F is not None) and (F != run[0][0].get('F')):
+            return False
+        return (segment[2] is None) == (run[0][1][2] is None)
+
+    def _arc(self, start, run):
+        # Get the G2 or G3 for run (or None if the segments don't fit).
+        if len(run) < self.min_segments:
+            return None
+        points = [start] + [(segment[0], segment[1])
+                            for _, segment in run]
+        fit = fit_arc(points, self.tolerance, max_radius=self.max_radius)
+        if fit is None:
+            return None
+        cx, cy, radius, clockwise, sweep = fit
+        end = points[-1]
+        xy = self.xy_places
+        parts = [
+            "G2" if clockwise else "G3",
+            "X" + show_places(end[0], xy),
+            "Y" + show_places(end[1], xy),
+            "I" + show_places(cx - start[0], xy),
+            "J" + show_places(cy - start[1], xy),
+        ]
+        if run[0][1][2] is not None:
+            e_total = sum([segment[2] for _, segment in run])
+            if self._state.e_relative:
+                e_value = e_total
+            else:
+                e_value = float(run[-1][0].get('E'))
+            parts.append("E" + show_places(e_value, self.e_places))
+        F = run[0][0].get('F')
+        if F is not None:
+            parts.append("F" + F)
+        return ParsedCommand(" ".join(parts))
+
+    def _flush(self, start, run):
+        # Get the commands for run (one arc if it fits).
+        arc = self._arc(start, run)
+        if arc is None:
+            return [command for command, _ in run]
+        self.arc_count += 1
+        self.welded_count += len(run)
+        return [arc]
+
+    def _out(self, command):
+        self.output_count += 1
+        self.output_bytes += len(command.line) + 1
+        return command
+
+    def __call__(self, commands):
+        self._state = state = MoveState()
+        run = []  # (command, (x, y, e)) for each segment
+        start = None  # The position before the run
+        for command in commands:
+            self.input_count += 1
+            self.input_bytes += len(command.line) + 1
+            segment = state.segment(command)
+            while True:
+                if (segment is not None) and \
+                        self._can_join(run, command, segment):
+                    if not run:
+                        start = (state.position[0], state.position[1])
+                    candidate = run + [(command, segment)]
+                    if (len(candidate) < self.min_segments) or \
+                            (self._arc(start, candidate) is not None):
+                        run = candidate
+                        break
+                if run and (self._arc(start, run) is None) and \
+                        (segment is not None):
+                    # Try again without the first segment.
+                    first = run.pop(0)
+                    yield self._out(first[0])
+                    start = (first[1][0], first[1][1])
+                    continue
+                for flushed in self._flush(start, run):
+                    yield self._out(flushed)
+                run = []
+                if segment is None:
+                    yield self._out(command)
+                    break
+            # The run was flushed above unless command is a segment, so
+            # anything that forget makes unknown (such as after a tool
+            # change or a Klipper-style macro) is only used by new runs:
+            if not state.forget(command):
+                state.update(command)  # whether or not it was kept
+        for flushed in self._flush(start, run):
+            yield self._out(flushed)
@@ -0,0 +1,218 @@
+'''
+gcodediagnostics
+----------------
+part of maniforge by Poikilos
+
+Collect problems found while parsing or emulating G-code (such as
+values that are not numbers or commands that aren't emulated) and show
+a summary of each kind of problem once instead of a message for every
+line.
+'''
+from __future__ import print_function
+from __future__ import division
+
+import logging
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+logger = getLogger(__name__)
+
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+
+class GCodeDiagnosticError(ValueError):
+    '''
+    A problem in G-code found while diagnostics are strict (See
+    Diagnostics).
+    '''
+    def __init__(self, message, kind=None, line_number=None):
+        if line_number is not None:
+            message = "Line {}: {}".format(line_number, message)
+        ValueError.__init__(self, message)
+        self.kind = kind
+        self.line_number = line_number
+
+
+class Diagnostic(object):
+    '''
+    One kind of problem and where it occurred.
+
+    Public attributes:
+    kind -- A short name for the problem (such as "not_a_number").
+    level -- The logging level (such as WARNING).
+    message -- The message of the first occurrence.
+    count -- How many times it occurred.
+    line_numbers -- The line numbers of the first occurrences (up to the
+        max_lines of the Diagnostics).
+    '''
+    __slots__ = ('kind', 'level', 'message', 'count', 'line_numbers')
+
+    def __init__(self, kind, level, message):
+        self.kind = kind
+        self.level = level
+        self.message = message
+        self.count = 0
+        self.line_numbers = []
+
+    def to_dict(self):
+        return {
+            'level': logging.getLevelName(self.level),
+            'message': self.message,
+            'count': self.count,
+            'line_numbers': self.line_numbers,
+        }
+
+    def summary(self):
+        msg = "{}: {}".format(logging.getLevelName(self.level),
+                              self.message)
+        if self.count > 1:
+            msg += " ({} times".format(self.count)
+            if self.line_numbers:
+                msg += ", first on line(s) {}".format(
+                    ", ".join([str(n) for n in self.line_numbers])
+                )
+            msg += ")"
+        elif self.line_numbers:
+            msg += " (line {})".format(self.line_numbers[0])
+        return msg
+
+
+class Diagnostics(object):
+    '''
+    Collect problems by kind (See Diagnostic) so that a summary can be
+    shown at the end (See report) instead of a message for every line.
+
+    Public attributes:
+    line_number -- The line that add uses if it isn't given one (The
+        caller can set it for each line).
+    max_lines -- How many line numbers to keep for each kind.
+    strict -- Raise GCodeDiagnosticError on the first problem at or
+        above ERROR.
+    report_first -- Log the first occurrence of each kind immediately
+        (such as for a default collector that may never be reported).
+    '''
+    def __init__(self, max_lines=5, strict=False, report_first=False):
+        self.max_lines = max_lines
+        self.strict = strict
+        self.report_first = report_first
+        self.line_number = None
+        self._diagnostics = {}  # Diagnostic objects by kind
+
+    def __len__(self):
+        return len(self._diagnostics)
+
+    def get(self, kind):
+        '''
+        Get the Diagnostic for a kind of problem (None if none).
+        '''
+        return self._diagnostics.get(kind)
+
+    def add(self, kind, message, line_number=None, level=WARNING):
+        '''
+        Record a problem.
+
+        Sequential arguments:
+        kind -- A short name for this kind of problem (Only the message
+            of the first problem of each kind is kept).
+        message -- The message (Format it only if the kind is new, such
+            as by checking "kind not in diagnostics" first, if it is
+            costly).
+
+        Keyword arguments:
+        line_number -- The line (default: self.line_number).
+        level -- The logging level such as WARNING or ERROR.
+
+        Raises:
+        GCodeDiagnosticError: If strict and level is at least ERROR.
+        '''
+        if line_number is None:
+            line_number = self.line_number
+        if self.strict and (level >= ERROR):
+            raise GCodeDiagnosticError(message, kind=kind,
+                                       line_number=line_number)
+        diagnostic = self._diagnostics.get(kind)
+        if diagnostic is None:
+            diagnostic = Diagnostic(kind, level, message)
+            self._diagnostics[kind] = diagnostic
+            if self.report_first:
+                logger.log(level, "{}: {}".format(
+                    logging.getLevelName(level), message))
+        diagnostic.count += 1
+        if ((line_number is not None)
+                and (len(diagnostic.line_numbers) < self.max_lines)):
+            diagnostic.line_numbers.append(line_number)
+
+    def add_lines(self, kind, message, line_numbers, level=WARNING):
+        '''
+        Record a problem that occurred on each of several lines at once
+        (such as found by a whole-file estimate).
+
+        Sequential arguments:
+        line_numbers -- A sequence (such as a numpy array) of lines.
+        '''
+        count = len(line_numbers)
+        if not count:
+            return
+        first = line_numbers[0]
+        self.add(kind, message, line_number=int(first), level=level)
+        diagnostic = self._diagnostics[kind]
+        diagnostic.count += count - 1
+        room = self.max_lines - len(diagnostic.line_numbers)
+        if room > 0:
+            diagnostic.line_numbers.extend(
+                [int(n) for n in line_numbers[1:room+1]]
+            )
+
+    def __contains__(self, kind):
+        return kind in self._diagnostics
+
+    def to_dict(self):
+        results = {}
+        for kind, diagnostic in self._diagnostics.items():
+            results[kind] = diagnostic.to_dict()
+        return results
+
+    def report(self, echo=None):
+        '''
+        Show a summary of each kind of problem (using logger, or echo if
+        set) then clear them.
+
+        Keyword arguments:
+        echo -- A callable that accepts a message (such as print).
+
+        Returns:
+        int: The number of kinds reported.
+        '''
+        diagnostics = self._diagnostics
+        for kind in sorted(diagnostics,
+                           key=lambda kind: -diagnostics[kind].level):
+            diagnostic = diagnostics[kind]
+            if echo is not None:
+                echo(diagnostic.summary())
+            else:
+                logger.log(diagnostic.level, diagnostic.summary())
+        count = len(diagnostics)
+        self.clear()
+        return count
+
+    def clear(self):
+        self._diagnostics = {}
+
+
+_default_diagnostics = Diagnostics(report_first=True)
+
+
+def get_default_diagnostics():
+    '''
+    Get the Diagnostics used by functions (such as get_cmd_meta) if the
+    caller doesn't provide one. It logs the first problem of each kind
+    immediately (See Diagnostics report_first).
+    '''
+    return _default_diagnostics
@@ -0,0 +1,361 @@
+'''
+gcodeestimate
+-------------
+part of maniforge by Poikilos
+
+Estimate the print time of a whole G-code file at once using numpy
+(See GCodeTable) instead of calling GCodeFollower.addSec for each line.
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodearc import arc_lengths
+from maniforge.gcodediagnostics import ERROR
+from maniforge.mfgcode import (
+    GCodeTable,
+    np,
+    parse_gcode_table,
+)
+
+logger = getLogger(__name__)
+
+MOVE_FUNCTIONS = ("G0", "G1", "G92")
+# ^ addSec estimates G92 the same way as a move.
+ARC_FUNCTIONS = GCodeTable.ARC_FUNCTIONS
+# ^ Moves that are estimated by their arc length (See gcodearc).
+
+# Functions that change the temperature or tool state or that add time
+# without moving, which are passed to addSec in order (Tool changes,
+# which are any function starting with "T", are also included):
+EVENT_FUNCTIONS = ("M104", "M109", "M190", "G28", "G4")
+
+# Functions that are also events when a follower has a thermalModel
+# (Otherwise they don't affect the estimate):
+THERMAL_EVENT_FUNCTIONS = ("M140",)
+
+
+def _before(values, initial):
+    '''
+    Get the last value that is not NaN before each row (or initial if
+    there is none), such as the position before each move.
+    '''
+    shifted = np.empty_like(values)
+    if len(values):
+        shifted[0] = np.nan
+        shifted[1:] = values[:-1]
+    return GCodeTable.forward_fill(shifted, initial=initial)
+
+
+def _e_positions(values, offsets, sets, initial):
+    '''
+    Get the extruder position after each row, where values are added to
+    the position in rows where offsets is True and set it where sets is
+    True (The sums are in order so they are the same as addSec's).
+    '''
+    changed = np.full(len(values), np.nan)
+    position = initial
+    for row in np.flatnonzero(offsets | sets).tolist():
+        if offsets[row]:
+            position += float(values[row])
+        else:
+            position = float(values[row])
+        changed[row] = position
+    return GCodeTable.forward_fill(changed, initial=initial)
+
+
+def _last(values, default):
+    '''
+    Get the last value that is not NaN (or default if there is none).
+    '''
+    present = np.flatnonzero(~np.isnan(values))
+    if not len(present):
+        return default
+    return float(values[present[-1]])
+
+
+def _or_nan(value):
+    if value is None:
+        return np.nan
+    return float(value)
+
+
+def _line_at(data, offset):
+    end = data.find(b"\n", offset)
+    if end < 0:
+        end = len(data)
+    return data[offset:end].decode("utf-8")
+
+
+def _is_tool_change(follower, name):
+    # addSec treats any function starting with "T" as a tool change, but
+    # a ThermalModel skips Klipper-style macros (such as
+    # TIMELAPSE_TAKE_FRAME), which have no number.
+    if not name.startswith("T"):
+        return False
+    return (follower.thermalModel is None) or name[1:].isdigit()
+
+
+def add_event_sec(follower, table, data, row_seconds=None):
+    '''
+    Pass each command in table that depends on (or changes) the
+    temperature or tool (See EVENT_FUNCTIONS) to follower.addSec in
+    order.
+
+    Sequential arguments:
+    follower -- A GCodeFollower.
+    table -- A GCodeTable (See parse_gcode_table).
+    data -- The G-code (bytes) that table was parsed from.
+
+    Keyword arguments:
+    row_seconds -- The seconds of each row's move. If set, they are
+        also added, and follower._estS is the time when each command
+        starts (such as for follower.thermalModel, where the time spent
+        waiting depends on when heating started).
+    '''
+    tools = [name for name in table.functions
+             if _is_tool_change(follower, name)]
+    functions = EVENT_FUNCTIONS + tuple(tools)
+    if follower.thermalModel is not None:
+        functions += THERMAL_EVENT_FUNCTIONS
+    is_event = table.function_mask(*functions)
+    diagnostics = follower.diagnostics
+    rows = table.line_number[is_event].tolist()
+    offsets = table.byte_offset[is_event].tolist()
+    if row_seconds is None:
+        for offset, line_number in zip(offsets, rows):
+            diagnostics.line_number = line_number
+            follower.addSec(_line_at(data, offset))
+        diagnostics.line_number = None
+        return
+    # The seconds of the moves before each row:
+    before = np.concatenate(([0.0], np.cumsum(row_seconds))).tolist()
+    started_s = follower._estS
+    event_s = 0.0  # The seconds that the events added
+    for row, offset, line_number in zip(np.flatnonzero(is_event).tolist(),
+                                        offsets, rows):
+        diagnostics.line_number = line_number
+        follower._estS = started_s + before[row] + event_s
+        follower.addSec(_line_at(data, offset))
+        event_s = follower._estS - started_s - before[row]
+    diagnostics.line_number = None
+    follower._estS = started_s + before[-1] + event_s
+
+
+def estimate_table(follower, table, data):
+    '''
+    Estimate the print time of the commands in table the same way as
+    calling follower.addSec for each line, and leave follower.emuState
+    the same as addSec would (position, modes, feed rates, extruder
+    position, temperatures and tool).
+
+    Moves (See MOVE_FUNCTIONS and ARC_FUNCTIONS) are calculated for
+    the whole table at once: the G90/G91 mode and the position are
+    forward-filled to every row. The few other commands that affect the
+    estimate (See EVENT_FUNCTIONS) are passed to follower.addSec in
+    order.
+
+    Sequential arguments:
+    follower -- A GCodeFollower.
+    table -- A GCodeTable (See parse_gcode_table).
+    data -- The G-code (bytes) that table was parsed from.
+
+    Returns:
+    float: The estimated seconds (also added to follower._estS).
+    '''
+    row_count = len(table)
+    emuState = follower.emuState
+    functions = table.functions
+    function_id = table.function_id
+    started_s = follower._estS
+
+    # The tool for each row (See _is_tool_change):
+    tools = [emuState['tool']]
+    tool_of_function = np.full(len(functions), -1, dtype=np.int64)
+    for i, name in enumerate(functions):
+        if _is_tool_change(follower, name):
+            if name not in tools:
+                tools.append(name)
+            tool_of_function[i] = tools.index(name)
+    row_tool = tool_of_function[function_id].astype(np.float64)
+    row_tool[row_tool < 0] = np.nan
+    row_tool = GCodeTable.forward_fill(row_tool, initial=0).astype(np.int64)
+
+    # The positioning mode for each row (1.0 if relative):
+    mode = np.full(row_count, np.nan)
+    mode[table.function_mask("G90")] = 0.0
+    mode[table.function_mask("G91")] = 1.0
+    relative = _before(
+        mode,
+        1.0 if emuState['position_mode'] == 'relative' else 0.0,
+    ) == 1.0
+    # The extruder mode (See GCodeFollower.getEPositionMode):
+    e_mode = np.full(row_count, np.nan)
+    e_mode[table.function_mask("G90", "M82")] = 0.0
+    e_mode[table.function_mask("G91", "M83")] = 1.0
+    e_relative = _before(
+        e_mode,
+        1.0 if follower.getEPositionMode() == 'relative' else 0.0,
+    ) == 1.0
+
+    is_arc = table.function_mask(*ARC_FUNCTIONS)
+    no_center = (is_arc & np.isnan(table.I) & np.isnan(table.J)
+                 & np.isnan(table.R))
+    # ^ Like GCodeFollower._emulateArc, skip it (even its position).
+    is_arc &= ~no_center
+    is_move = table.function_mask(*MOVE_FUNCTIONS) | is_arc
+    axes = [table.X, table.Y, table.Z]
+    move_any = is_move & (~np.isnan(axes[0]) | ~np.isnan(axes[1])
+                          | ~np.isnan(axes[2]) | is_arc)
+    # ^ An arc moves even if it ends where it starts (a full circle).
+    F = table.F
+    given_F = ~np.isnan(F)
+
+    # Like addSec, only estimate a move that has F (A move without F
+    # is skipped, with a warning only if the tool's feed rate from the
+    # last move with X, Y or Z and F is also unknown):
+    last_tool_feed = {}
+    unknown = np.zeros(row_count, dtype=bool)
+    for tool_i, tool in enumerate(tools):
+        rows = np.flatnonzero(row_tool == tool_i)
+        if not len(rows):
+            continue
+        tool_state = emuState['tools'].get(tool) or {}
+        sources = np.where(move_any[rows] & given_F[rows], F[rows], np.nan)
+        previous = _before(sources, _or_nan(tool_state.get('feed_rate')))
+        unknown[rows] = is_move[rows] & ~given_F[rows] & np.isnan(previous)
+        last_tool_feed[tool] = _last(sources, None)
+    diagnostics = follower.diagnostics
+    diagnostics.add_lines(
+        "unknown_feed_rate",
+        "The feed_rate is unknown.",
+        table.line_number[unknown],
+    )
+    applied = is_move & given_F
+    feed = F
+    feed_per_sec = feed / 60.0
+
+    # Travel (like addSec: In relative mode, the position becomes the
+    # relative offset, and a missing axis is 0):
+    travel = applied & move_any
+    squared = np.zeros(row_count)
+    final_position = list(emuState['position'])
+    starts = []
+    ends = []
+    for axis_i, values in enumerate(axes):
+        new = np.where(relative, np.nan_to_num(values), values)
+        new = np.where(travel, new, np.nan)
+        old = _before(new, float(emuState['position'][axis_i]))
+        if_absent = np.where(relative, 0.0, old)
+        new = np.where(np.isnan(new), if_absent, new)
+        delta = np.where(relative, np.abs(new), np.abs(new - old))
+        squared += np.where(travel, delta * delta, 0.0)
+        final_position[axis_i] = _last(np.where(travel, new, np.nan),
+                                       final_position[axis_i])
+        starts.append(np.where(relative, 0.0, old))
+        ends.append(new)
+    distance = np.sqrt(squared)
+    if np.any(is_arc):
+        arcs = np.flatnonzero(is_arc & travel)
+        distance[arcs] = np.nan_to_num(arc_lengths(
+            starts[0][arcs], starts[1][arcs],
+            ends[0][arcs], ends[1][arcs],
+            table.I[arcs], table.J[arcs], table.R[arcs],
+            table.function_mask("G2")[arcs],
+            ends[2][arcs] - starts[2][arcs],
+        ))
+        # ^ 0 where R is from the start to the start (See arc_length).
+    travel_s = distance[travel] / feed_per_sec[travel]
+
+    # Extrusion without travel (like addSec, the E difference, or E in
+    # relative mode where each value is added to the position in order):
+    feeding = applied & ~move_any & ~np.isnan(table.E)
+    e_values = np.where(feeding, table.E, np.nan)
+    e_pos = follower.getEPos()
+    e_pos = 0.0 if e_pos is None else float(e_pos)
+    e_set = feeding & ~e_relative
+    e_after = _e_positions(e_values, feeding & e_relative, e_set, e_pos)
+    e_before = np.empty_like(e_after)
+    if row_count:
+        e_before[0] = e_pos
+        e_before[1:] = e_after[:-1]
+    feed_s = (np.where(e_relative, np.abs(e_values),
+                       np.abs(e_before - e_values))[feeding]
+              / feed_per_sec[feeding])
+    diagnostics.add_lines(
+        "no_movement",
+        "Estimating a move is not possible since there was no X, Y, Z,"
+        " nor E movement.",
+        table.line_number[applied & ~move_any & np.isnan(table.E)],
+    )
+    diagnostics.add_lines(
+        "no_arc_center",
+        "There is no I, J nor R in an arc.",
+        table.line_number[no_center],
+        level=ERROR,
+    )
+    for name in table.functions:
+        if name not in follower.commandRegistry:
+            diagnostics.add_lines(
+                "not_emulated:" + name,
+                "The command isn't emulated for estimates or other uses:"
+                " {}".format(name),
+                table.line_number[table.function_mask(name)],
+            )
+
+    if follower.thermalModel is not None:
+        row_seconds = np.zeros(row_count)
+        row_seconds[travel] = travel_s
+        row_seconds[feeding] = feed_s
+        add_event_sec(follower, table, data, row_seconds=row_seconds)
+    else:
+        add_event_sec(follower, table, data)
+        follower._estS += float(np.sum(travel_s)) + float(np.sum(feed_s))
+
+    # Leave the state the same as addSec would:
+    if np.any(travel):
+        emuState['position'] = final_position
+    mode_values = mode[~np.isnan(mode)]
+    if len(mode_values):
+        emuState['position_mode'] = ('relative' if mode_values[-1] == 1.0
+                                     else 'absolute')
+    e_mode_values = e_mode[~np.isnan(e_mode)]
+    if len(e_mode_values):
+        follower.setEPositionMode('relative' if e_mode_values[-1] == 1.0
+                                  else 'absolute')
+    for tool, tool_feed in last_tool_feed.items():
+        if tool_feed is not None:
+            emuState['tools'][tool]['feed_rate'] = tool_feed
+    servo_feeds = np.where(applied & ~move_any, feed, np.nan)
+    servo_feed = _last(servo_feeds, None)
+    if servo_feed is not None:
+        servo = emuState['extruder']
+        emuState['servos'][servo]['feed_rate'] = servo_feed
+    if np.any(feeding):
+        follower.setEPos(float(e_after[-1]))
+    return follower._estS - started_s
+
+
+def estimate_gcode(follower, data):
+    '''
+    Parse G-code (bytes or str) and estimate it (See estimate_table).
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    return estimate_table(follower, parse_gcode_table(data), data)
+
+
+def estimate_file(follower, path):
+    '''
+    Estimate a whole G-code file (See estimate_table).
+    '''
+    with open(path, 'rb') as ins:
+        data = ins.read()
+    return estimate_gcode(follower, data)
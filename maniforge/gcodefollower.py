@@ -2,12 +2,15 @@
 from __future__ import print_function
 from __future__ import division
 
+from contextlib import closing
 from decimal import Decimal
 import decimal
 import inspect
 import json
 import math
+import multiprocessing
 import os
+import re
 import shutil
 import sys
 
@@ -18,7 +21,42 @@ else:
     from hierosoft.logging2 import getLogger
 
 from maniforge import cast_by_type_string
-from maniforge.mfgcode import cmd_meta_dict, get_cmd_meta
+from maniforge.gcodearc import arc_length
+from maniforge.gcodediagnostics import (
+    ERROR,
+    Diagnostics,
+)
+from maniforge.gcodeestimate import estimate_file
+from maniforge.gcodehandlers import CommandRegistry
+from maniforge.gcodemetrics import GCodeMetrics
+from maniforge.gcodeparallel import (
+    LineRun,
+    ScanOptions,
+    apply_line_run,
+    iter_scanned_lines,
+)
+from maniforge.gcodepipeline import (
+    END_RETRACTION_FLAG,
+    Preheat,
+    run_pipeline,
+)
+from maniforge.gcodeplan import (
+    TowerPlanRecorder,
+    TowerPlans,
+    load_tower_plans,
+    save_tower_plans,
+)
+from maniforge.gcodeplanner import estimate_planned_file
+from maniforge.gcodestart import HeaterOverlap
+from maniforge.mfgcode import (
+    DEFAULT_FIXED_PLACES,
+    FAST_DECIMAL,
+    FIXED_PLACES,
+    ParsedCommand,
+    from_fixed,
+    iter_mapped_lines,
+    to_fixed,
+)
 from maniforge.mfmath import getHMSFromS, getHMSMessageFromS
 from maniforge.mfpython import encVal
 
@@ -53,6 +91,9 @@ class GCodeFollower:
           Example servos:
           - 'E0' (and others) is a dict containing servo information.
             - 'position' is a 1D (float, not list) position.
+            - 'position_mode' is 'absolute' or 'relative' (set by M82
+              or M83, and also by G90 or G91 like Marlin). Obtain it
+              with getEPositionMode.
     '''
     _towerName = ("the mesh (such as STL) from Python GUI for"
                   " Configurable Temperature Tower")
@@ -63,7 +104,37 @@ class GCodeFollower:
     # The old one is thing:2092820 but that is not very tall, and has
     # some mesh issues.
 
-    _end_retraction_flag = "filament slightly"
+    _end_retraction_flag = END_RETRACTION_FLAG
+    # Find build moves without parsing (See _isBuildMoveBytes):
+    _move_bytes_pattern = re.compile(br'\s*G0?[01]\s')
+    _z_bytes_pattern = re.compile(br'\sZ')
+    _e_bytes_pattern = re.compile(br'\sE[-+]?\.?\d')
+    _x_bytes_pattern = re.compile(br'\sX[-+]?\.?\d')
+    _y_bytes_pattern = re.compile(br'\sY[-+]?\.?\d')
+    # Heating rates (See getToolSecRelTemp and getBedSecRelTemp):
+    TOOL_SEC_PER_DEGREE = 109.0 / 188.0
+    # It took R2X 14T with FlexionHT about 1m49s to get from
+    # room temperature of about 22C to 210C: 109s/188degrees
+    # = 0.57978723404255319149 sec/deg
+    BED_SEC_PER_DEGREE = 213.0 / 36.0
+    # It took R2X 14T with stock z axis about 3m33s to get from
+    # room temperature of about 22C to 58C: 213s/36degrees
+    # = 5.91666666666666666667 sec/deg
+    # Commands that don't affect the estimate (See
+    # registerDefaultHandlers):
+    IGNORED_COMMANDS = (
+        "M84",  # Disable motors
+        "M92",  # Set axis steps-per-unit
+        "M105",  # Report temperatures
+        "M106",  # Set fan speed
+        "M107",  # Fan off
+        "M117",  # Show a message
+        "M140",  # Set bed temp BUT don't wait
+        "M204",  # Set starting acceleration
+        "M280",  # Set a servo position
+        "M420",  # Get and/or set bed leveling state
+        "SET_VELOCITY_LIMIT",  # Klipper (like M204 & M203)
+    )
     _rangeNames = ["min", "max"]
     _settingsDocPath = "settings descriptions.txt"
     _settingsPath = "settings.json"
@@ -162,6 +233,9 @@ class GCodeFollower:
         # ^ The default *can* be absolute if set in Marlin
         #   configuration_adv.h (See
         #   <https://reprap.org/forum/read.php?262,193749>).
+        self.thermalModel = None
+        # ^ If set (See gcodethermal ThermalModel.install), heaters are
+        #   estimated at the same time as moves and each other.
         # Initialize emuState (requires self.fwDefaultPositionMode):
         self.resetEmuState()
         # self._insert_msg = "; GCodeFollower."
@@ -227,7 +301,54 @@ class GCodeFollower:
         for k, v in self.commands.items():
             self.code_numbers[k] = Decimal(v[1:])
 
-        self.debuggedLengths = []
+        self.debuggedLengths = set()
+        # ^ Each command structure shown by addSec (only if verbose).
+        self.commandRegistry = CommandRegistry(timed=False)
+        # ^ The handler addSec uses for each command (See
+        #   registerDefaultHandlers and CommandRegistry.get_stats).
+        #   Handlers are only timed while collecting metrics.
+        self.registerDefaultHandlers()
+        self.cacheTowerPlans = True
+        # ^ Save what _generateTower does to the template (See
+        #   gcodeplan) so that generating it again with a different
+        #   temperature range doesn't require reading it again. A saved
+        #   plan is only used (or saved) while the handlers are the
+        #   default ones (See hasDefaultHandlers), since it has the
+        #   times that the handlers added.
+        self.coordinateMode = "decimal" if FAST_DECIMAL else "fixed"
+        # ^ "fixed": _generateTower compares parameters as ints (See
+        #   to_fixed) and only sets their stats at the end. "decimal":
+        #   Use a Decimal for each parameter (and set its stat) on each
+        #   line. The default is whichever is faster with this Python
+        #   (See FAST_DECIMAL and tests/benchmark_gcodefollower.py).
+        self.collectMetrics = False
+        # ^ Collect a GCodeMetrics during generateTower (as
+        #   self.metrics) and save it as JSON (See metricsPath).
+        self.metricsPath = None
+        # ^ Where to save the metrics (If None, the output path +
+        #   ".metrics.json").
+        self.metrics = None
+        self.diagnostics = Diagnostics()
+        # ^ Problems found by addSec (See report at the end of
+        #   generateTower and addFileSec). Set diagnostics.strict to
+        #   raise GCodeDiagnosticError on the first error instead.
+        self.plannerLimits = None
+        # ^ If set to a PlannerLimits (such as from
+        #   PlannerLimits.from_marlininfo), addFileSec models the
+        #   acceleration and lookahead of the firmware (See gcodeplanner)
+        #   instead of matching addSec.
+        self.workers = 1
+        # ^ How many processes _generateTower uses to parse the template
+        #   (See getScanOptions). If 0, use one for each CPU.
+        self.preheatLevels = False
+        # ^ Heat for each level early instead of waiting at the level
+        #   (See _postProcessTower).
+        self.overlapHeating = False
+        # ^ Heat the bed and hotend at the same time and during homing
+        #   in the start G-code (See _postProcessTower).
+        self._batchPlans = None
+        # ^ The TowerPlans of each template and plan key during
+        #   generateTowers (so each variant doesn't parse it again).
 
     def saveDocumentationOnce(self):
         if not os.path.isfile(GCodeFollower._settingsDocPath):
@@ -279,6 +400,26 @@ class GCodeFollower:
             self.emuState['servos'][servo] = {}
         self.emuState['servos'][servo]['position'] = ePos
 
+    def getEPositionMode(self):
+        '''
+        Get the positioning mode ('absolute' or 'relative') of the
+        current extruder.
+        '''
+        servo = self.emuState['extruder']
+        servoState = self.emuState['servos'].get(servo)
+        if servoState is None:
+            return self.fwDefaultPositionMode
+        return servoState.get('position_mode', self.fwDefaultPositionMode)
+
+    def setEPositionMode(self, mode):
+        if mode not in ('absolute', 'relative'):
+            raise ValueError("mode should be 'absolute' or 'relative' but"
+                             " is {}".format(mode))
+        servo = self.emuState['extruder']
+        if self.emuState['servos'].get(servo) is None:
+            self.emuState['servos'][servo] = {}
+        self.emuState['servos'][servo]['position_mode'] = mode
+
     def getToolTemperature(self):
         toolState = self.getToolState()
         temperature = None
@@ -350,6 +491,8 @@ class GCodeFollower:
         self.setTool('T0')
         self.setToolToAmbientTemperature()
         self.setExtruder('E0')
+        if self.thermalModel is not None:
+            self.thermalModel.reset()
 
     def saveDocumentation(self):
         try:
@@ -801,6 +944,92 @@ class GCodeFollower:
             return "{}-{}".format(temps[-1], temps[0])
         return "{}-{}".format(temps[0], temps[-1])
 
+    def getTowerPath(self):
+        '''
+        Get the path where _generateTower saves the tower (The
+        temperature range and the template's name). Call checkSettings
+        first.
+        '''
+        return (self.getRangeString("temperature") + "_"
+                + self.getVar("template_gcode_path"))
+
+    def _isBuildMoveBytes(self, line):
+        '''
+        Check whether a line of the template (bytes) is a G0 or G1 that
+        _generateTower would discard after stop_building, without
+        parsing it: It extrudes (and isn't an end retraction, See
+        _end_retraction_flag) or moves both X and Y. A line with Z is
+        never included since the height has to be tracked.
+        '''
+        code_end = line.find(b";")
+        code = line if code_end < 0 else line[:code_end]
+        if not GCodeFollower._move_bytes_pattern.match(code):
+            return False
+        if GCodeFollower._z_bytes_pattern.search(code):
+            return False
+        if GCodeFollower._e_bytes_pattern.search(code):
+            flag = GCodeFollower._end_retraction_flag.encode("utf-8")
+            if flag not in line:
+                return True
+        return ((GCodeFollower._x_bytes_pattern.search(code) is not None)
+                and (GCodeFollower._y_bytes_pattern.search(code)
+                     is not None))
+
+    def getTowerPlanKey(self):
+        '''
+        Get the settings that a saved tower plan depends on (See
+        gcodeplan). The temperatures are not included since they are
+        filled in when a plan is used.
+        '''
+        stw = 'set temperature and wait'
+        return {
+            'heights': [str(height) for height in self.heights],
+            'max_z_build_movement': str(self.getVar("max_z_build_movement")),
+            'set temperature and wait': [self.commands[stw],
+                                         self.params[stw][0]],
+            'set fan speed': self.commands['set fan speed'],
+            'end_retraction_flag': GCodeFollower._end_retraction_flag,
+        }
+
+    def getScanOptions(self):
+        '''
+        Get the ScanOptions for parsing the template in several
+        processes (See maniforge.gcodeparallel and self.workers), or None
+        if the handler of a move or of G90 or G91 isn't the default (See
+        registerDefaultHandlers), since then the moves can't be
+        emulated in another process.
+        '''
+        kinds = {
+            GCodeFollower._emulateMove: "move",
+            GCodeFollower._emulateAbsolute: "absolute",
+            GCodeFollower._emulateRelative: "relative",
+            GCodeFollower._emulateAbsoluteE: "e_absolute",
+            GCodeFollower._emulateRelativeE: "e_relative",
+            GCodeFollower._emulateDwell: "dwell",
+            GCodeFollower._emulateNothing: "nothing",
+        }
+        required = ("G0", "G1", "G92", "G90", "G91")
+        local_functions = {}
+        for function in (required + ("G4", "M82", "M83")
+                         + tuple(GCodeFollower.IGNORED_COMMANDS)):
+            entry = self.commandRegistry.resolve(function)
+            if entry is None:
+                continue
+            kind = kinds.get(entry.handler)
+            if kind is not None:
+                local_functions[function] = kind
+        for function in required:
+            if function not in local_functions:
+                return None
+        stw_cmd = self.commands['set temperature and wait']
+        return ScanOptions(
+            local_functions,
+            position_mode=self.emuState['position_mode'],
+            e_position_mode=self.getEPositionMode(),
+            fixed=(self.coordinateMode == "fixed"),
+            set_temperature_prefix=stw_cmd + " ",
+        )
+
     def setStat(self, name, value, line_number):
         """
         If you override setStat, you must also override:
@@ -823,6 +1052,17 @@ class GCodeFollower:
     def getStat(self, name):
         return self.stats.get(name)
 
+    def _setStatRun(self, name, value, total, line_number):
+        '''
+        Set a stat the same way as calling setStat for each of several
+        values (such as each E of a maniforge.gcodeparallel.LineRun),
+        where value is the last one and total is their sum (which
+        setStat adds to net_E_before_stop_building for E).
+        '''
+        if total != value:
+            self.setStat(name, total - value, line_number)
+        self.setStat(name, value, line_number)
+
     def _changeStat(self, name, delta, line_number):
         self.setStat(name, self.getStat(name) + delta, line_number)
 
@@ -839,6 +1079,84 @@ class GCodeFollower:
         except Exception as ex:
             self.enableUI(True)
             raise ex
+        finally:
+            self.commandRegistry.timed = False
+
+    def generateTowers(self, variants):
+        '''
+        Generate a tower for each of several variants (such as a
+        temperature range for each filament). The first variant with a
+        given number of temperatures records a tower plan (See
+        gcodeplan), and each other variant with that number only fills
+        in its own temperatures while writing its own file. The settings
+        are the same as before afterward.
+
+        The template is read and parsed once for each different number
+        of temperatures, not once for all variants, since the tower ends
+        at a different level for each number. For example,
+        190-220,230-260 (7 temperatures each) parses it once, but
+        190-220/5,230-250/10 (7 and 3 temperatures) parses it twice (A
+        saved plan from an earlier run is used instead if there is one,
+        See cacheTowerPlans).
+
+        Sequential arguments:
+        variants -- A list of dicts of settings, such as
+            {"temperature": [190, 220], "temperature_step": 5} where a
+            list is a range (See setRangeVars) and any other value is
+            passed to setVar.
+
+        Returns:
+        list: The path of each tower (None for one where the settings
+            were not ok).
+        '''
+        original_settings = dict(self._settings)
+        self._batchPlans = {}
+        paths = []
+        try:
+            for variant in variants:
+                for name, value in variant.items():
+                    if isinstance(value, (list, tuple)):
+                        self.setRangeVars(name, value[0], value[1])
+                    else:
+                        self.setVar(name, value)
+                ok, err = self.checkSettings()
+                # ^ _generateTower uses the heights and temperatures
+                #   from before it checks the settings again.
+                self.resetEmuState()
+                # ^ Estimate each tower from a cold printer.
+                if ok and self._generateTower():
+                    paths.append(self.getTowerPath())
+                else:
+                    paths.append(None)
+        except Exception as ex:
+            self.enableUI(True)
+            raise ex
+        finally:
+            self._batchPlans = None
+            self.commandRegistry.timed = False
+            self._settings = original_settings
+            self.saveSettings()
+        return paths
+
+    def _finishMetrics(self, dst_path):
+        '''
+        Stop self.metrics and save it as JSON to self.metricsPath (or
+        dst_path + ".metrics.json" if None).
+        '''
+        metrics = self.metrics
+        metrics.stop()
+        handlers = {}
+        for name, stat in self.commandRegistry.get_stats().items():
+            if stat[0]:
+                handlers[name] = {'calls': stat[0], 'seconds': stat[1]}
+        metrics.extra['handlers'] = handlers
+        metrics.extra['template'] = self.getVar("template_gcode_path")
+        metrics.extra['coordinate_mode'] = self.coordinateMode
+        path = self.metricsPath
+        if path is None:
+            path = dst_path + ".metrics.json"
+        if metrics.dump(path):
+            print('* saved metrics to "{}"'.format(path))
 
     def getToolSecRelTemp(self, S):
         '''
@@ -852,15 +1170,18 @@ class GCodeFollower:
             self.setToolToAmbientTemperature()
             temperature = self.getToolTemperature()
         diff = abs(S - temperature)
-        toolSecPerDegree = 109.0 / 188.0
-        # It took R2X 14T with FlexionHT about 1m49s to get from
-        # room temperature of about 22C to 210C: 109s/188degrees
-        # = 0.57978723404255319149 sec/deg
-        return float(diff) * toolSecPerDegree
+        return float(diff) * self.TOOL_SEC_PER_DEGREE
 
-    def debug(self, msg):
+    def debug(self, msg, *args):
+        '''
+        Show a message if verbose. If there are args, msg is formatted
+        with them only if shown (so pass values as args instead of
+        formatting msg in a hot path).
+        '''
         if not self._verbose:
             return
+        if args:
+            msg = msg.format(*args)
         logger.debug("[debug] {}".format(msg))
 
     def getBedSecRelTemp(self, S):
@@ -875,265 +1196,390 @@ class GCodeFollower:
             self.setBedToAmbientTemperature()
             temperature = self.getBedTemperature()
         diff = abs(S - temperature)
-        bedSecPerDegree = 213.0 / 36.0
-        # It took R2X 14T with stock z axis about 3m33s to get from
-        # room temperature of about 22C to 58C: 213s/36degrees
-        # = 5.91666666666666666667 sec/deg
-        return float(diff) * bedSecPerDegree
+        return float(diff) * self.BED_SEC_PER_DEGREE
 
     def addSec(self, gcodeLine):
         '''
         Analyze the gcode line and add seconds to self._estS based on
         the travel speed and distance.
+
+        Sequential arguments:
+        gcodeLine -- A line of G-code (str), or a ParsedCommand so that
+            a line the caller already parsed isn't parsed again.
         '''
-        gcodeLine = gcodeLine.strip()
-        cmd_meta = get_cmd_meta(gcodeLine)
-        meta = cmd_meta_dict(cmd_meta)
-        if meta is None:
-            lenMsg = "{}(string[{}])".format(meta, 0)
+        if isinstance(gcodeLine, ParsedCommand):
+            meta = gcodeLine
         else:
-            lenMsg = "{}(string[{}])".format(cmd_meta[0], len(meta))
-        if lenMsg not in self.debuggedLengths:
+            meta = ParsedCommand(gcodeLine.strip())
+        cmd_meta = meta.pairs
+        if self._verbose:
             # Show unique command structures (Where the combination
             # of the G-code name and the parameter count is unique).
-            self.debuggedLengths.append(lenMsg)
-            debug("* found first instance of a command like: {}"
-                  "".format(meta))
-        if meta is None:
-            return
-        f = meta.get('function')
-        if f is None:
-            f = ""
-        if f.startswith("T"):
-            # Choose tool
-            # such as {'T': '0'}
-            self.setTool(f)
-        elif f == "M104":
-            # Set hotend temperature
-            # such as {'M': '104', 'S': '210'}
-            S = meta.get('S')
-            if S is None:
-                logger.warning('WARNING: S is None in "{}"'
-                               .format(cmd_meta))
+            if cmd_meta is None:
+                shape = (None, 0)
             else:
-                S = float(S)
-                self.setToolTemperature(S)
-        elif f == "M105":
-            # Report temperatures
-            # Usage: M105 [R] [T<index>]
-            # such as {'M': '105'}
-            pass
-        elif f == "M109":
-            # Wait for hotend temperature
-            # Usage:
-            # M109 [B<temp>] [F<flag>] [I<index>] [R<temp>] [S<temp>] [T<index>]
-            # such as {'M': '109', 'S': '210'}
-            S = meta.get('S')
-            if S is None:
-                logger.warning('WARNING: S is None in "{}"'
-                               .format(cmd_meta))
-            else:
-                S = float(S)
-                heatUpTime = self.getToolSecRelTemp(S)
-                self._estS += heatUpTime
-                oldS = self.getToolTemperature()
-                debug("_estSec += {} tool heat up time from {} to {}"
-                      "".format(heatUpTime, oldS, S))
-                self.setToolTemperature(S)
-        elif f == "M82":
-            # Set extrusion to absolute mode
-            # such as {'M': '82'}
-            pass
-        elif f == "M280":
-            # Set a servo position
-            # Usage: M280 P<index> S<pos>
-            # such as {'M': '280', 'P': '0', 'S': '160'}
-            pass
-        elif f == "G4":
-            # Dwell
-            # Usage: G4 [P<time (ms)>] [S<time (sec)>]
-            # such as {'G': '4', 'P': '100'}
-            S = meta.get('S')
-            P = meta.get('P')
+                shape = (cmd_meta[0], len(cmd_meta))
+            if shape not in self.debuggedLengths:
+                self.debuggedLengths.add(shape)
+                debug("* found first instance of a command like: {}",
+                      cmd_meta)
+        if cmd_meta is None:
+            return
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.count(meta.function)
+        if not self.commandRegistry.dispatch(self, meta):
+            self.diagnostics.add(
+                "not_emulated:" + meta.function,
+                "The command isn't emulated for estimates or other uses:"
+                " {}".format(cmd_meta),
+            )
+        # Additional relevant commands:
+        # M209: Set auto retract
+        # M141: Set chamber temperature
+
+    def registerDefaultHandlers(self, registry=None):
+        '''
+        Register the handler of each command that addSec emulates (See
+        self.commandRegistry). To emulate another command (or a macro),
+        register a callable that accepts (follower, meta) where meta is
+        a ParsedCommand, such as:
+        follower.commandRegistry.register("G5", emulateSpline)
+
+        Keyword arguments:
+        registry -- The CommandRegistry to register them in (default:
+            self.commandRegistry).
+        '''
+        if registry is None:
+            registry = self.commandRegistry
+        registry.register_prefix("T", GCodeFollower._emulateToolChange)
+        # ^ such as {'T': '0'}
+        registry.register("M104", GCodeFollower._emulateSetToolTemperature)
+        registry.register("M109", GCodeFollower._emulateToolHeatUp)
+        registry.register("G4", GCodeFollower._emulateDwell)
+        registry.register("G28", GCodeFollower._emulateAutoHome)
+        registry.register("M190", GCodeFollower._emulateBedHeatUp)
+        for f in ("G0", "G1", "G92"):
+            registry.register(f, GCodeFollower._emulateMove)
+        for f in ("G2", "G3"):
+            registry.register(f, GCodeFollower._emulateArc)
+        registry.register("G90", GCodeFollower._emulateAbsolute)
+        registry.register("G91", GCodeFollower._emulateRelative)
+        registry.register("M82", GCodeFollower._emulateAbsoluteE)
+        registry.register("M83", GCodeFollower._emulateRelativeE)
+        for f in GCodeFollower.IGNORED_COMMANDS:
+            registry.register(f, GCodeFollower._emulateNothing)
+
+    def hasDefaultHandlers(self):
+        '''
+        Check whether self.commandRegistry has only the handlers of
+        registerDefaultHandlers (not a custom handler or the handlers of
+        a ThermalModel).
+        '''
+        defaults = CommandRegistry()
+        self.registerDefaultHandlers(defaults)
+        return self.commandRegistry.handlers() == defaults.handlers()
+
+    def _emulateNothing(self, meta):
+        pass
+
+    def _emulateToolChange(self, meta):
+        # Choose tool
+        self.setTool(meta.function)
+
+    def _emulateSetToolTemperature(self, meta):
+        # Set hotend temperature
+        # such as {'M': '104', 'S': '210'}
+        S = meta.get('S')
+        if S is None:
+            self.diagnostics.add(
+                "no_S:" + meta.function,
+                'S is None in "{}"'.format(meta.pairs),
+                level=ERROR,
+            )
+        else:
+            S = float(S)
+            self.setToolTemperature(S)
+
+    def _emulateToolHeatUp(self, meta):
+        # Wait for hotend temperature
+        # Usage:
+        # M109 [B<temp>] [F<flag>] [I<index>] [R<temp>] [S<temp>] [T<index>]
+        # such as {'M': '109', 'S': '210'}
+        S = meta.get('S')
+        if S is None:
+            self.diagnostics.add(
+                "no_S:" + meta.function,
+                'S is None in "{}"'.format(meta.pairs),
+                level=ERROR,
+            )
+        else:
+            S = float(S)
+            heatUpTime = self.getToolSecRelTemp(S)
+            self._estS += heatUpTime
+            oldS = self.getToolTemperature()
+            debug("_estSec += {} tool heat up time from {} to {}",
+                  heatUpTime, oldS, S)
+            self.setToolTemperature(S)
+
+    def _emulateDwell(self, meta):
+        # Dwell
+        # Usage: G4 [P<time (ms)>] [S<time (sec)>]
+        # such as {'G': '4', 'P': '100'}
+        S = meta.get('S')
+        P = meta.get('P')
+        if P is not None:
+            P = float(P)
+        if S is None:
             if P is not None:
-                P = float(P)
-            if S is None:
-                if P is not None:
-                    S = P / 1000.0
-            else:
-                S = float(S)
-            if S is not None:
-                self._estS += S
-                debug("_estSec += {} dwell".format(S))
-            else:
-                logger.warning('WARNING: S & P are None in "{}"'
-                               .format(cmd_meta))
-        elif f == "M420":
-            # Get and/or set bed leveling state
-            # such as {'M': '420', 'S': '1'}
-            pass
-        elif f == "G28":
-            # Auto-home
-            # such as {'G': '28'}
-            oldTS = self.getToolTemperature()
-            T_S = self.autoHomeToolTemperature
-            toolHeatUpTime = self.getToolSecRelTemp(T_S)
-            self._estS += toolHeatUpTime
-            debug("_estSec += {} tool heat up time from {} to {} auto"
-                  "".format(toolHeatUpTime, oldTS, T_S))
-            self.setToolTemperature(T_S)
-            oldBS = self.getBedTemperature()
-            B_S = self.autoHomeBedTemperature
+                S = P / 1000.0
+        else:
+            S = float(S)
+        if S is not None:
+            self._estS += S
+            debug("_estSec += {} dwell", S)
+        else:
+            self.diagnostics.add(
+                "no_S_or_P:" + meta.function,
+                'S & P are None in "{}"'.format(meta.pairs),
+                level=ERROR,
+            )
+
+    def _emulateAutoHome(self, meta):
+        # Auto-home
+        # such as {'G': '28'}
+        oldTS = self.getToolTemperature()
+        T_S = self.autoHomeToolTemperature
+        toolHeatUpTime = self.getToolSecRelTemp(T_S)
+        self._estS += toolHeatUpTime
+        debug("_estSec += {} tool heat up time from {} to {} auto",
+              toolHeatUpTime, oldTS, T_S)
+        self.setToolTemperature(T_S)
+        oldBS = self.getBedTemperature()
+        B_S = self.autoHomeBedTemperature
+        bedHeatUpTime = self.getBedSecRelTemp(B_S)
+        self._estS += bedHeatUpTime
+        debug("  _estSec += {} bed heat up time from {} to {} auto",
+              bedHeatUpTime, oldBS, B_S)
+        self.setBedTemperature(B_S)
+        self._estS += self.autoHomeMoveTime
+        debug("  _estSec += {} autoHomeMoveTime",
+              self.autoHomeMoveTime)
+        # ^ A long time assumes a touch sensor
+
+    def _emulateBedHeatUp(self, meta):
+        # Wait for bed temperature
+        # such as {'M': '190', 'S': '60.0'}
+        oldBS = self.getBedTemperature()
+        B_S = meta.get('S')
+        if B_S is not None:
+            B_S = float(B_S)
             bedHeatUpTime = self.getBedSecRelTemp(B_S)
             self._estS += bedHeatUpTime
-            debug("  _estSec += {} bed heat up time from {} to {} auto"
-                  "".format(bedHeatUpTime, oldBS, B_S))
+            debug("_estSec += {} bed heat up time from {} to {}",
+                  bedHeatUpTime, oldBS, B_S)
             self.setBedTemperature(B_S)
-            self._estS += self.autoHomeMoveTime
-            debug("  _estSec += {} autoHomeMoveTime"
-                  "".format(self.autoHomeMoveTime))
-            # ^ A long time assumes a touch sensor
-        elif f == "M190":
-            # Wait for bed temperature
-            # such as {'M': '190', 'S': '60.0'}
-            oldBS = self.getBedTemperature()
-            B_S = meta.get('S')
-            if B_S is not None:
-                B_S = float(B_S)
-                bedHeatUpTime = self.getBedSecRelTemp(B_S)
-                self._estS += bedHeatUpTime
-                debug("_estSec += {} bed heat up time from {} to {}"
-                      "".format(bedHeatUpTime, oldBS, B_S))
-                self.setBedTemperature(B_S)
-            else:
-                # TODO: see if self.getBedTemperature differs from the
-                # last bed temp command's S.
-                pass
-        elif f == "M92":
-            # Set Axis Steps-per-unit
-            # such as {'G': '92', 'E': '0'}
+        else:
+            # TODO: see if self.getBedTemperature differs from the
+            # last bed temp command's S.
             pass
-        elif f in ["G0", "G1", "G92"]:
-            # such as:
-            # - {'G': '1', 'X': '50', 'Y': '1.5', 'Z': '0.22',
-            #    'F': '9000'}
-            # - {'G': '1', 'X': '110', 'E': '45', 'F': '500.0'}
-            # - {'G': '1', 'Y': '0.0', 'F': '250.0'}
-            # Caveats:
-            # - "Marlin 2.0 introduces an option to maintain a
-            #   separate default feed rate for G0"
-            #   -<https://marlinfw.org/docs/gcode/G000-G001.html>
-            # - "Coordinates are given in millimeters by default. Units
-            #   may be set to inches by G20."
-            #   -<https://marlinfw.org/docs/gcode/G000-G001.html>
-            oldPos = self.getToolPos()
-            newPos = self.getToolPos()
-            newPos = [meta.get('X'), meta.get('Y'), meta.get('Z')]
-            # ^ Cast to float before using (See the two loops below).
-            deltas = [0.0, 0.0, 0.0]
-            moveAny = False
-            if self.emuState['position_mode'] == 'relative':
-                for i in range(len(newPos)):
-                    if newPos[i] is None:
-                        newPos[i] = 0.0
-                    else:
-                        newPos[i] = float(newPos[i])
-                        moveAny = True
-                    deltas[i] = abs(newPos[i])
-            else:
-                for i in range(len(newPos)):
-                    if newPos[i] is None:
-                        newPos[i] = oldPos[i]
-                    else:
-                        moveAny = True
-                        newPos[i] = float(newPos[i])
-                    deltas[i] = abs(newPos[i]-oldPos[i])
-            distance = math.sqrt(
-                deltas[0]**2 + deltas[1]**2 + deltas[2]**2
-            )
-            # elif f == "G0":
-            # such as:
-            # - {'G': '0', 'F': '4200', 'X': '103.931', 'Y': '57.516',
-            #    'Z': '0.32'}
-            # - {'G': '0', 'F': '4200', 'X': '103.451', 'Y': '57.996'}
-            # - {'G': '0', 'X': '103.251', 'Y': '57.416'}
-
-            F = meta.get('F')  # mm/minute
-            tool = self.emuState['tool']
-            if F is None:
-                oldF = self.emuState['tools'][tool].get('feed_rate')
-                if oldF is not None:
-                    F = oldF
+
+    def _emulateAbsolute(self, meta):
+        self.emuState['position_mode'] = 'absolute'
+        self.setEPositionMode('absolute')
+        # ^ Like Marlin, G90 and G91 also set the extruder mode (but
+        #   Klipper only sets it with M82 and M83).
+
+    def _emulateRelative(self, meta):
+        self.emuState['position_mode'] = 'relative'
+        self.setEPositionMode('relative')
+
+    def _emulateAbsoluteE(self, meta):
+        self.setEPositionMode('absolute')
+
+    def _emulateRelativeE(self, meta):
+        self.setEPositionMode('relative')
+
+    def _emulateMove(self, meta):
+        # such as:
+        # - {'G': '1', 'X': '50', 'Y': '1.5', 'Z': '0.22',
+        #    'F': '9000'}
+        # - {'G': '1', 'X': '110', 'E': '45', 'F': '500.0'}
+        # - {'G': '1', 'Y': '0.0', 'F': '250.0'}
+        # Caveats:
+        # - "Marlin 2.0 introduces an option to maintain a
+        #   separate default feed rate for G0"
+        #   -<https://marlinfw.org/docs/gcode/G000-G001.html>
+        # - "Coordinates are given in millimeters by default. Units
+        #   may be set to inches by G20."
+        #   -<https://marlinfw.org/docs/gcode/G000-G001.html>
+        oldPos = self.getToolPos()
+        newPos = self.getToolPos()
+        newPos = [meta.get('X'), meta.get('Y'), meta.get('Z')]
+        # ^ Cast to float before using (See the two loops below).
+        deltas = [0.0, 0.0, 0.0]
+        moveAny = False
+        if self.emuState['position_mode'] == 'relative':
+            for i in range(len(newPos)):
+                if newPos[i] is None:
+                    newPos[i] = 0.0
                 else:
-                    logger.warning(
-                        "WARNING: The feed_rate is unknown at {}."
-                        .format(cmd_meta))
-                return
+                    newPos[i] = float(newPos[i])
+                    moveAny = True
+                deltas[i] = abs(newPos[i])
+        else:
+            for i in range(len(newPos)):
+                if newPos[i] is None:
+                    newPos[i] = oldPos[i]
+                else:
+                    moveAny = True
+                    newPos[i] = float(newPos[i])
+                deltas[i] = abs(newPos[i]-oldPos[i])
+        distance = math.sqrt(
+            deltas[0]**2 + deltas[1]**2 + deltas[2]**2
+        )
+        # elif f == "G0":
+        # such as:
+        # - {'G': '0', 'F': '4200', 'X': '103.931', 'Y': '57.516',
+        #    'Z': '0.32'}
+        # - {'G': '0', 'F': '4200', 'X': '103.451', 'Y': '57.996'}
+        # - {'G': '0', 'X': '103.251', 'Y': '57.416'}
+
+        F = meta.get('F')  # mm/minute
+        tool = self.emuState['tool']
+        if F is None:
+            oldF = self.emuState['tools'][tool].get('feed_rate')
+            if oldF is not None:
+                F = oldF
+            else:
+                self.diagnostics.add(
+                    "unknown_feed_rate",
+                    "The feed_rate is unknown at {}.".format(meta.pairs),
+                )
+            return
+        else:
+            F = float(F)
+        feedPerSec = F / 60.0
+
+        if moveAny:
+            travelTime = distance / feedPerSec
+            self._estS += travelTime
+            if travelTime > 6:
+                debug("_estSec += {} travel time ({} / {})",
+                      travelTime, distance, feedPerSec)
+                debug("  oldPos: {}", oldPos)
+                debug("  newPos: {}", newPos)
+                debug("  deltas: {}", deltas)
+                debug("  self.emuState['position_mode']: {}",
+                      self.emuState['position_mode'])
+            self.emuState['position'] = newPos
+            self.emuState['tools'][tool]['feed_rate'] = F
+            # ^ A servo feed_rate is set below if not returning.
+            return
+        servo = self.emuState['extruder']
+        self.emuState['servos'][servo]['feed_rate'] = F
+
+        eDiff = 0.0
+        E = meta.get('E')
+        if E is not None:
+            E = float(E)
+            if self.getEPositionMode() == 'relative':
+                eDiff = abs(E)
+                E += self.getEPos()
             else:
-                F = float(F)
-            feedPerSec = F / 60.0
-
-            if moveAny:
-                travelTime = distance / feedPerSec
-                self._estS += travelTime
-                if travelTime > 6:
-                    debug("_estSec += {} travel time ({} / {})"
-                          "".format(travelTime, distance, feedPerSec))
-                    debug("  oldPos: {}".format(oldPos))
-                    debug("  newPos: {}".format(newPos))
-                    debug("  deltas: {}".format(deltas))
-                    debug("  self.emuState['position_mode']: {}"
-                          "".format(self.emuState['position_mode']))
-                self.emuState['position'] = newPos
-                self.emuState['tools'][tool]['feed_rate'] = F
-                # ^ A servo feed_rate is set below if not returning.
-                return
-            servo = self.emuState['extruder']
-            self.emuState['servos'][servo]['feed_rate'] = F
-
-            eDiff = 0.0
-            E = meta.get('E')
-            if E is not None:
-                E = float(E)
                 eDiff = abs(self.getEPos() - E)
-                feedTime = eDiff / feedPerSec
-                self._estS += feedTime
-                debug("_estSec += {} feed time ({} / {})"
-                      "".format(feedTime, eDiff, feedPerSec))
-                self.setEPos(E)
+            feedTime = eDiff / feedPerSec
+            self._estS += feedTime
+            debug("_estSec += {} feed time ({} / {})",
+                  feedTime, eDiff, feedPerSec)
+            self.setEPos(E)
+        else:
+            self.diagnostics.add(
+                "no_movement",
+                'Estimating "{}" is not possible since there was no X,'
+                ' Y, Z, nor E movement.'.format(meta.pairs),
+            )
+
+    def _emulateArc(self, meta):
+        # such as {'G': '2', 'X': '125', 'Y': '0', 'I': '-10', 'J': '0',
+        #          'E': '0.5', 'F': '1200'}
+        # (G2 is clockwise, G3 counterclockwise, and I and J are the
+        # center relative to the start, or R is the radius). Like
+        # _emulateMove, the move is only estimated if it has F, E isn't
+        # tracked while moving, and in relative mode the position
+        # becomes the offset. See maniforge.gcodearc.
+        oldPos = self.getToolPos()
+        relative = self.emuState['position_mode'] == 'relative'
+        newPos = [meta.get('X'), meta.get('Y'), meta.get('Z')]
+        for i in range(len(newPos)):
+            if newPos[i] is not None:
+                newPos[i] = float(newPos[i])
+            elif relative:
+                newPos[i] = 0.0
             else:
-                logger.warning('WARNING: Estimating "{}" is not possible since'
-                               ' there was no X, Y, Z, nor E movement.'
-                               .format(cmd_meta))
+                newPos[i] = oldPos[i]
+        if relative:
+            start = (0.0, 0.0)
+            dz = newPos[2]
+        else:
+            start = (oldPos[0], oldPos[1])
+            dz = newPos[2] - oldPos[2]
+        offset = None
+        if meta.has('I') or meta.has('J'):
+            offset = (float(meta.get('I') or 0.0),
+                      float(meta.get('J') or 0.0))
+        radius = meta.get('R')
+        if radius is not None:
+            radius = float(radius)
+        elif offset is None:
+            self.diagnostics.add(
+                "no_arc_center",
+                'There is no I, J nor R in "{}"'.format(meta.pairs),
+                level=ERROR,
+            )
+            return
+        distance = arc_length(start, newPos[:2], offset=offset,
+                              radius=radius,
+                              clockwise=(meta.function == "G2"), dz=dz)
+        if distance is None:
+            distance = 0.0  # R from the start to the start is no arc.
 
-        elif f == "M107":
-            # Fan off
-            # such as {'M': '107'}
-            pass
-        elif f == "M106":
-            # Set fan speed
-            # such as {'M': '106', 'S': '255'}
-            pass
-        elif f == "G90":
-            self.emuState['position_mode'] = 'absolute'
-        elif f == "G91":
-            self.emuState['position_mode'] = 'relative'
-        elif f == "M140":
-            # Set bed temp BUT don't wait.
-            pass
-        elif f == "M117":
-            # Show a message.
-            pass
-        elif f == "M84":
-            # Disable motors.
-            pass
+        F = meta.get('F')  # mm/minute
+        tool = self.emuState['tool']
+        if F is None:
+            if self.emuState['tools'][tool].get('feed_rate') is None:
+                self.diagnostics.add(
+                    "unknown_feed_rate",
+                    "The feed_rate is unknown at {}.".format(meta.pairs),
+                )
+            return
+        F = float(F)
+        self._estS += distance / (F / 60.0)
+        self.emuState['position'] = newPos
+        self.emuState['tools'][tool]['feed_rate'] = F
+
+    def addFileSec(self, path):
+        '''
+        Add the estimated seconds for a whole G-code file to self._estS
+        the same way as calling addSec for each line, but using numpy
+        for the whole file at once (See
+        maniforge.gcodeestimate.estimate_table). If self.plannerLimits
+        is set, moves are estimated using acceleration instead (See
+        maniforge.gcodeplanner.estimate_planned_table). Problems are
+        reported once at the end (See self.diagnostics).
+
+        Sequential arguments:
+        path -- The G-code file.
+
+        Returns:
+        float: The seconds added.
+        '''
+        if self.plannerLimits is not None:
+            seconds = estimate_planned_file(self, path, self.plannerLimits)
         else:
-            logger.warning("WARNING: The command isn't emulated for estimates"
-                           " or other uses: {}"
-                           .format(cmd_meta))
-        # Additional relevant commands:
-        # M209: Set auto retract
-        # M141: Set chamber temperature
+            seconds = estimate_file(self, path)
+        self.diagnostics.report()
+        return seconds
 
     def _generateTower(self):
         getV = self.getVar
@@ -1162,10 +1608,23 @@ class GCodeFollower:
                                " run checkSettings before"
                                " generateTower.")
         echoP = self._echo_progress
+        metrics = None  # Only check "is not None" in the loop.
+        if self.collectMetrics:
+            metrics = GCodeMetrics()
+            self.commandRegistry.clear_stats()
+            self.commandRegistry.timed = True
+        self.metrics = metrics
+        diagnostics = self.diagnostics
+        diagnostics.clear()
         self._estS = 0.0
+        if self.thermalModel is not None:
+            self.thermalModel.reset()
         start_temperature_found = False
         stw_cmd = self.commands['set temperature and wait']
         stw_param0 = self.params['set temperature and wait'][0]
+        # The temperature lines (See gcodeplan):
+        level_fmt = stw_cmd + " " + stw_param0 + "{:.2f}"
+        start_fmt = stw_cmd + " " + stw_param0 + "{:d}"
         tmprs = self.temperatures
 
         self.clearStats()
@@ -1197,8 +1656,7 @@ class GCodeFollower:
             self.echo(str(e))
             raise e
         tmp_path = getV("template_gcode_path") + ".tmp"
-        dst_path = (self.getRangeString("temperature") + "_"
-                    + getV("template_gcode_path"))
+        dst_path = self.getTowerPath()
         # os.path.splitext(getV("template_gcode_path"))[0]
         # + "_" + range + ".gcode"
         dant_shown = {}  # debug accessing new temperature
@@ -1208,293 +1666,535 @@ class GCodeFollower:
         bytes_total = os.path.getsize(getV("template_gcode_path"))
         bytes_count = 0
         setS("progress", "0%", -1)
-        prev_line_len = 0
         template_gcode_path = getV("template_gcode_path")
+        plans = None
+        batch_key = None
+        cache = self.cacheTowerPlans and self.hasDefaultHandlers()
+        if self._batchPlans is not None:
+            batch_key = (template_gcode_path,
+                         json.dumps(self.getTowerPlanKey(), sort_keys=True))
+            plans = self._batchPlans.get(batch_key)
+        if (plans is None) and cache:
+            plans = load_tower_plans(template_gcode_path,
+                                     self.getTowerPlanKey())
+        elif (plans is None) and (batch_key is not None):
+            plans = TowerPlans(self.getTowerPlanKey())
+        if batch_key is not None:
+            self._batchPlans[batch_key] = plans
+        if plans is not None:
+            plan = plans.get(len(tmprs))
+            if plan is not None:
+                print("* using the saved plan for \"{}\"..."
+                      "".format(template_gcode_path))
+                if metrics is not None:
+                    metrics.lap("read")
+                plan.estimate(self, tmprs)
+                if metrics is not None:
+                    metrics.lap("estimate")
+                plan.restore(self)
+                if metrics is not None:
+                    metrics.extra['diagnostics'] = diagnostics.to_dict()
+                diagnostics.report()
+                plan.write_file(template_gcode_path, tmp_path, tmprs)
+                self._postProcessTower(tmp_path)
+                self._finishTower(tmp_path, dst_path, plan.line_count)
+                if metrics is not None:
+                    metrics.lap("write")
+                    metrics.lines = plan.line_count
+                    metrics.bytes = bytes_total
+                    metrics.extra['cached_plan'] = True
+                    self._finishMetrics(dst_path)
+                return True
+
+        def addSec(gcodeLine, slot=None):
+            if metrics is not None:
+                metrics.lap("classify")
+                outs.add_sec(self, gcodeLine, slot=slot)
+                metrics.lap("estimate")
+                return
+            outs.add_sec(self, gcodeLine, slot=slot)
+
+        fixed = (self.coordinateMode == "fixed")
+        max_z_move = getV("max_z_build_movement")  # Only cast once.
+        if fixed:
+            # Parameters are ints in the units of FIXED_PLACES (See
+            # to_fixed), and the parameter stats are only set at the end
+            # (from param_raws) since they are Decimal.
+            max_z_move = to_fixed(str(max_z_move), FIXED_PLACES['Z'])
+        param_raws = {}  # The last value string of each parameter
+        param_lines = {}  # The line where each param_raws value was
+        net_e = None  # See net_E_before_stop_building in setStat
+        e_places = 0  # The most decimal places of any E in net_e
+
+        def getParam(name):
+            # Get the last value of a parameter (like getS in the
+            # Decimal mode).
+            if fixed:
+                raw = param_raws.get(name)
+                if raw is None:
+                    return None
+                return Decimal(raw)
+            return getS(name)
+
+        def getParamLine(name):
+            if fixed:
+                return param_lines.get(name)
+            return self.getStatLine(name)
+
+        def showParam(value, name):
+            # Get a value from given_values or deltas in the original
+            # units (to show it).
+            if fixed and (value is not None):
+                return from_fixed(
+                    value,
+                    FIXED_PLACES.get(name, DEFAULT_FIXED_PLACES)
+                )
+            return value
+
         print("* reading \"{}\"...".format(template_gcode_path))
-        with open(template_gcode_path) as ins:
-            with open(tmp_path, 'w') as outs:
-                line_number = 0
-                for original_line in ins:
-                    bytes_count += prev_line_len
+        workers = self.workers
+        if workers == 0:
+            workers = multiprocessing.cpu_count()
+        scan_options = None
+        if workers > 1:
+            scan_options = self.getScanOptions()
+            if scan_options is None:
+                echoP("* INFO: The template will be parsed in one process"
+                      " since a move handler was replaced.")
+        if scan_options is not None:
+            source = iter_scanned_lines(
+                self,
+                template_gcode_path,
+                scan_options,
+                workers,
+                stop=lambda: getS("stop_building"),
+            )
+        else:
+            source = iter_mapped_lines(template_gcode_path)
+        with closing(source) as ins:
+            outs = TowerPlanRecorder()
+            line_number = 0
+            lines = ins
+            if metrics is not None:
+                lines = metrics.iter_timed(ins, "read", "classify")
+            for bytes_count, original_bytes in lines:
+                if isinstance(original_bytes, LineRun):
+                    # Lines that another process parsed (See
+                    # iter_scanned_lines) have the same effect as
+                    # handling them one at a time below:
+                    run = original_bytes
                     setS(
                         "progress",
-                        (str(round(bytes_count/round(bytes_total/100)))
+                        (str(round(run.last_offset*100
+                                   / max(bytes_total, 1)))
                          + "%"),
-                        line_number
+                        line_number + run.line_count - 1
                     )
-                    prev_line_len = len(original_line)
-                    next_l_h = None  # next level's height
-                    next_l_t = None  # next level's temperature
-                    if getS("level") + 1 < len(heights):
-                        next_l_h = heights[getS("level") + 1]
-                        if self._verbose:
-                            l_str = str(getS("level") + 1)
-                            if dnlh_shown.get(l_str) is not True:
-                                echoP("* INFO: The next height (for"
-                                      " level {}) is"
-                                      " {}.".format(l_str, next_l_h))
-                                dnlh_shown[l_str] = True
-                    else:
-                        if self._verbose:
-                            l_str = str(getS("level") + 1)
-                            if dnnh_shown.get(l_str) is not True:
-                                echoP("* INFO: There is no height for"
-                                      " the next level"
-                                      " ({}).".format(l_str))
-                                dnnh_shown[l_str] = True
-                    if getS("level") + 1 < len(tmprs):
-                        next_l_t = tmprs[getS("level") + 1]
-                        if self._verbose:
-                            l_str = str(getS("level") + 1)
-                            if dant_shown.get(l_str) is not True:
-                                echoP("* INFO: A temperature for level"
-                                      " {} is being"
-                                      " accessed.".format(l_str))
-                                dant_shown[l_str] = True
-                    if given_values is not None:
-                        for k, v in given_values.items():
-                            previous_values[k] = v
-                    given_values = {}  # This is ONLY for the current
-                    #                  # command. Other known (past)
-                    #                  # values are in stats.
+                    if given_values:
+                        previous_values.update(given_values)
+                        given_values = {}
+                    apply_line_run(self, run, line_number)
+                    for key, (value, raw, index) in run.params.items():
+                        previous_values[key] = value
+                        if fixed:
+                            param_raws[key] = raw
+                            param_lines[key] = line_number + index
+                        elif key == "E":
+                            self._setStatRun(key, value, run.e_total,
+                                             line_number + index)
+                        else:
+                            setS(key, value, line_number + index)
+                    if fixed and (run.e_total is not None):
+                        net_e = run.e_total + (net_e or 0)
+                        e_places = max(e_places, run.e_places)
+                    outs.write_segments(run.segments)
+                    previous_dst_line = run.last_line
+                    line_number += run.line_count
+                    continue
+                outs.source(bytes_count, original_bytes)
+                # ^ bytes_count is the true byte offset of the line.
+                setS(
+                    "progress",
+                    (str(round(bytes_count*100/max(bytes_total, 1)))
+                     + "%"),
+                    line_number
+                )
+                if (getS("stop_building")
+                        and self._isBuildMoveBytes(original_bytes)):
+                    # Fast-forward: The line would be discarded, and
+                    # skipping it only changes the stats of its params
+                    # (It has no Z, so Z deltas are still correct).
+                    if given_values:
+                        previous_values.update(given_values)
+                        given_values = {}
                     line_number += 1
-                    line = original_line.rstrip()
-                    double_blank = False
-                    if previous_dst_line is not None:
-                        if ((len(previous_dst_line) == 0) and
-                                (len(line) == 0)):
-                            double_blank = True
-                    previous_src_line = line
-                    cmd_meta = get_cmd_meta(line)
-                    would_extrude = False
-                    would_move_for_build = False
-                    would_build = False
-                    deltas = {}
-                    part_indices = {}
-                    if cmd_meta is not None:
-                        for i in range(1, len(cmd_meta)):
-                            part_indices[cmd_meta[i][0]] = i
-                            if len(cmd_meta[i]) < 2:
-                                continue  # no value; just letter param
-                            elif len(cmd_meta[i]) > 2:
-                                echoP("Line {}: WARNING: extra param"
-                                      " (this should never happen) in"
-                                      " '{}'".format(line_number, line))
-                            try:
-                                setS(cmd_meta[i][0],
-                                     Decimal(cmd_meta[i][1]),
-                                     line_number)
-                                given_values[cmd_meta[i][0]] = Decimal(
-                                    cmd_meta[i][1]
-                                )
-                            except decimal.InvalidOperation as e:
-                                if type(e) == decimal.ConversionSyntax:
-                                    echoP(
-                                        "Line {}: ERROR: Bad"
-                                        " conversion syntax:"
-                                        " '{}'".format(line_number,
-                                                       cmd_meta[i][1])
-                                    )
-                                else:
-                                    echoP(
-                                        "Line {}: ERROR: Bad Decimal"
-                                        " (InvalidOperation):"
-                                        " '{}'".format(line_number,
-                                                       cmd_meta[i][1])
-                                    )
-                                echoP("  cmd_meta: {}".format(cmd_meta))
-                        for k, v in given_values.items():
-                            previous_v = previous_values.get(k)
-                            if previous_v is not None:
-                                deltas[k] = v - previous_v
-                        if getS("stop_building"):
-                            # echoP(str(cmd_meta))
-                            if (len(cmd_meta) == 2):
-                                if (cmd_meta[1][0] == "F"):
-                                    # It ONLY has F param, so it is not
-                                    # end gcode.
-                                    would_move_for_build = True
-                                # elif given_values.get("F")
-                                # is not None:
-                                #     echoP("Line {}: ERROR: Keeping"
-                                #           " unnecessary"
-                                #           " F in:"
-                                #           " {}".format(line_number,
-                                #                        cmd_meta))
-                            # else:
-                            #     echoP("Line {}: ERROR: Keeping"
-                            #           " necessary F"
-                            #           " in: {}".format(line_number,
-                            #                            cmd_meta))
-                    if cmd_meta is None:
-                        if ((not getS("stop_building")) or
-                                (not double_blank)):
-                            self.addSec(original_line)
-                            outs.write(
-                                (original_line.rstrip("\n").rstrip("\r")
-                                 + "\n")
-                            )
-                            previous_dst_line = line
-                        continue
-                    # cmdStr ''.join(cmd_meta[0])  # such as "M117"
-                    # Example cmd_meta=[['G', '4'], ['P', '100']]
-                    if len(cmd_meta[0]) == 1:
-                        # Klipper-style macro
-                        pass
-                    elif cmd_meta[0][1] is not None:
+                    continue
+                original_line = original_bytes.decode("utf-8")
+                if original_line.endswith("\r\n"):
+                    # Only use "\n" as in text mode (See "universal
+                    #   newlines" in Python documentation).
+                    original_line = original_line[:-2] + "\n"
+                if metrics is not None:
+                    metrics.lap("read")
+                next_l_h = None  # next level's height
+                next_l_t = None  # next level's temperature
+                if getS("level") + 1 < len(heights):
+                    next_l_h = heights[getS("level") + 1]
+                    if self._verbose:
+                        l_str = str(getS("level") + 1)
+                        if dnlh_shown.get(l_str) is not True:
+                            echoP("* INFO: The next height (for"
+                                  " level {}) is"
+                                  " {}.".format(l_str, next_l_h))
+                            dnlh_shown[l_str] = True
+                else:
+                    if self._verbose:
+                        l_str = str(getS("level") + 1)
+                        if dnnh_shown.get(l_str) is not True:
+                            echoP("* INFO: There is no height for"
+                                  " the next level"
+                                  " ({}).".format(l_str))
+                            dnnh_shown[l_str] = True
+                if getS("level") + 1 < len(tmprs):
+                    next_l_t = tmprs[getS("level") + 1]
+                    if self._verbose:
+                        l_str = str(getS("level") + 1)
+                        if dant_shown.get(l_str) is not True:
+                            echoP("* INFO: A temperature for level"
+                                  " {} is being"
+                                  " accessed.".format(l_str))
+                            dant_shown[l_str] = True
+                if given_values is not None:
+                    for k, v in given_values.items():
+                        previous_values[k] = v
+                given_values = {}  # This is ONLY for the current
+                #                  # command. Other known (past)
+                #                  # values are in stats.
+                line_number += 1
+                diagnostics.line_number = line_number
+                line = original_line.rstrip()
+                double_blank = False
+                if previous_dst_line is not None:
+                    if ((len(previous_dst_line) == 0) and
+                            (len(line) == 0)):
+                        double_blank = True
+                previous_src_line = line
+                command = ParsedCommand(line)
+                cmd_meta = command.pairs
+                would_extrude = False
+                would_move_for_build = False
+                would_build = False
+                deltas = {}
+                part_indices = {}
+                if cmd_meta is not None:
+                    for i in range(1, len(cmd_meta)):
+                        part_indices[cmd_meta[i][0]] = i
+                        if len(cmd_meta[i]) < 2:
+                            continue  # no value; just letter param
+                        elif len(cmd_meta[i]) > 2:
+                            echoP("Line {}: WARNING: extra param"
+                                  " (this should never happen) in"
+                                  " '{}'".format(line_number, line))
                         try:
-                            code_number = int(cmd_meta[0][1])
-                        except ValueError as ex:
-                            print("Error in cmd_meta: {}".format(cmd_meta))
-                            raise ex
-
-                    if len(cmd_meta[0]) == 1:
-                        # Klipper-style macro
-                        # such as TIMELAPSE_TAKE_FRAME
-                        self.addSec(line)
-                        outs.write(original_line)
-                        previous_dst_line = line
-                        pass
-                    elif cmd_meta[0][0] == "G":
-                        if given_values.get('E') is not None:
-                            would_extrude = True
-                            # if (comment is not None) or
-                            # (GCodeFollower._end_retraction_flag in
-                            # comment):
-                            if GCodeFollower._end_retraction_flag in line:
-                                if Decimal(given_values.get('E')) < 0:
-                                    # NOTE: Otherwise includes
-                                    # retractions in end gcode
-                                    # (negative # after E)
-                                    would_extrude = False
-                            # Otherwise, discard BOTH negative and
-                            # positive filament feeding after tower is
-                            # finished.
-                        # NOTE: homing is still allowed (values without
-                        # params are not in given_values).
-                        if given_values.get('X') is not None:
-                            if (given_values.get('Y') is not None):
-                                would_move_for_build = True
-                            elif (given_values.get('Z') is not None):
-                                would_move_for_build = True
-                            elif given_values.get('X') != Decimal("0.00"):
-                                would_move_for_build = True
+                            if fixed:
+                                key = cmd_meta[i][0]
+                                value = to_fixed(
+                                    cmd_meta[i][1],
+                                    FIXED_PLACES.get(key,
+                                                     DEFAULT_FIXED_PLACES)
+                                )
+                                param_raws[key] = cmd_meta[i][1]
+                                param_lines[key] = line_number
+                                if (key == "E") and \
+                                        not getS("stop_building"):
+                                    net_e = value + (net_e or 0)
+                                    dot = cmd_meta[i][1].find(".")
+                                    if dot >= 0:
+                                        e_places = max(
+                                            e_places,
+                                            len(cmd_meta[i][1]) - dot - 1
+                                        )
                             else:
-                                # it is homing X, so it isn't building
-                                pass
-                        # elif given_values.get('Y') is not None:
-                            # # NOTE: This can't help but eliminate
-                            # # moving the (Prusa-style) bed forward
-                            # # for easy removal in end gcode.
-                            # would_move_for_build = True
-                        delta_z = deltas.get("Z")
-                        if (delta_z is not None):
-                            if (abs(delta_z) <= getV("max_z_build_movement")):
-                                # This is too small to be a necessary
-                                # move (it is probably moving to the
-                                # next layer)
+                                value = command.get_decimal(cmd_meta[i][0])
+                                setS(cmd_meta[i][0], value, line_number)
+                            given_values[cmd_meta[i][0]] = value
+                        except decimal.InvalidOperation as e:
+                            if type(e) == decimal.ConversionSyntax:
+                                echoP(
+                                    "Line {}: ERROR: Bad"
+                                    " conversion syntax:"
+                                    " '{}'".format(line_number,
+                                                   cmd_meta[i][1])
+                                )
+                            else:
+                                echoP(
+                                    "Line {}: ERROR: Bad Decimal"
+                                    " (InvalidOperation):"
+                                    " '{}'".format(line_number,
+                                                   cmd_meta[i][1])
+                                )
+                            echoP("  cmd_meta: {}".format(cmd_meta))
+                    # Only the Z delta is used (See delta_z).
+                    given_z = given_values.get("Z")
+                    if given_z is not None:
+                        previous_z = previous_values.get("Z")
+                        if previous_z is not None:
+                            deltas["Z"] = given_z - previous_z
+                if metrics is not None:
+                    metrics.lap("parse")
+                if cmd_meta is not None:
+                    if getS("stop_building"):
+                        # echoP(str(cmd_meta))
+                        if (len(cmd_meta) == 2):
+                            if (cmd_meta[1][0] == "F"):
+                                # It ONLY has F param, so it is not
+                                # end gcode.
                                 would_move_for_build = True
-                            elif (getS("stop_building") and
-                                    not would_move_for_build):
-                                echoP("Line {}: Moving from {} (from"
-                                      " line {}) to {} would"
-                                      " move a lot {}"
-                                      " (keeping '{}').".format(
-                                        line_number,
-                                        getS("Z"),
-                                        self.getStatLine("Z"),
-                                        given_values.get("Z"),
-                                        abs(deltas.get("Z")),
-                                        line
-                                      ))
+                            # elif given_values.get("F")
+                            # is not None:
+                            #     echoP("Line {}: ERROR: Keeping"
+                            #           " unnecessary"
+                            #           " F in:"
+                            #           " {}".format(line_number,
+                            #                        cmd_meta))
+                        # else:
+                        #     echoP("Line {}: ERROR: Keeping"
+                        #           " necessary F"
+                        #           " in: {}".format(line_number,
+                        #                            cmd_meta))
+                if cmd_meta is None:
+                    if ((not getS("stop_building")) or
+                            (not double_blank)):
+                        addSec(command)
+                        outs.write(
+                            (original_line.rstrip("\n").rstrip("\r")
+                             + "\n")
+                        )
+                        previous_dst_line = line
+                    continue
+                # cmdStr ''.join(cmd_meta[0])  # such as "M117"
+                # Example cmd_meta=[['G', '4'], ['P', '100']]
+                if len(cmd_meta[0]) == 1:
+                    # Klipper-style macro
+                    pass
+                elif cmd_meta[0][1] is not None:
+                    try:
+                        code_number = int(cmd_meta[0][1])
+                    except ValueError as ex:
+                        print("Error in cmd_meta: {}".format(cmd_meta))
+                        raise ex
+
+                if len(cmd_meta[0]) == 1:
+                    # Klipper-style macro
+                    # such as TIMELAPSE_TAKE_FRAME
+                    addSec(command)
+                    outs.write(original_line)
+                    previous_dst_line = line
+                    pass
+                elif cmd_meta[0][0] == "G":
+                    if given_values.get('E') is not None:
+                        would_extrude = True
+                        # if (comment is not None) or
+                        # (GCodeFollower._end_retraction_flag in
+                        # comment):
+                        if GCodeFollower._end_retraction_flag in line:
+                            if given_values.get('E') < 0:
+                                # NOTE: Otherwise includes
+                                # retractions in end gcode
+                                # (negative # after E)
+                                would_extrude = False
+                        # Otherwise, discard BOTH negative and
+                        # positive filament feeding after tower is
+                        # finished.
+                    # NOTE: homing is still allowed (values without
+                    # params are not in given_values).
+                    if given_values.get('X') is not None:
+                        if (given_values.get('Y') is not None):
+                            would_move_for_build = True
+                        elif (given_values.get('Z') is not None):
+                            would_move_for_build = True
+                        elif given_values.get('X') != 0:
+                            would_move_for_build = True
+                        else:
+                            # it is homing X, so it isn't building
+                            pass
+                    # elif given_values.get('Y') is not None:
+                        # # NOTE: This can't help but eliminate
+                        # # moving the (Prusa-style) bed forward
+                        # # for easy removal in end gcode.
+                        # would_move_for_build = True
+                    delta_z = deltas.get("Z")
+                    if (delta_z is not None):
+                        if (abs(delta_z) <= max_z_move):
+                            # This is too small to be a necessary
+                            # move (it is probably moving to the
+                            # next layer)
+                            would_move_for_build = True
                         elif (getS("stop_building") and
-                                (getS("Z") is None)):
-                            echoP("Line {}: ERROR: No recorded z delta"
-                                  "but build is"
-                                  " over.".format(line_number))
-
-                        would_build = (would_extrude or
-                                       would_move_for_build)
-
-                        if (code_number == 1) or (code_number == 0):
-                            if getS("stop_building"):
-                                if would_build:
-                                    # NOTE: this removes any retraction
-                                    # (negative value after 'E' param)
-                                    # in stop gcode.
-                                    continue
-                                else:
-                                    echoP(
-                                        "Line {}: WARNING: Allowing"
-                                        " '{}' after stop (z"
-                                        " delta {})".format(
-                                            line_number,
-                                            line,
-                                            deltas.get("Z")
-                                        )
-                                    )
-                            self.addSec(line)
-                            outs.write(line + "\n")
-                            previous_dst_line = line  # It's just a
-                            #                         # movement, so
-                            #                         # don't edit it.
-                            #                         # Insert
-                            #                         # temperature
-                            #                         # after it if it
-                            #                         # is a new level
-                            #                         # (below).
-                            given_z = given_values.get("Z")
-                            z_index = part_indices.get("Z")
-                            if z_index is None:
-                                continue
-                            if len(cmd_meta[z_index]) == 1:
-                                setS("height", Decimal("0.00"),
-                                     line_number)
-                                last_height = getS("height")
-                                setL(0, line_number)
-                                # echoP("Line {}: Missing value after"
-                                #       " '{}'".format(
-                                #     line_number,
-                                #     cmd_meta[1][0])
-                                # )
-                                # continue
-                                # if len(cmd_meta[1]) == 1:  # already
-                                #                            # checked
-                                echoP("Line {}: INFO: Homing was"
-                                      " detected so"
-                                      " level & height were changed"
-                                      " to 0...")
+                                not would_move_for_build):
+                            echoP("Line {}: Moving from {} (from"
+                                  " line {}) to {} would"
+                                  " move a lot {}"
+                                  " (keeping '{}').".format(
+                                    line_number,
+                                    getParam("Z"),
+                                    getParamLine("Z"),
+                                    showParam(given_values.get("Z"), "Z"),
+                                    showParam(abs(deltas.get("Z")), "Z"),
+                                    line
+                                  ))
+                    elif (getS("stop_building") and
+                            (getParam("Z") is None)):
+                        echoP("Line {}: ERROR: No recorded z delta"
+                              "but build is"
+                              " over.".format(line_number))
+
+                    would_build = (would_extrude or
+                                   would_move_for_build)
+
+                    if (code_number == 1) or (code_number == 0):
+                        if getS("stop_building"):
+                            if would_build:
+                                # NOTE: this removes any retraction
+                                # (negative value after 'E' param)
+                                # in stop gcode.
                                 continue
                             else:
-                                # NOTE: already determined to have "Z"
-                                #   (See `continue` further up.)
-                                # NOTE: len(cmd_meta[z_index]) cannot be
-                                #   0 since it is obtained using split.
-                                setS("height",
-                                     Decimal(cmd_meta[z_index][1]),
-                                     line_number)
-                                # if self._verbose:
-                                #     echoP(
-                                #         "* INFO: Z is now {} due to"
-                                #         " {}".format(
-                                #             cmd_meta[z_index][1],
-                                #             cmd_meta
-                                #         )
-                                #     )
-                                last_height = getS("height")
-                                lvl = getS("level")
-                                h = getS("height")
-                                if next_l_h is None:
+                                echoP(
+                                    "Line {}: WARNING: Allowing"
+                                    " '{}' after stop (z"
+                                    " delta {})".format(
+                                        line_number,
+                                        line,
+                                        showParam(deltas.get("Z"), "Z")
+                                    )
+                                )
+                        addSec(command)
+                        outs.write(line + "\n")
+                        previous_dst_line = line  # It's just a
+                        #                         # movement, so
+                        #                         # don't edit it.
+                        #                         # Insert
+                        #                         # temperature
+                        #                         # after it if it
+                        #                         # is a new level
+                        #                         # (below).
+                        given_z = given_values.get("Z")
+                        z_index = part_indices.get("Z")
+                        if z_index is None:
+                            continue
+                        if len(cmd_meta[z_index]) == 1:
+                            setS("height", Decimal("0.00"),
+                                 line_number)
+                            last_height = getS("height")
+                            setL(0, line_number)
+                            # echoP("Line {}: Missing value after"
+                            #       " '{}'".format(
+                            #     line_number,
+                            #     cmd_meta[1][0])
+                            # )
+                            # continue
+                            # if len(cmd_meta[1]) == 1:  # already
+                            #                            # checked
+                            echoP("Line {}: INFO: Homing was"
+                                  " detected so"
+                                  " level & height were changed"
+                                  " to 0...")
+                            continue
+                        else:
+                            # NOTE: already determined to have "Z"
+                            #   (See `continue` further up.)
+                            # NOTE: len(cmd_meta[z_index]) cannot be
+                            #   0 since it is obtained using split.
+                            setS("height",
+                                 Decimal(cmd_meta[z_index][1]),
+                                 line_number)
+                            # if self._verbose:
+                            #     echoP(
+                            #         "* INFO: Z is now {} due to"
+                            #         " {}".format(
+                            #             cmd_meta[z_index][1],
+                            #             cmd_meta
+                            #         )
+                            #     )
+                            last_height = getS("height")
+                            lvl = getS("level")
+                            h = getS("height")
+                            if next_l_h is None:
+                                if not getS("stop_building"):
+                                    setS("stop_building", True,
+                                         line_number)
+                                    estHr, estMin, estLeft = (
+                                        getHMSFromS(self._estS)
+                                    )
+                                    self._estS
+                                    print("ESTIMATE: {}s"
+                                          "".format(self._estS))
+                                    self._extrudeS = self._estS
+                                    outs.stop(self)
+                                    print("ESTIMATE: {}h{}m{}s"
+                                          "".format(estHr,
+                                                    estMin,
+                                                    estLeft))
+                                    # self.addSec(original_line)
+                                    outs.write(
+                                        (self._stop_building_msg
+                                         + "\n")
+                                    )
+                                    if next_l_t is not None:
+                                        echoP(
+                                            "* Line {}: The tower"
+                                            " ends (there is no"
+                                            " level beyond {}) at"
+                                            " {} before the"
+                                            " temperature range, so"
+                                            " there will be no"
+                                            " temperature beyond {}"
+                                            .format(
+                                                line_number,
+                                                getL(),
+                                                h,
+                                                tmprs[getL()]
+                                            )
+                                        )
+                                    else:
+                                        echoP(
+                                            "* Line {}: The tower"
+                                            " ends (there is no"
+                                            " level beyond {}) at"
+                                            " {} nor another level"
+                                            " in the temperature"
+                                            " range, so there will"
+                                            " be no temperature"
+                                            " beyond {}"
+                                            .format(
+                                                line_number,
+                                                getL(),
+                                                h,
+                                                tmprs[getL()]
+                                            )
+                                        )
+                                    echoP("  (Future extrusion"
+                                          " will be"
+                                          " suppressed)")
+
+                                    continue
+                            elif h >= next_l_h:
+                                # This code can still be reached if
+                                # not would_extrude:
+                                if next_l_t is None:
                                     if not getS("stop_building"):
                                         setS("stop_building", True,
                                              line_number)
+                                        print("ESTIMATE: {}s"
+                                              "".format(self._estS))
+                                        self._extrudeS = (
+                                            self._estS
+                                        )
+                                        outs.stop(self)
                                         estHr, estMin, estLeft = (
                                             getHMSFromS(self._estS)
                                         )
-                                        self._estS
-                                        print("ESTIMATE: {}s"
-                                              "".format(self._estS))
-                                        self._extrudeS = self._estS
                                         print("ESTIMATE: {}h{}m{}s"
                                               "".format(estHr,
                                                         estMin,
@@ -1504,264 +2204,228 @@ class GCodeFollower:
                                             (self._stop_building_msg
                                              + "\n")
                                         )
-                                        if next_l_t is not None:
-                                            echoP(
-                                                "* Line {}: The tower"
-                                                " ends (there is no"
-                                                " level beyond {}) at"
-                                                " {} before the"
-                                                " temperature range, so"
-                                                " there will be no"
-                                                " temperature beyond {}"
-                                                .format(
-                                                    line_number,
-                                                    getL(),
-                                                    h,
-                                                    tmprs[getL()]
-                                                )
-                                            )
-                                        else:
-                                            echoP(
-                                                "* Line {}: The tower"
-                                                " ends (there is no"
-                                                " level beyond {}) at"
-                                                " {} nor another level"
-                                                " in the temperature"
-                                                " range, so there will"
-                                                " be no temperature"
-                                                " beyond {}"
-                                                .format(
-                                                    line_number,
-                                                    getL(),
-                                                    h,
-                                                    tmprs[getL()]
-                                                )
-                                            )
-                                        echoP("  (Future extrusion"
-                                              " will be"
-                                              " suppressed)")
-
-                                        continue
-                                elif h >= next_l_h:
-                                    # This code can still be reached if
-                                    # not would_extrude:
-                                    if next_l_t is None:
-                                        if not getS("stop_building"):
-                                            setS("stop_building", True,
-                                                 line_number)
-                                            print("ESTIMATE: {}s"
-                                                  "".format(self._estS))
-                                            self._extrudeS = (
-                                                self._estS
-                                            )
-                                            estHr, estMin, estLeft = (
-                                                getHMSFromS(self._estS)
-                                            )
-                                            print("ESTIMATE: {}h{}m{}s"
-                                                  "".format(estHr,
-                                                            estMin,
-                                                            estLeft))
-                                            # self.addSec(original_line)
-                                            outs.write(
-                                                (self._stop_building_msg
-                                                 + "\n")
-                                            )
-                                            echoP(
-                                                "* Line {}: The tower"
-                                                " will be truncated"
-                                                " since there is no new"
-                                                " temperature available"
-                                                " (no level beyond {})"
-                                                " at {}".format(
-                                                    line_number,
-                                                    getL(),
-                                                    h
-                                                )
-                                            )
-                                            echoP("  (Future extrusion"
-                                                  " will be"
-                                                  " suppressed)")
-                                        continue
-                                    if not start_temperature_found:
-                                        # setL("level", 0, line_number)
                                         echoP(
-                                            "Line {}: INFO: Splicing"
-                                            " temperature at {} will be"
-                                            " skipped since the old set"
-                                            " temp and wait ({}) wasn't"
-                                            " found yet (level is {}),"
-                                            " so this is z move is"
-                                            " presumably start"
-                                            " gcode.".format(
+                                            "* Line {}: The tower"
+                                            " will be truncated"
+                                            " since there is no new"
+                                            " temperature available"
+                                            " (no level beyond {})"
+                                            " at {}".format(
                                                 line_number,
-                                                h,
-                                                stw_cmd,
-                                                getL()
-                                            )
-                                        )
-                                    elif ((len(heights) > lvl + 2) and
-                                            (h > heights[lvl + 2])):
-                                        echoP(
-                                            "Line {}: WARNING: Splicing"
-                                            " temperature at height"
-                                            " {} will be skipped since"
-                                            " the height is greater"
-                                            " than the next level after"
-                                            " the one starting here"
-                                            " (since this may"
-                                            " be a wait or purge"
-                                            " position)".format(
-                                                line_number,
-                                                h,
+                                                getL(),
+                                                h
                                             )
                                         )
-                                    else:
-                                        # if lvl + 1 < len(tmprs):
-                                        # already checked (see this
-                                        # clause and the previous `if`
-                                        # clause).
-                                        modL(1, line_number)
-                                        if self._verbose:
-                                            echoP(
-                                                "Line {}: INFO: "
-                                                " **temperature** at"
-                                                " height {} will"
-                                                " become {} (for"
-                                                " level {})".format(
-                                                    line_number,
-                                                    h,
-                                                    tmprs[getL()],
-                                                    getL()
-                                                )
-                                            )
-                                        new_line = "{} {}{:.2f}".format(
+                                        echoP("  (Future extrusion"
+                                              " will be"
+                                              " suppressed)")
+                                    continue
+                                if not start_temperature_found:
+                                    # setL("level", 0, line_number)
+                                    echoP(
+                                        "Line {}: INFO: Splicing"
+                                        " temperature at {} will be"
+                                        " skipped since the old set"
+                                        " temp and wait ({}) wasn't"
+                                        " found yet (level is {}),"
+                                        " so this is z move is"
+                                        " presumably start"
+                                        " gcode.".format(
+                                            line_number,
+                                            h,
                                             stw_cmd,
-                                            stw_param0,
-                                            tmprs[getL()]
+                                            getL()
                                         )
-                                        # echoP(new_line)
-                                        self.addSec(new_line)
-                                        outs.write(new_line + "\n")
-                                        previous_dst_line = new_line
-                                        modS("new_line_count", 1,
-                                             line_number)
-                                        echoP(
-                                            "Line {}: Inserted:"
-                                            " {}".format(
-                                                line_number,
-                                                new_line
-                                            )
+                                    )
+                                elif ((len(heights) > lvl + 2) and
+                                        (h > heights[lvl + 2])):
+                                    echoP(
+                                        "Line {}: WARNING: Splicing"
+                                        " temperature at height"
+                                        " {} will be skipped since"
+                                        " the height is greater"
+                                        " than the next level after"
+                                        " the one starting here"
+                                        " (since this may"
+                                        " be a wait or purge"
+                                        " position)".format(
+                                            line_number,
+                                            h,
                                         )
-                                        echoP("- after"
-                                              " '{}'".format(line))
-                                        echoP("- new line #: {}".format(
-                                            (line_number
-                                             + getS("new_line_count"))
-                                        ))
+                                    )
                                 else:
+                                    # if lvl + 1 < len(tmprs):
+                                    # already checked (see this
+                                    # clause and the previous `if`
+                                    # clause).
+                                    modL(1, line_number)
                                     if self._verbose:
-                                        l_str = str(getL() + 1)
-                                        if dwfnh_shown.get(l_str) is not True:
-                                            # echoP(
-                                            #     "* INFO: The next"
-                                            #     " height (for level"
-                                            #     " {}) of {} has not"
-                                            #     " yet been reached"
-                                            #     " at {}.".format(
-                                            #         l_str,
-                                            #         next_l_h,
-                                            #         h
-                                            #     )
-                                            # )
-                                            dwfnh_shown[l_str] = True
-#
-                        else:  # some other G code
-                            if getS("stop_building"):
-                                if would_build:
-                                    continue
-                                else:
-                                    if code_number == 91:
                                         echoP(
-                                            "Line {}: INFO:"
-                                            " Allowing '{}'"
-                                            " after stop".format(
+                                            "Line {}: INFO: "
+                                            " **temperature** at"
+                                            " height {} will"
+                                            " become {} (for"
+                                            " level {})".format(
                                                 line_number,
-                                                line
+                                                h,
+                                                tmprs[getL()],
+                                                getL()
                                             )
                                         )
-                                    else:
-                                        echoP(
-                                            "Line {}: WARNING:"
-                                            " Allowing '{}'"
-                                            " after stop".format(
-                                                line_number, line
-                                            )
+                                    new_line = level_fmt.format(
+                                        tmprs[getL()]
+                                    )
+                                    # echoP(new_line)
+                                    addSec(new_line,
+                                           slot=(getL(), level_fmt))
+                                    outs.write_slot(new_line + "\n",
+                                                    getL(),
+                                                    level_fmt + "\n")
+                                    previous_dst_line = new_line
+                                    modS("new_line_count", 1,
+                                         line_number)
+                                    echoP(
+                                        "Line {}: Inserted:"
+                                        " {}".format(
+                                            line_number,
+                                            new_line
                                         )
-                            self.addSec(line)
-                            outs.write(line + "\n")
-                            previous_dst_line = line
-
-                    elif cmd_meta[0][0] == "M":
-                        if line[0:5] == stw_cmd + " ":
-                            # ^self.commands['set temperature and wait']
-                            #  (usually M109)
-                            # (extruder temperature)
-                            # d for decimal integer format (with no
-                            # decimals):
-                            new_line = "{} {}{:d}".format(stw_cmd,
-                                                          stw_param0,
-                                                          tmprs[getL()])
-                            if start_temperature_found:
-                                echoP("Line {}: Extra temperature"
-                                      " command at {}:"
-                                      " {}".format(line_number,
-                                                   getS("height"), line)
-                                      + "\n- changed to: " + new_line
-                                      + "...")
+                                    )
+                                    echoP("- after"
+                                          " '{}'".format(line))
+                                    echoP("- new line #: {}".format(
+                                        (line_number
+                                         + getS("new_line_count"))
+                                    ))
                             else:
-                                echoP(
-                                    "Line {}: Initial temperature"
-                                    " command at {}:"
-                                    " {}".format(line_number,
-                                                 getS("height"),
-                                                 line)
-                                    + "\n- changed to: " + new_line
-                                    + "..."
-                                )
-                            self.addSec(new_line)
-                            outs.write(new_line + "\n")
-                            previous_dst_line = line
-                            # if getL() == 0:
-                            #     if getL() + 1 < len(tmprs):
-                            #         modL(1, line_number)
-                            #         # echoP("Level {} is "
-                            #         #       "next.".format(
-                            #         #         getL())
-                            #         #       )
-                            start_temperature_found = True
-                        elif (getS("stop_building") and
-                                (code_number == cn['set fan speed'])):
-                            # Do not keep the fan speed line.
-                            continue
+                                if self._verbose:
+                                    l_str = str(getL() + 1)
+                                    if dwfnh_shown.get(l_str) is not True:
+                                        # echoP(
+                                        #     "* INFO: The next"
+                                        #     " height (for level"
+                                        #     " {}) of {} has not"
+                                        #     " yet been reached"
+                                        #     " at {}.".format(
+                                        #         l_str,
+                                        #         next_l_h,
+                                        #         h
+                                        #     )
+                                        # )
+                                        dwfnh_shown[l_str] = True
+#
+                    else:  # some other G code
+                        if getS("stop_building"):
+                            if would_build:
+                                continue
+                            else:
+                                if code_number == 91:
+                                    echoP(
+                                        "Line {}: INFO:"
+                                        " Allowing '{}'"
+                                        " after stop".format(
+                                            line_number,
+                                            line
+                                        )
+                                    )
+                                else:
+                                    echoP(
+                                        "Line {}: WARNING:"
+                                        " Allowing '{}'"
+                                        " after stop".format(
+                                            line_number, line
+                                        )
+                                    )
+                        addSec(command)
+                        outs.write(line + "\n")
+                        previous_dst_line = line
+
+                elif cmd_meta[0][0] == "M":
+                    if line[0:5] == stw_cmd + " ":
+                        # ^self.commands['set temperature and wait']
+                        #  (usually M109)
+                        # (extruder temperature)
+                        # d for decimal integer format (with no
+                        # decimals):
+                        new_line = start_fmt.format(tmprs[getL()])
+                        if start_temperature_found:
+                            echoP("Line {}: Extra temperature"
+                                  " command at {}:"
+                                  " {}".format(line_number,
+                                               getS("height"), line)
+                                  + "\n- changed to: " + new_line
+                                  + "...")
                         else:
-                            self.addSec(line)
-                            outs.write(line + "\n")
-                            previous_dst_line = line
+                            echoP(
+                                "Line {}: Initial temperature"
+                                " command at {}:"
+                                " {}".format(line_number,
+                                             getS("height"),
+                                             line)
+                                + "\n- changed to: " + new_line
+                                + "..."
+                            )
+                        addSec(new_line, slot=(getL(), start_fmt))
+                        outs.write_slot(new_line + "\n", getL(),
+                                        start_fmt + "\n")
+                        previous_dst_line = line
+                        # if getL() == 0:
+                        #     if getL() + 1 < len(tmprs):
+                        #         modL(1, line_number)
+                        #         # echoP("Level {} is "
+                        #         #       "next.".format(
+                        #         #         getL())
+                        #         #       )
+                        start_temperature_found = True
+                    elif (getS("stop_building") and
+                            (code_number == cn['set fan speed'])):
+                        # Do not keep the fan speed line.
+                        continue
                     else:
-                        self.addSec(line)
+                        addSec(command)
                         outs.write(line + "\n")
                         previous_dst_line = line
-                        pass
-                        # echoP("Unknown command:"
-                        #       " {}".format(cmd_meta[0][0]))
-        shutil.move(tmp_path, dst_path)
-        etaTimeStr = getHMSMessageFromS(self._estS)
-        extTimeStr = getHMSMessageFromS(self._extrudeS)
-        self.echo("100% (done; saved {};"
-                  " estimated print time: {} ({} extrusion))"
-                  "".format(dst_path, etaTimeStr, extTimeStr))
-        bytes_count = bytes_total
-        setS("progress", "100%", line_number)
+                else:
+                    addSec(command)
+                    outs.write(line + "\n")
+                    previous_dst_line = line
+                    pass
+                    # echoP("Unknown command:"
+                    #       " {}".format(cmd_meta[0][0]))
+        if fixed:
+            for name, raw in param_raws.items():
+                setS(name, Decimal(raw), param_lines[name])
+            if net_e is not None:
+                # Overwrite the total that setS("E", ...) may have added
+                #   to with the sum of every E before stop_building.
+                exact = not isinstance(net_e, Decimal)
+                net_e = from_fixed(net_e, FIXED_PLACES['E'])
+                if exact and (e_places < FIXED_PLACES['E']):
+                    # Match the Decimal sum's decimal places:
+                    net_e = net_e.quantize(Decimal(1).scaleb(-e_places))
+                setS("net_E_before_stop_building", net_e,
+                     param_lines.get("E"))
+        plan = outs.finish(self, getS("new_line_count"), line_number)
+        if plans is not None:
+            plans.set(len(tmprs), plan)
+            if cache:
+                save_tower_plans(template_gcode_path, plans)
+        # Only now write the output, copying the unchanged parts of the
+        # template directly (See TowerPlan.write_file):
+        diagnostics.line_number = None
+        if metrics is not None:
+            metrics.extra['diagnostics'] = diagnostics.to_dict()
+        diagnostics.report()
+        if metrics is not None:
+            metrics.lap("classify")
+            metrics.lines = line_number
+            metrics.bytes = bytes_total
+        plan.write_file(template_gcode_path, tmp_path, tmprs)
+        self._postProcessTower(tmp_path)
+        self._finishTower(tmp_path, dst_path, line_number)
+        if metrics is not None:
+            metrics.lap("write")
+            self._finishMetrics(dst_path)
 
         # @G1 Z16.40
         # +M104 S240
@@ -1771,9 +2435,70 @@ class GCodeFollower:
         # +M104 S250
         # @G1 Z57.04
         # +M104 S255
-        self.enableUI(True)
         return True
 
+    def _postProcessTower(self, path):
+        '''
+        Change the tower at path in one pass (See gcodepipeline) if
+        enabled:
+        - overlapHeating: Start the heaters early in the start G-code
+          and wait for them after homing (See gcodestart HeaterOverlap).
+        - preheatLevels: Set each level's temperature (M104) early
+          enough that the hotend is predicted to be ready when the level
+          starts, instead of waiting there (M109) unless the time before
+          it is too short (See gcodepipeline Preheat).
+        The estimated waiting time that was removed is subtracted from
+        the estimate.
+
+        Returns:
+        list: The stages that ran, with their counts and saved_seconds.
+        '''
+        stages = []
+        overlap = None
+        if self.overlapHeating:
+            overlap = HeaterOverlap(
+                GCodeFollower(echo_callback=lambda msg: None)
+            )
+            stages.append(overlap)
+        preheat = None
+        if self.preheatLevels:
+            preheat = Preheat(GCodeFollower(echo_callback=lambda msg: None))
+            stages.append(preheat)
+        if not stages:
+            return stages
+        stages_path = path + ".stages"
+        with open(stages_path, 'w') as outs:
+            run_pipeline(path, outs, stages)
+        shutil.move(stages_path, path)
+        for stage in stages:
+            self._estS -= stage.saved_seconds
+            if self._extrudeS is not None:
+                self._extrudeS -= stage.saved_seconds
+        if overlap is not None:
+            self.echo("* heating at the same time in the start G-code"
+                      " ({} wait(s) moved, {} heater(s) started early)"
+                      " saved about {}"
+                      "".format(overlap.moved_count,
+                                overlap.started_count,
+                                getHMSMessageFromS(overlap.saved_seconds)))
+        if preheat is not None:
+            self.echo("* preheating {} level(s) early saved about {} of"
+                      " waiting ({} still wait)"
+                      "".format(preheat.preheat_count,
+                                getHMSMessageFromS(preheat.saved_seconds),
+                                preheat.wait_count))
+        return stages
+
+    def _finishTower(self, tmp_path, dst_path, line_number):
+        shutil.move(tmp_path, dst_path)
+        etaTimeStr = getHMSMessageFromS(self._estS)
+        extTimeStr = getHMSMessageFromS(self._extrudeS)
+        self.echo("100% (done; saved {};"
+                  " estimated print time: {} ({} extrusion))"
+                  "".format(dst_path, etaTimeStr, extTimeStr))
+        self.setStat("progress", "100%", line_number)
+        self.enableUI(True)
+
 
 if __name__ == "__main__":
     print("This is a module. To use it, you must import it into your "
@@ -37,6 +37,11 @@ class GCodeFollowerArgParser():
         self.temperatures = None
         self.template_gcode_path = None
         self.help = False
+        self.metrics = False
+        self.workers = 1
+        self.variants = None
+        self.preheat = False
+        self.overlap_heating = False
         seqArgs = []
 
         for argI in range(1, len(sys.argv)):
@@ -50,6 +55,37 @@ class GCodeFollowerArgParser():
                 logger.setLevel(logging.DEBUG)
             elif arg == "--help":
                 self.help = True
+            elif arg == "--metrics":
+                # Save counters & timers as JSON after generateTower.
+                self.metrics = True
+            elif arg.startswith("--workers="):
+                # Parse the template in parallel (0 for one per CPU).
+                self.workers = int(arg[len("--workers="):])
+            elif arg == "--preheat":
+                # Heat for each level early instead of waiting.
+                self.preheat = True
+            elif arg == "--overlap-heating":
+                # Heat the bed & hotend at once in the start G-code.
+                self.overlap_heating = True
+            elif arg.startswith("--batch="):
+                # Make a tower for each range such as
+                # --batch=190-220,230-250/10 (See generateTowers, which
+                # parses the template once for each different number of
+                # temperatures, so twice in this example).
+                self.variants = []
+                for part in arg[len("--batch="):].split(","):
+                    variant = {}
+                    if "/" in part:
+                        part, step = part.split("/")
+                        variant['temperature_step'] = int(step)
+                    variant['temperature'] = [
+                        int(value) for value in part.split("-")
+                    ]
+                    if len(variant['temperature']) != 2:
+                        raise ValueError("The range {} in {} should be"
+                                         " like MIN-MAX or MIN-MAX/STEP."
+                                         "".format(part, arg))
+                    self.variants.append(variant)
             elif arg.startswith("--"):
                 raise ValueError("The argument {} is invalid."
                                  "".format(arg))
@@ -62,6 +98,8 @@ class GCodeFollowerArgParser():
             self.temperatures = [seqArgs[1], seqArgs[2]]
         elif len(seqArgs) == 2:
             self.temperatures = [seqArgs[0], seqArgs[1]]
+        if (self.temperatures is None) and self.variants:
+            self.temperatures = self.variants[0]['temperature']
         if len(seqArgs) > 3:
             usage()
             raise ValueError("Error: There were too many arguments.")
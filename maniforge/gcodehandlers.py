@@ -0,0 +1,195 @@
+'''
+gcodehandlers
+-------------
+part of maniforge by Poikilos
+
+Map each G-code command to the callable that emulates it (such as for
+GCodeFollower.addSec), so that choosing the handler is one dict lookup
+and a command (or a macro) can be added without editing or subclassing
+the follower.
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import time
+
+if sys.version_info.major >= 3:
+    from sys import intern
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:
+    # Python 2
+    perf_counter = time.time
+
+
+class CommandHandler(object):
+    '''
+    A registered handler and how much it has been used.
+
+    Public attributes:
+    name -- The command (or prefix) it was registered for.
+    handler -- The callable, called as handler(follower, meta) where
+        meta is a maniforge.mfgcode.ParsedCommand.
+    calls -- How many commands it has handled.
+    seconds -- The total time it took (wall time).
+    '''
+    __slots__ = ('name', 'handler', 'calls', 'seconds')
+
+    def __init__(self, name, handler):
+        self.name = name
+        self.handler = handler
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ("CommandHandler({}, {}, calls={}, seconds={})"
+                "".format(repr(self.name), self.handler, self.calls,
+                          self.seconds))
+
+
+class CommandRegistry(object):
+    '''
+    Command handlers keyed by command (such as "G1", "M104" or a macro
+    such as "TIMELAPSE_TAKE_FRAME"). Keys are interned, and a command
+    handled by a prefix (See register_prefix) is added to the dict the
+    first time, so dispatch is one lookup either way.
+
+    Public attributes:
+    timed -- Add the time of each call to the handler's seconds (If
+        False, only calls are counted).
+    '''
+    def __init__(self, timed=True):
+        self.timed = timed
+        self._handlers = {}
+        self._prefixes = []  # CommandHandler objects for prefixes
+        self._resolved = set()  # Commands added for a prefix
+
+    def register(self, function, handler):
+        '''
+        Set the handler for a command (replacing any previous one).
+
+        Sequential arguments:
+        function -- The command, such as "G2" or "SET_VELOCITY_LIMIT".
+        handler -- A callable called as handler(follower, meta), where
+            meta is a maniforge.mfgcode.ParsedCommand.
+        '''
+        self._forget_resolved()
+        key = intern(str(function))
+        self._handlers[key] = CommandHandler(key, handler)
+
+    def register_prefix(self, prefix, handler):
+        '''
+        Set the handler for any command starting with prefix (such as
+        "T" for tool changes) that doesn't have its own handler.
+        '''
+        self._forget_resolved()
+        self._prefixes = [entry for entry in self._prefixes
+                          if entry.name != prefix]
+        self._prefixes.append(CommandHandler(prefix, handler))
+
+    def unregister(self, function):
+        '''
+        Remove the handler for a command or prefix (if any).
+        '''
+        self._forget_resolved()
+        self._handlers.pop(function, None)
+        self._prefixes = [entry for entry in self._prefixes
+                          if entry.name != function]
+
+    def _forget_resolved(self):
+        for function in self._resolved:
+            del self._handlers[function]
+        self._resolved.clear()
+
+    def resolve(self, function):
+        '''
+        Get the CommandHandler for a command (None if there is none).
+        '''
+        entry = self._handlers.get(function)
+        if entry is not None:
+            return entry
+        if function is None:
+            return None
+        for entry in self._prefixes:
+            if function.startswith(entry.name):
+                key = intern(function)
+                self._handlers[key] = entry
+                self._resolved.add(key)
+                return entry
+        return None
+
+    def dispatch(self, follower, meta):
+        '''
+        Call the handler for a command.
+
+        Sequential arguments:
+        follower -- The object passed to the handler (such as a
+            GCodeFollower).
+        meta -- A maniforge.mfgcode.ParsedCommand.
+
+        Returns:
+        bool: False if there is no handler for the command.
+        '''
+        entry = self._handlers.get(meta.function)
+        if entry is None:
+            entry = self.resolve(meta.function)
+            if entry is None:
+                return False
+        if self.timed:
+            start = perf_counter()
+            entry.handler(follower, meta)
+            entry.seconds += perf_counter() - start
+        else:
+            entry.handler(follower, meta)
+        entry.calls += 1
+        return True
+
+    def add_calls(self, function, calls):
+        '''
+        Count calls to the handler of a command that were emulated
+        another way (such as by maniforge.gcodeparallel).
+        '''
+        entry = self.resolve(function)
+        if entry is not None:
+            entry.calls += calls
+
+    def handlers(self):
+        '''
+        Get the registered handlers as (commands, prefixes) where each
+        is a dict of name: handler (without the commands that were
+        added for a prefix), such as to compare two registries.
+        '''
+        commands = {function: entry.handler
+                    for function, entry in self._handlers.items()
+                    if function not in self._resolved}
+        prefixes = {entry.name: entry.handler for entry in self._prefixes}
+        return commands, prefixes
+
+    def __contains__(self, function):
+        return self.resolve(function) is not None
+
+    def get_stats(self):
+        '''
+        Get how much each handler was used.
+
+        Returns:
+        dict: (calls, seconds) for each registered command or prefix.
+        '''
+        results = {}
+        for name, entry in self._handlers.items():
+            if name in self._resolved:
+                continue
+            results[name] = (entry.calls, entry.seconds)
+        for entry in self._prefixes:
+            results[entry.name] = (entry.calls, entry.seconds)
+        return results
+
+    def clear_stats(self):
+        for entry in self._handlers.values():
+            entry.calls = 0
+            entry.seconds = 0.0
+        for entry in self._prefixes:
+            entry.calls = 0
+            entry.seconds = 0.0
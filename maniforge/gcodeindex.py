@@ -0,0 +1,367 @@
+'''
+gcodeindex
+----------
+part of maniforge by Poikilos
+
+Find where each layer of a G-code file starts and keep that in a
+sidecar file next to the G-code file, so that finding a layer (or a
+height) doesn't require reading the whole file again.
+
+This is a standalone utility: Nothing else in maniforge builds or reads
+a LayerIndex (gcodeplan only uses stat_mtime_ns and file_sha1 to check
+its own sidecar file). For example, to start reading at a height:
+    index = get_layer_index(path)
+    layer = index.layer_at_height(2.0)
+    if layer is not None:
+        for offset, line in iter_mapped_lines(path, start=layer[0]):
+            ...
+'''
+from __future__ import print_function
+from __future__ import division
+
+from bisect import bisect_left
+import hashlib
+import json
+import os
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodediagnostics import (
+    ERROR,
+    get_default_diagnostics,
+)
+from maniforge.mfgcode import (
+    get_cmd_tuples_bytes,
+    iter_mapped_lines,
+)
+
+logger = getLogger(__name__)
+
+# Comments that slicers put before each layer:
+# - ";LAYER_CHANGE" (PrusaSlicer & SuperSlicer)
+# - ";LAYER:<n>" (Cura)
+LAYER_MARKERS = (b";LAYER_CHANGE", b";LAYER:")
+
+
+def layer_index_path(path):
+    '''
+    Get the path of the sidecar file where the LayerIndex of a G-code
+    file is saved.
+    '''
+    return path + ".layers.json"
+
+
+class LayerIndex(object):
+    '''
+    The start of each layer in a G-code file.
+
+    Public attributes:
+    offsets -- The byte offset of the line where each layer starts (The
+        layer marker comment if the slicer adds them, otherwise the Z
+        move that goes to the layer).
+    line_numbers -- The line number (counting from 1) of each offset.
+    heights -- The Z height of each layer.
+    extruded -- The cumulative (net) length of filament extruded before
+        each layer, regardless of the M82/M83 mode.
+    source -- "marker" if layers are from slicer comments (See
+        LAYER_MARKERS) or "z" if from Z moves followed by extrusion.
+    size, mtime_ns, sha1 -- The file this is for (See is_current).
+    '''
+    VERSION = 1
+
+    def __init__(self, offsets=None, line_numbers=None, heights=None,
+                 extruded=None, source=None, size=None, mtime_ns=None,
+                 sha1=None):
+        self.offsets = offsets if offsets is not None else []
+        self.line_numbers = (line_numbers if line_numbers is not None
+                             else [])
+        self.heights = heights if heights is not None else []
+        self.extruded = extruded if extruded is not None else []
+        self.source = source
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha1 = sha1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def to_dict(self):
+        return {
+            'version': LayerIndex.VERSION,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'sha1': self.sha1,
+            'source': self.source,
+            'offsets': self.offsets,
+            'line_numbers': self.line_numbers,
+            'heights': self.heights,
+            'extruded': self.extruded,
+        }
+
+    @staticmethod
+    def from_dict(meta):
+        if meta.get('version') != LayerIndex.VERSION:
+            return None
+        return LayerIndex(
+            offsets=meta['offsets'],
+            line_numbers=meta['line_numbers'],
+            heights=meta['heights'],
+            extruded=meta['extruded'],
+            source=meta.get('source'),
+            size=meta.get('size'),
+            mtime_ns=meta.get('mtime_ns'),
+            sha1=meta.get('sha1'),
+        )
+
+    def is_current(self, path):
+        '''
+        Check whether the index is for the current version of the file
+        at path. The size and modified time are checked first, then the
+        content hash if only the time differs (such as if the file was
+        copied). If the hash matches, mtime_ns is updated.
+        '''
+        stat = os.stat(path)
+        if stat.st_size != self.size:
+            return False
+        if stat_mtime_ns(stat) == self.mtime_ns:
+            return True
+        if self.sha1 is None:
+            return False
+        if file_sha1(path) != self.sha1:
+            return False
+        self.mtime_ns = stat_mtime_ns(stat)
+        return True
+
+    def find_height(self, height):
+        '''
+        Get the index of the first layer that is at least at height (or
+        len(self) if there is no such layer).
+        '''
+        return bisect_left(self.heights, float(height))
+
+    def layer_at_height(self, height):
+        '''
+        Get (offset, line_number, height, extruded) for the first layer
+        that is at least at height, or None if there is no such layer.
+        '''
+        i = self.find_height(height)
+        if i >= len(self):
+            return None
+        return self.layer(i)
+
+    def layer(self, i):
+        '''
+        Get (offset, line_number, height, extruded) for layer i.
+        '''
+        return (self.offsets[i], self.line_numbers[i], self.heights[i],
+                self.extruded[i])
+
+
+def stat_mtime_ns(stat):
+    '''
+    Get the modified time of an os.stat result in nanoseconds.
+    '''
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        # Python 2
+        mtime_ns = int(stat.st_mtime * 1000000000)
+    return mtime_ns
+
+
+def file_sha1(path):
+    '''
+    Get the SHA-1 hex digest of the content of the file at path.
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as ins:
+        while True:
+            chunk = ins.read(1 << 20)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_layer_index(path, diagnostics=None):
+    '''
+    Read the whole G-code file and find the start of each layer (See
+    LayerIndex). If the file has slicer layer markers, each marker
+    starts a layer (at the height of the first Z move after it).
+    Otherwise, a layer starts at a Z move to a height above the previous
+    layer where extrusion occurs (so a Z hop is not a layer). A move
+    with a Z or E that is not a number is skipped.
+
+    Keyword arguments:
+    diagnostics -- Where to report problems (See
+        maniforge.gcodediagnostics; default: get_default_diagnostics()).
+    '''
+    if diagnostics is None:
+        diagnostics = get_default_diagnostics()
+    digest = hashlib.sha1()
+    marker_layers = []  # [offset, line_number, z, extruded] lists
+    z_layers = []
+    absolute = True
+    e_absolute = True
+    z = 0.0
+    e = 0.0
+    extruded = 0.0
+    z_move = None  # [offset, line_number, z, extruded] of last Z move
+    layer_z = None  # The height of the last layer that extruded
+    waiting_marker = None  # A marker that needs the height of its layer
+    line_number = 0
+    for offset, line in iter_mapped_lines(path):
+        digest.update(line)
+        line_number += 1
+        if line[:1] == b";":
+            if line.startswith(LAYER_MARKERS):
+                waiting_marker = [offset, line_number, z, extruded]
+                marker_layers.append(waiting_marker)
+            continue
+        cmd_meta = get_cmd_tuples_bytes(line)
+        if cmd_meta is None:
+            continue
+        function = b"".join(cmd_meta[0])
+        if function in (b"G0", b"G1", b"G92"):
+            new_z = None
+            new_e = None
+            has_xy = False
+            try:
+                for pair in cmd_meta[1:]:
+                    if len(pair) < 2:
+                        continue
+                    key = pair[0]
+                    if key == b"Z":
+                        new_z = float(pair[1])
+                    elif key == b"E":
+                        new_e = float(pair[1])
+                    elif key in (b"X", b"Y"):
+                        has_xy = True
+            except ValueError:
+                diagnostics.add(
+                    "not_a_number",
+                    '"{}" is not a number in "{}"'.format(
+                        pair[1].decode("utf-8", "replace"),
+                        line.rstrip().decode("utf-8", "replace"),
+                    ),
+                    line_number=line_number,
+                    level=ERROR,
+                )
+                continue
+            if function == b"G92":
+                if new_z is not None:
+                    z = new_z
+                if new_e is not None:
+                    e = new_e
+                continue
+            if new_z is not None:
+                if not absolute:
+                    new_z += z
+                if new_z != z:
+                    z = new_z
+                    z_move = [offset, line_number, z, extruded]
+                    if waiting_marker is not None:
+                        waiting_marker[2] = z
+                        waiting_marker = None
+            if new_e is not None:
+                if e_absolute:
+                    delta = new_e - e
+                    e = new_e
+                else:
+                    delta = new_e
+                extruded += delta
+                if (delta > 0) and has_xy:
+                    if (layer_z is None) or (z > layer_z):
+                        layer_z = z
+                        if z_move is not None:
+                            z_layers.append(z_move)
+                        else:
+                            z_layers.append([offset, line_number, z,
+                                             extruded - delta])
+        elif function == b"G90":
+            absolute = True
+            e_absolute = True
+        elif function == b"G91":
+            absolute = False
+            e_absolute = False
+        elif function == b"M82":
+            e_absolute = True
+        elif function == b"M83":
+            e_absolute = False
+    source = "marker" if marker_layers else "z"
+    layers = marker_layers if marker_layers else z_layers
+    stat = os.stat(path)
+    return LayerIndex(
+        offsets=[layer[0] for layer in layers],
+        line_numbers=[layer[1] for layer in layers],
+        heights=[layer[2] for layer in layers],
+        extruded=[layer[3] for layer in layers],
+        source=source,
+        size=stat.st_size,
+        mtime_ns=stat_mtime_ns(stat),
+        sha1=digest.hexdigest(),
+    )
+
+
+def load_layer_index(path):
+    '''
+    Load the saved LayerIndex of a G-code file, or get None if there is
+    none or it is not for the current version of the file.
+    '''
+    index_path = layer_index_path(path)
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with open(index_path, 'r') as ins:
+            index = LayerIndex.from_dict(json.load(ins))
+    except (ValueError, KeyError) as ex:
+        logger.warning('WARNING: "{}" will be rebuilt since it is not'
+                       ' readable: {}'.format(index_path, ex))
+        return None
+    if index is None:
+        return None
+    mtime_ns = index.mtime_ns
+    if not index.is_current(path):
+        return None
+    if index.mtime_ns != mtime_ns:
+        save_layer_index(path, index)
+    return index
+
+
+def save_layer_index(path, index):
+    '''
+    Save the LayerIndex of the G-code file at path next to it (See
+    layer_index_path). If that is not possible (such as if the
+    directory is read-only), only log a warning.
+    '''
+    index_path = layer_index_path(path)
+    try:
+        with open(index_path, 'w') as outs:
+            json.dump(index.to_dict(), outs)
+    except (IOError, OSError) as ex:
+        logger.warning('WARNING: The layer index could not be saved to'
+                       ' "{}": {}'.format(index_path, ex))
+        return False
+    return True
+
+
+def get_layer_index(path, rebuild=False, diagnostics=None):
+    '''
+    Get the LayerIndex for a G-code file, building (and saving) it only
+    if the saved one is missing or outdated.
+
+    Keyword arguments:
+    rebuild -- Build it even if the saved one is current.
+    diagnostics -- See build_layer_index.
+    '''
+    index = None
+    if not rebuild:
+        index = load_layer_index(path)
+    if index is None:
+        index = build_layer_index(path, diagnostics=diagnostics)
+        save_layer_index(path, index)
+    return index
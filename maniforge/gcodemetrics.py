@@ -0,0 +1,143 @@
+'''
+gcodemetrics
+------------
+part of maniforge by Poikilos
+
+Count commands and time the stages of processing a G-code file (such
+as GCodeFollower.generateTower) so that throughput can be compared
+between versions. Nothing is collected unless a GCodeMetrics object is
+used (The hot paths only check whether it is None).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import json
+import sys
+import time
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+try:
+    perf_counter = time.perf_counter
+except AttributeError:
+    # Python 2
+    perf_counter = time.time
+
+logger = getLogger(__name__)
+
+
+class GCodeMetrics(object):
+    '''
+    Counters, stage timers and throughput gauges for one run.
+
+    Stages are timed as laps (See lap): The time since the previous lap
+    is added to the named stage, so calling lap at the boundary of each
+    stage accounts for all of the time without nesting timers.
+
+    Public attributes:
+    counters -- How many times each command (such as "G1") occurred.
+    stage_seconds -- The seconds spent in each stage (See STAGES).
+    lines -- How many lines were read.
+    bytes -- How many bytes were read.
+    extra -- Other values to include in to_dict (such as handler
+        stats).
+    '''
+    VERSION = 1
+    STAGES = ("read", "parse", "classify", "estimate", "write")
+
+    def __init__(self):
+        self.counters = {}
+        self.stage_seconds = {}
+        for stage in GCodeMetrics.STAGES:
+            self.stage_seconds[stage] = 0.0
+        self.lines = 0
+        self.bytes = 0
+        self.extra = {}
+        self.started = perf_counter()
+        self.stopped = None
+        self._lap_start = self.started
+
+    def count(self, function):
+        '''
+        Count a command (such as meta.function of a ParsedCommand).
+        '''
+        counters = self.counters
+        counters[function] = counters.get(function, 0) + 1
+
+    def lap(self, stage):
+        '''
+        Add the time since the previous lap (or since the start) to the
+        stage.
+        '''
+        now = perf_counter()
+        self.stage_seconds[stage] = (self.stage_seconds.get(stage, 0.0)
+                                     + now - self._lap_start)
+        self._lap_start = now
+
+    def iter_timed(self, iterable, stage, previous_stage):
+        '''
+        Yield each item of iterable, timing the wait for each item as
+        stage and the time before asking for the next as
+        previous_stage (such as "read" and "classify" for the lines of
+        a file).
+        '''
+        iterator = iter(iterable)
+        while True:
+            self.lap(previous_stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.lap(stage)
+                return
+            self.lap(stage)
+            yield item
+
+    def stop(self):
+        '''
+        Stop the total time (The gauges are based on it).
+        '''
+        self.stopped = perf_counter()
+
+    def get_seconds(self):
+        stopped = self.stopped
+        if stopped is None:
+            stopped = perf_counter()
+        return stopped - self.started
+
+    def to_dict(self):
+        seconds = self.get_seconds()
+        lines_per_sec = None
+        bytes_per_sec = None
+        if seconds > 0:
+            lines_per_sec = self.lines / seconds
+            bytes_per_sec = self.bytes / seconds
+        results = {
+            'version': GCodeMetrics.VERSION,
+            'seconds': seconds,
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'lines_per_sec': lines_per_sec,
+            'bytes_per_sec': bytes_per_sec,
+            'stage_seconds': self.stage_seconds,
+            'counters': self.counters,
+        }
+        results.update(self.extra)
+        return results
+
+    def dump(self, path):
+        '''
+        Save the metrics (See to_dict) as JSON. If that is not possible
+        (such as if the directory is read-only), only log a warning.
+        '''
+        try:
+            with open(path, 'w') as outs:
+                json.dump(self.to_dict(), outs, indent=2, sort_keys=True)
+        except (IOError, OSError) as ex:
+            logger.warning('WARNING: The metrics could not be saved to'
+                           ' "{}": {}'.format(path, ex))
+            return False
+        return True
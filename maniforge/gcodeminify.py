@@ -0,0 +1,312 @@
+'''
+gcodeminify
+-----------
+part of maniforge by Poikilos
+
+Make G-code smaller without changing what the printer does, such as
+for faster copying to an SD card (or a TFT) and less data over a serial
+connection. The Minifier stage (See gcodepipeline) removes what is
+already in effect (See RULES):
+- F that is already the feed rate.
+- M106 that sets the fan to the speed it already has (and M107 if it is
+  already off).
+- G90, G91, M82 and M83 if already in that mode.
+- X, Y, Z and E in G0 and G1 that don't change the position, then a
+  move with nothing left (a zero-length move).
+- Comments, blank lines and extra whitespace.
+
+The state is the same as a GCodeFollower emulates (position, positioning
+modes, feed rate and fans), but from every command (See MoveState),
+since the emulator only moves for a command with F. Anything else (a
+tool change, homing, a Klipper-style macro or another command that is
+not known not to move) makes the position and feed rate unknown, so
+nothing that depends on them is removed until they are set again. The
+modes are unknown until set (in a way that is the same in Marlin and
+Klipper).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodepipeline import (
+    MODE_FUNCTIONS,
+    MOVE_FUNCTIONS,
+    MoveState,
+    is_tool_change,
+)
+from maniforge.mfgcode import (
+    ParsedCommand,
+    meta_to_cmd,
+)
+
+logger = getLogger(__name__)
+
+# The name of each rule in the order they are applied (See Minifier):
+RULES = (
+    "comments",  # Comments (and whitespace before them)
+    "blank_lines",
+    "whitespace",  # Extra spaces between or around parameters
+    "modal_F",  # F that is already the feed rate
+    "fan",  # M106 or M107 that doesn't change the fan
+    "modes",  # G90, G91, M82 or M83 that is already in effect
+    "unchanged_axes",  # X, Y, Z or E that is already the position
+    "zero_length",  # G0 or G1 with nothing left
+)
+
+
+class Minifier(object):
+    '''
+    Remove what doesn't change the printer's state (See RULES).
+
+    Keyword arguments:
+    keep_comments -- Keep comment lines that start with any of these
+        (without ";"), such as ("LAYER:",) for a display that counts
+        layers from comments.
+    rules -- The names of the rules to apply (default: RULES).
+
+    Public attributes:
+    saved_bytes -- The bytes removed by each rule (including newlines
+        of removed lines).
+    removed_lines -- How many lines each rule removed.
+    input_count, output_count -- How many lines were read and written.
+    input_bytes, output_bytes -- The size of the lines read and written
+        (including newlines).
+    '''
+    def __init__(self, keep_comments=(), rules=None):
+        self.keep_comments = tuple(keep_comments)
+        self.rules = RULES if rules is None else tuple(rules)
+        for rule in self.rules:
+            if rule not in RULES:
+                raise ValueError("{} is not one of {}"
+                                 "".format(repr(rule), RULES))
+        self.saved_bytes = dict((rule, 0) for rule in RULES)
+        self.removed_lines = dict((rule, 0) for rule in RULES)
+        self.input_count = 0
+        self.output_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._state = MoveState()
+        self._feed_rate = None
+        self._fans = {}
+
+    def _save(self, rule, old_line, new_line):
+        # Count the bytes removed by rule (None for a removed line).
+        if new_line is None:
+            self.saved_bytes[rule] += len(old_line) + 1
+            self.removed_lines[rule] += 1
+        else:
+            self.saved_bytes[rule] += len(old_line) - len(new_line)
+
+    def __call__(self, commands):
+        for command in commands:
+            self.input_count += 1
+            self.input_bytes += len(command.line) + 1
+            result = self.minify(command)
+            self._update(command)
+            if result is None:
+                continue
+            self.output_count += 1
+            self.output_bytes += len(result.line) + 1
+            yield result
+
+    def minify(self, command):
+        '''
+        Get the smallest command that does the same as command in the
+        current state, or None to remove it (This doesn't update the
+        state, See __call__).
+        '''
+        rules = self.rules
+        line = command.line
+        if command.pairs is None:
+            # A blank line or only a comment:
+            comment = line.strip()
+            if not comment:
+                if "blank_lines" in rules:
+                    self._save("blank_lines", line, None)
+                    return None
+                return command
+            if "comments" not in rules:
+                return command
+            if comment[1:].lstrip().startswith(self.keep_comments):
+                return command
+            self._save("comments", line, None)
+            return None
+        if ("comments" in rules) and (command.comment_start >= 0):
+            code = line[:command.comment_start].rstrip()
+            self._save("comments", line, code)
+            line = code
+        if "whitespace" in rules:
+            if command.is_macro() or (command.function == "M117"):
+                code = line.strip()  # A message may have spaces.
+            else:
+                code = " ".join(line.split())
+            self._save("whitespace", line, code)
+            line = code
+        pairs = list(command.pairs)
+        if [pair for pair in pairs if len(pair) != 2] or \
+                (command.function == "M117"):
+            # Keep a macro or a parameter without a value as it is.
+            return self._result(command, line)
+        function = command.function
+        if function in MOVE_FUNCTIONS + ("G2", "G3"):
+            if "modal_F" in rules:
+                pairs = self._drop(pairs, line, "modal_F",
+                                   self._is_modal_F)
+        if function in ("M106", "M107"):
+            speed = self._fan_speed(command)
+            if ("fan" in rules) and (speed is not None) and \
+                    (speed == self._fans.get(self._fan(command))):
+                self._save("fan", line, None)
+                return None
+        if function in MODE_FUNCTIONS:
+            if ("modes" in rules) and self._is_mode(function):
+                self._save("modes", line, None)
+                return None
+        if function in MOVE_FUNCTIONS:
+            if "unchanged_axes" in rules:
+                pairs = self._drop(pairs, meta_to_cmd(pairs),
+                                   "unchanged_axes", self._is_unchanged)
+            if ("zero_length" in rules) and (len(pairs) == 1):
+                self._save("zero_length", meta_to_cmd(pairs), None)
+                return None
+        if len(pairs) != len(command.pairs):
+            line = meta_to_cmd(pairs)
+        return self._result(command, line)
+
+    @staticmethod
+    def _result(command, line):
+        if line == command.line:
+            return command
+        return ParsedCommand(line)
+
+    def _drop(self, pairs, line, rule, is_redundant):
+        # Remove each parameter where is_redundant(key, value).
+        kept = [pairs[0]] + [pair for pair in pairs[1:]
+                             if not is_redundant(pair[0], pair[1])]
+        if len(kept) != len(pairs):
+            self._save(rule, line, meta_to_cmd(kept))
+        return kept
+
+    def _is_modal_F(self, key, value):
+        if key != 'F':
+            return False
+        try:
+            return float(value) == self._feed_rate
+        except ValueError:
+            return False
+
+    def _is_unchanged(self, key, value):
+        state = self._state
+        try:
+            value = float(value)
+        except ValueError:
+            return False
+        if key in ('X', 'Y', 'Z'):
+            if not state.xy_mode_known:
+                return False
+            if state.xy_relative:
+                return value == 0
+            return value == state.position[('X', 'Y', 'Z').index(key)]
+        if key == 'E':
+            if not state.e_mode_known:
+                return False
+            if state.e_relative:
+                return value == 0
+            return value == state.e_position
+        return False
+
+    def _is_mode(self, function):
+        # Check whether function is already in effect in both Marlin and
+        # Klipper (An M82 or M83 also has to be the last of the two,
+        # since Klipper keeps it after G90 or G91, See MoveState m83).
+        state = self._state
+        if not state.e_mode_known:
+            return False
+        if function in ("M82", "M83"):
+            if not state.m83_known or \
+                    (state.m83 != (function == "M83")):
+                return False
+            if function == "M83":
+                return state.e_relative
+        if not state.xy_mode_known:
+            return False
+        if function == "G91":
+            return state.xy_relative and state.e_relative
+        return not (state.xy_relative or state.e_relative)
+        # ^ G90, or M82 (which doesn't affect E after G91 in Klipper)
+
+    @staticmethod
+    def _fan(command):
+        # Get the P of a fan command (None for the fan of the current
+        # tool, which is a different fan for each tool in Marlin if each
+        # extruder has one).
+        return command.get('P')
+
+    @staticmethod
+    def _fan_speed(command):
+        if command.function == "M107":
+            return 0.0
+        try:
+            speed = command.get_float('S')
+        except ValueError:
+            return None
+        return 255.0 if speed is None else speed
+
+    def _update(self, command):
+        # Track the state after the original command (which does the
+        # same as its result).
+        function = command.function
+        if function is None:
+            return
+        state = self._state
+        if function in ("M106", "M107"):
+            fan = self._fan(command)
+            if fan is None:
+                self._fans = {}  # It may be any of them.
+            else:
+                self._fans.pop(None, None)  # It may be this one.
+            self._fans[fan] = self._fan_speed(command)
+            return
+        if function in MOVE_FUNCTIONS + ("G2", "G3"):
+            try:
+                F = command.get_float('F')
+            except ValueError:
+                F = None
+                self._feed_rate = None
+            if F is not None:
+                self._feed_rate = F
+        elif state.forget(command):
+            # It may move (such as G28 or a tool change).
+            self._feed_rate = None
+            if command.is_macro():
+                self._fans = {}
+            elif is_tool_change(command):
+                self._fans.pop(None, None)  # The tool has another fan.
+            return
+        state.update(command)
+        if function not in MODE_FUNCTIONS + ("G92",):
+            if not state.xy_mode_known:
+                state.position = [None, None, None]
+            if not state.e_mode_known:
+                state.e_position = None
+
+    def report(self):
+        '''
+        Get a line for each rule that saved bytes, such as
+        "comments: 1024 bytes (12 lines removed)".
+        '''
+        lines = []
+        for rule in RULES:
+            if not self.saved_bytes[rule]:
+                continue
+            lines.append("{}: {} bytes ({} lines removed)".format(
+                rule, self.saved_bytes[rule], self.removed_lines[rule],
+            ))
+        return lines
@@ -0,0 +1,796 @@
+'''
+gcodeparallel
+-------------
+part of maniforge by Poikilos
+
+Parse and classify a large G-code template in several processes (See
+iter_scanned_lines) so that GCodeFollower._generateTower only has to
+handle the lines that depend on the state of the tower (such as Z moves
+and temperature commands) one at a time.
+
+The template is split into chunks at newline boundaries, and each chunk
+is scanned by itself (See scan_chunk): Consecutive lines that would only
+be copied to the output and estimated are summarized as a LineRun. A
+run only records the state that its own lines set (such as the position
+or the feed rate), so merging the runs in order is a prefix scan: The
+state after each run is the state before it with the run's changes on
+top (See apply_line_run).
+'''
+from __future__ import print_function
+from __future__ import division
+
+from collections import OrderedDict
+import decimal
+import math
+import multiprocessing
+import re
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodediagnostics import (
+    ERROR,
+    WARNING,
+)
+from maniforge.gcodeplan import (
+    add_segment,
+    is_temperature_command,
+    line_segment,
+)
+from maniforge.mfgcode import (
+    DEFAULT_FIXED_PLACES,
+    FIXED_PLACES,
+    ParsedCommand,
+    map_gcode_file,
+    to_fixed,
+)
+
+logger = getLogger(__name__)
+
+# Each chunk is about the size of the template divided by this many
+# chunks per process (so a slow chunk doesn't leave the others idle),
+# but at least MIN_CHUNK_SIZE and at most MAX_CHUNK_SIZE bytes:
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 1 << 24
+
+# The kinds of emulation that scan_chunk can do without the state of
+# the caller (See ScanOptions.local_functions):
+LOCAL_KINDS = ("move", "absolute", "relative", "e_absolute", "e_relative",
+               "dwell", "nothing")
+
+# A command that sets the positioning mode or the extruder mode at the
+# start of a line (See chunk_modes):
+_MODE_PATTERN = re.compile(br'^[ \t]*(G9[01]|M8[23])(?![0-9.])',
+                           re.MULTILINE)
+
+
+class ScanOptions(object):
+    '''
+    The settings of the caller that scan_chunk needs (It is passed to
+    each process).
+
+    Public attributes:
+    local_functions -- A dict where each key is a function (such as
+        "G1") that can be emulated without the caller's state, and the
+        value is how (See LOCAL_KINDS): "move" like
+        GCodeFollower._emulateMove, "absolute" or "relative" (G90 or
+        G91), "e_absolute" or "e_relative" (M82 or M83), "dwell" like
+        GCodeFollower._emulateDwell, or "nothing".
+    position_mode -- The positioning mode ("absolute" or "relative") to
+        assume at the start of each chunk (See ChunkScan).
+    e_position_mode -- The extruder mode to assume at the start of each
+        chunk (See GCodeFollower.getEPositionMode).
+    fixed -- Convert parameters with to_fixed instead of Decimal (See
+        GCodeFollower.coordinateMode).
+    set_temperature_prefix -- A line where the first 5 characters are
+        this (such as "M109 ") is never in a LineRun, the same as in
+        _generateTower.
+    '''
+    def __init__(self, local_functions, position_mode="absolute",
+                 e_position_mode="absolute", fixed=False,
+                 set_temperature_prefix="M109 "):
+        self.local_functions = local_functions
+        self.position_mode = position_mode
+        self.e_position_mode = e_position_mode
+        self.fixed = fixed
+        self.set_temperature_prefix = set_temperature_prefix
+
+
+class LineRun(object):
+    '''
+    Consecutive lines that _generateTower would write (See segments)
+    and estimate without depending on the level, height or temperature.
+
+    Public attributes:
+    start, end -- The byte range of the lines in the template.
+    last_offset -- Where the last line starts.
+    line_count -- How many lines there are.
+    last_line -- The last line without trailing whitespace.
+    segments -- The output as TowerPlan segments ("copy", "lines" or
+        "text").
+    times -- The estimated time of each line that takes time, in order
+        (so they are added to the estimate in the same order as
+        addSec).
+    params -- For each parameter, (value, raw, index) from the last line
+        that has it, where value is a Decimal (or from to_fixed if
+        ScanOptions.fixed), raw is the string, and index is the line
+        (counting from 1) in the run.
+    e_total -- The sum of every E value (None if there is none).
+    e_places -- The most decimal places of any E value.
+    position -- The position that the lines set ([x, y, z] where an
+        axis that no line set is None), or None if no line moved.
+    mode -- The positioning mode that the lines set (None if none).
+    e_mode -- The extruder mode that the lines set (None if none).
+    e_position -- The extruder position that the lines set (None if
+        none).
+    e_offsets -- The relative E values to add to the extruder position
+        in order, if the lines move it before it is known (None if
+        none).
+    feed_rate -- The tool feed rate that the lines set (None if none).
+    servo_feed_rate -- The extruder feed rate that the lines set (None
+        if none).
+    counters -- How many times each function occurred.
+    diagnostics -- [kind, message, level, indices] for each kind of
+        problem (See Diagnostics), where indices are like in params.
+    others -- Functions that aren't emulated (Each is in diagnostics,
+        but if the caller registered a handler for one, the run has to
+        be handled line by line, See iter_scanned_lines).
+    '''
+    __slots__ = (
+        'start',
+        'end',
+        'last_offset',
+        'line_count',
+        'last_line',
+        'segments',
+        'times',
+        'params',
+        'e_total',
+        'e_places',
+        'position',
+        'mode',
+        'e_mode',
+        'e_position',
+        'e_offsets',
+        'feed_rate',
+        'servo_feed_rate',
+        'counters',
+        'diagnostics',
+        'others',
+    )
+
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.last_offset = start
+        self.line_count = 0
+        self.last_line = None
+        self.segments = []
+        self.times = []
+        self.params = {}
+        self.e_total = None
+        self.e_places = 0
+        self.position = None
+        self.mode = None
+        self.e_mode = None
+        self.e_position = None
+        self.e_offsets = None
+        self.feed_rate = None
+        self.servo_feed_rate = None
+        self.counters = {}
+        self.diagnostics = None
+        self.others = None
+
+    def __getstate__(self):
+        return [getattr(self, name) for name in LineRun.__slots__]
+
+    def __setstate__(self, state):
+        for name, value in zip(LineRun.__slots__, state):
+            setattr(self, name, value)
+
+    def add_diagnostic(self, kind, message, index, level=WARNING):
+        diagnostics = self.diagnostics
+        if diagnostics is None:
+            diagnostics = self.diagnostics = OrderedDict()
+        entry = diagnostics.get(kind)
+        if entry is None:
+            diagnostics[kind] = [kind, message, level, [index]]
+        else:
+            entry[3].append(index)
+
+
+class ChunkScan(object):
+    '''
+    The result of scan_chunk.
+
+    Public attributes:
+    start, end -- The byte range of the chunk.
+    mode -- The positioning mode that was assumed at the start.
+    mode_sensitive -- True if a move depended on mode (so the chunk
+        has to be scanned again if the mode differs).
+    e_mode, e_mode_sensitive -- The same for the extruder mode.
+    items -- In order, a LineRun or a (start, end) byte range of lines
+        that the caller has to handle one at a time.
+    '''
+    def __init__(self, start, end, mode, e_mode="absolute"):
+        self.start = start
+        self.end = end
+        self.mode = mode
+        self.mode_sensitive = False
+        self.e_mode = e_mode
+        self.e_mode_sensitive = False
+        self.items = []
+
+
+class _Deferred(Exception):
+    '''
+    The line depends on state from before the chunk, so the caller has
+    to emulate it (See _ChunkEmulator).
+    '''
+
+
+class _ChunkEmulator(object):
+    '''
+    Emulate the commands of a chunk like GCodeFollower.addSec, but
+    starting with only what the chunk itself sets (None where the
+    position or extruder position is unknown).
+
+    Each method returns (seconds, effects) where effects is a list of
+    (name, value) for the LineRun attributes that the command sets (See
+    _commit). A command that needs an unknown value raises _Deferred
+    (after updating what is known).
+    '''
+    def __init__(self, mode, scan, e_mode="absolute"):
+        self.mode = mode
+        self.mode_known = False
+        self.e_mode = e_mode
+        self.e_mode_known = False
+        self.scan = scan
+        self.position = [None, None, None]
+        self.e_position = None
+        self.feed_known = False
+        # ^ The current tool's feed rate is known (since a travel move
+        #   with F after the last tool change).
+
+    def move(self, command):
+        '''
+        Emulate a G0, G1 or G92 like GCodeFollower._emulateMove.
+        '''
+        F = command.get('F')
+        if F is None:
+            # addSec adds nothing, but warns if the feed rate is unknown.
+            if not self.feed_known:
+                raise _Deferred()
+            return 0.0, None
+        F = float(F)
+        if not self.mode_known:
+            self.scan.mode_sensitive = True
+        feedPerSec = F / 60.0
+        relative = (self.mode == 'relative')
+        given = [command.get('X'), command.get('Y'), command.get('Z')]
+        newPos = [None, None, None]
+        deltas = [0.0, 0.0, 0.0]
+        moveAny = False
+        deferred = False
+        for i in range(3):
+            if given[i] is None:
+                newPos[i] = 0.0 if relative else self.position[i]
+                continue
+            moveAny = True
+            newPos[i] = float(given[i])
+            if relative:
+                deltas[i] = abs(newPos[i])
+            elif self.position[i] is None:
+                deferred = True
+            else:
+                deltas[i] = abs(newPos[i]-self.position[i])
+        if moveAny:
+            changed = newPos if relative else [
+                (newPos[i] if given[i] is not None else None)
+                for i in range(3)
+            ]
+            self.position = newPos
+            self.feed_known = True
+            if deferred:
+                raise _Deferred()
+            distance = math.sqrt(
+                deltas[0]**2 + deltas[1]**2 + deltas[2]**2
+            )
+            return (distance / feedPerSec,
+                    [("position", changed), ("feed_rate", F)])
+        effects = [("servo_feed_rate", F)]
+        E = command.get('E')
+        if E is None:
+            effects.append((
+                "diagnostic",
+                ("no_movement",
+                 'Estimating "{}" is not possible since there was no X,'
+                 ' Y, Z, nor E movement.'.format(command.pairs),
+                 WARNING),
+            ))
+            return 0.0, effects
+        E = float(E)
+        if not self.e_mode_known:
+            self.scan.e_mode_sensitive = True
+        old_e = self.e_position
+        if self.e_mode == 'relative':
+            if old_e is None:
+                effects.append(("e_offset", E))
+            else:
+                self.e_position = E + old_e
+                effects.append(("e_position", self.e_position))
+            return abs(E) / feedPerSec, effects
+        self.e_position = E
+        if old_e is None:
+            raise _Deferred()
+        effects.append(("e_position", E))
+        return abs(old_e - E) / feedPerSec, effects
+
+    def dwell(self, command):
+        '''
+        Emulate a G4 like GCodeFollower._emulateDwell.
+        '''
+        S = command.get('S')
+        P = command.get('P')
+        if P is not None:
+            P = float(P)
+        if S is None:
+            if P is not None:
+                S = P / 1000.0
+        else:
+            S = float(S)
+        if S is not None:
+            return S, None
+        return 0.0, [(
+            "diagnostic",
+            ("no_S_or_P:" + command.function,
+             'S & P are None in "{}"'.format(command.pairs),
+             ERROR),
+        )]
+
+    def emulate(self, kind, command):
+        '''
+        Emulate a command of a local kind (See LOCAL_KINDS).
+        '''
+        if kind == "move":
+            return self.move(command)
+        elif kind == "dwell":
+            return self.dwell(command)
+        elif kind in ("absolute", "relative"):
+            self.mode = kind
+            self.mode_known = True
+            self.e_mode = kind  # like Marlin (See _emulateAbsolute)
+            self.e_mode_known = True
+            return 0.0, [("mode", kind), ("e_mode", kind)]
+        elif kind in ("e_absolute", "e_relative"):
+            self.e_mode = kind[2:]
+            self.e_mode_known = True
+            return 0.0, [("e_mode", self.e_mode)]
+        return 0.0, None
+
+
+def scan_chunk(buffer, start, end, options, mode=None, e_mode=None):
+    '''
+    Classify the lines of a chunk of a template the same way as
+    GCodeFollower._generateTower (before the tower ends) and summarize
+    each run of lines that don't depend on the state of the tower (See
+    LineRun). Other lines, such as a G0 or G1 with Z, a temperature or
+    tool command (See is_temperature_command), a line that can't be
+    parsed, or a move that depends on state from before the chunk (See
+    _ChunkEmulator) are left for the caller.
+
+    Sequential arguments:
+    buffer -- The template (such as from map_gcode_file).
+    start, end -- The byte range of the chunk (whole lines).
+    options -- A ScanOptions.
+
+    Keyword arguments:
+    mode -- The positioning mode at start (default:
+        options.position_mode).
+    e_mode -- The extruder mode at start (default:
+        options.e_position_mode).
+
+    Returns:
+    ChunkScan
+    '''
+    if mode is None:
+        mode = options.position_mode
+    if e_mode is None:
+        e_mode = options.e_position_mode
+    scan = ChunkScan(start, end, mode, e_mode)
+    items = scan.items
+    emulator = _ChunkEmulator(mode, scan, e_mode)
+    run = None
+    find = buffer.find
+    offset = start
+    while offset < end:
+        line_end = find(b"\n", offset, end)
+        if line_end < 0:
+            line_end = end
+        else:
+            line_end += 1
+        line_start = offset
+        offset = line_end
+        if run is None:
+            run = LineRun(line_start)
+        if _scan_line(buffer[line_start:line_end], run, emulator,
+                      options):
+            continue
+        # The caller handles the line:
+        if run.line_count:
+            items.append(run)
+        run = None
+        if items and (type(items[-1]) is tuple):
+            items[-1] = (items[-1][0], line_end)
+        else:
+            items.append((line_start, line_end))
+    if (run is not None) and run.line_count:
+        items.append(run)
+    return scan
+
+
+def _scan_line(original_bytes, run, emulator, options):
+    '''
+    Add a line to run if it can be summarized (See scan_chunk), and
+    update what emulator knows either way.
+
+    Returns:
+    bool: True if it was added, False if the caller has to handle it.
+    '''
+    try:
+        original_line = original_bytes.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    if original_line.endswith("\r\n"):
+        original_line = original_line[:-2] + "\n"
+    line = original_line.rstrip()
+    command = ParsedCommand(line)
+    cmd_meta = command.pairs
+    if cmd_meta is None:
+        _add_line(run, original_line.rstrip("\n").rstrip("\r") + "\n",
+                  original_bytes, line)
+        return True
+    function = command.function
+    if is_temperature_command(function):
+        if function.startswith("T"):
+            emulator.feed_known = False  # It may be another tool.
+        return False
+    keep = True
+    if len(cmd_meta[0]) == 1:
+        # Klipper-style macro
+        text = original_line
+    else:
+        text = line + "\n"
+        try:
+            code_number = int(cmd_meta[0][1])
+        except (TypeError, ValueError):
+            return False
+        if cmd_meta[0][0] == "G":
+            if (code_number in (0, 1)) and command.has("Z"):
+                keep = False  # It may change the level.
+        elif cmd_meta[0][0] == "M":
+            if line[0:5] == options.set_temperature_prefix:
+                keep = False
+    kind = options.local_functions.get(function)
+    seconds = 0.0
+    effects = None
+    if kind is not None:
+        try:
+            seconds, effects = emulator.emulate(kind, command)
+        except (_Deferred, ValueError):
+            return False
+    if not keep:
+        return False
+    index = run.line_count + 1
+    values = []
+    e_total = None
+    e_places = 0
+    fixed = options.fixed
+    for i in range(1, len(cmd_meta)):
+        pair = cmd_meta[i]
+        if len(pair) < 2:
+            continue
+        elif len(pair) > 2:
+            return False  # The caller shows a warning.
+        key = pair[0]
+        try:
+            if fixed:
+                value = to_fixed(pair[1],
+                                 FIXED_PLACES.get(key, DEFAULT_FIXED_PLACES))
+                if key == "E":
+                    dot = pair[1].find(".")
+                    if dot >= 0:
+                        e_places = max(e_places, len(pair[1]) - dot - 1)
+            else:
+                value = command.get_decimal(key)
+        except decimal.InvalidOperation:
+            return False  # The caller shows an error.
+        if key == "E":
+            e_total = value + (e_total or 0)
+        values.append((key, value, pair[1]))
+
+    # Only now that the line is kept, change the run:
+    for key, value, raw in values:
+        run.params[key] = (value, raw, index)
+    if e_total is not None:
+        run.e_total = e_total + (run.e_total or 0)
+        run.e_places = max(run.e_places, e_places)
+    if kind is None:
+        if run.others is None:
+            run.others = set()
+        run.others.add(function)
+        run.add_diagnostic(
+            "not_emulated:" + function,
+            "The command isn't emulated for estimates or other uses:"
+            " {}".format(cmd_meta),
+            index,
+        )
+    else:
+        if seconds:
+            run.times.append(seconds)
+        if effects is not None:
+            _commit(run, effects, index)
+    counters = run.counters
+    counters[function] = counters.get(function, 0) + 1
+    _add_line(run, text, original_bytes, line)
+    return True
+
+
+def _commit(run, effects, index):
+    '''
+    Record the effects of a command (See _ChunkEmulator) in run.
+    '''
+    for name, value in effects:
+        if name == "position":
+            if run.position is None:
+                run.position = [None, None, None]
+            for i in range(3):
+                if value[i] is not None:
+                    run.position[i] = value[i]
+        elif name == "e_offset":
+            if run.e_offsets is None:
+                run.e_offsets = []
+            run.e_offsets.append(value)
+        elif name == "diagnostic":
+            kind, message, level = value
+            run.add_diagnostic(kind, message, index, level=level)
+        else:
+            setattr(run, name, value)
+
+
+def _add_line(run, text, original_bytes, line):
+    '''
+    Add a line to run, where text is its output (added to run.segments
+    like TowerPlanRecorder.write) and line is without trailing
+    whitespace.
+    '''
+    add_segment(run.segments, line_segment(text, run.end, original_bytes))
+    run.last_line = line
+    run.line_count += 1
+    run.last_offset = run.end
+    run.end += len(original_bytes)
+
+
+def chunk_modes(buffer, ranges, mode, e_mode):
+    '''
+    Get (mode, e_mode) at the start of each of ranges (sorted (start,
+    end) byte ranges of buffer) by finding the commands at the start of
+    a line that set them (G90, G91, M82 or M83, See
+    GCodeFollower._emulateAbsolute), where mode and e_mode are the
+    positioning mode and extruder mode at the start of buffer. A chunk
+    is scanned again if it depends on a mode that differs (such as if
+    a macro changed it, See iter_scanned_lines).
+    '''
+    results = []
+    matches = _MODE_PATTERN.finditer(buffer)
+    match = next(matches, None)
+    for start, _ in ranges:
+        while (match is not None) and (match.start() < start):
+            function = match.group(1)
+            if function == b"G90":
+                mode = e_mode = "absolute"
+            elif function == b"G91":
+                mode = e_mode = "relative"
+            elif function == b"M82":
+                e_mode = "absolute"
+            else:
+                e_mode = "relative"
+            match = next(matches, None)
+        results.append((mode, e_mode))
+    return results
+
+
+def chunk_ranges(buffer, chunk_size):
+    '''
+    Split buffer into (start, end) byte ranges of about chunk_size bytes
+    where each ends after a newline (except at the end of buffer).
+    '''
+    ranges = []
+    size = len(buffer)
+    start = 0
+    while start < size:
+        end = start + max(chunk_size, 1)
+        if end >= size:
+            end = size
+        else:
+            newline = buffer.find(b"\n", end - 1)
+            end = size if newline < 0 else newline + 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def _scan_job(job):
+    '''
+    Scan a chunk in a worker process (See scan_chunk), where job is
+    (path, start, end, options, mode, e_mode).
+    '''
+    path, start, end, options, mode, e_mode = job
+    with map_gcode_file(path) as buffer:
+        return scan_chunk(buffer, start, end, options, mode=mode,
+                          e_mode=e_mode)
+
+
+def apply_line_run(follower, run, line_number):
+    '''
+    Add the estimate of a LineRun to a GCodeFollower and leave its
+    emuState, metrics and diagnostics the same as calling addSec for
+    each line of the run.
+
+    Sequential arguments:
+    follower -- The GCodeFollower.
+    run -- A LineRun.
+    line_number -- The number of the line before the run.
+    '''
+    for seconds in run.times:
+        follower._estS += seconds
+    emuState = follower.emuState
+    if run.position is not None:
+        position = list(emuState['position'])
+        for i, value in enumerate(run.position):
+            if value is not None:
+                position[i] = value
+        emuState['position'] = position
+    if run.mode is not None:
+        emuState['position_mode'] = run.mode
+    if run.e_mode is not None:
+        follower.setEPositionMode(run.e_mode)
+    if run.e_offsets is not None:
+        for offset in run.e_offsets:
+            follower.setEPos(offset + follower.getEPos())
+    if run.e_position is not None:
+        follower.setEPos(run.e_position)
+    if run.feed_rate is not None:
+        emuState['tools'][emuState['tool']]['feed_rate'] = run.feed_rate
+    if run.servo_feed_rate is not None:
+        servo = emuState['extruder']
+        emuState['servos'][servo]['feed_rate'] = run.servo_feed_rate
+    metrics = follower.metrics
+    if metrics is not None:
+        counters = metrics.counters
+        registry = follower.commandRegistry
+        for function, count in run.counters.items():
+            counters[function] = counters.get(function, 0) + count
+            registry.add_calls(function, count)
+    if run.diagnostics is not None:
+        diagnostics = follower.diagnostics
+        for kind, message, level, indices in run.diagnostics.values():
+            diagnostics.add_lines(
+                kind,
+                message,
+                [line_number + index for index in indices],
+                level=level,
+            )
+
+
+def iter_scanned_lines(follower, path, options, workers, stop=None,
+                       chunk_size=None):
+    '''
+    Yield (offset, line) for each line of a template like
+    iter_mapped_lines, except yield (offset, run) for each LineRun
+    (where offset is run.start) that was scanned by a pool of workers
+    (See scan_chunk). Each item is only yielded after the caller has
+    handled the previous one, so the state of follower is checked when
+    it is needed:
+    - A chunk is scanned again (in this process) if it depends on the
+      positioning mode or the extruder mode (See ChunkScan) and the
+      mode of follower differs from the assumed one (See chunk_modes).
+    - The lines of a run are yielded one at a time instead if
+      follower.commandRegistry has a handler for one of its others.
+    - Once stop returns True, the workers are stopped and the rest of
+      the lines are yielded one at a time.
+
+    Sequential arguments:
+    follower -- The GCodeFollower that handles the lines.
+    path -- The template.
+    options -- A ScanOptions.
+    workers -- The number of processes (If 1 or if there is only one
+        chunk, the template is scanned in this process).
+
+    Keyword arguments:
+    stop -- A callable that returns True once runs can't be used (such
+        as after the tower ends).
+    chunk_size -- The size of each chunk in bytes (default: based on the
+        size of the template and workers, See CHUNKS_PER_WORKER).
+    '''
+    registry = follower.commandRegistry
+    with map_gcode_file(path) as buffer:
+        size = len(buffer)
+        if chunk_size is None:
+            chunk_size = size // max(workers * CHUNKS_PER_WORKER, 1)
+            chunk_size = min(max(chunk_size, MIN_CHUNK_SIZE),
+                             MAX_CHUNK_SIZE)
+        ranges = chunk_ranges(buffer, chunk_size)
+        pool = None
+        if (workers > 1) and (len(ranges) > 1):
+            modes = chunk_modes(buffer, ranges, options.position_mode,
+                                options.e_position_mode)
+            pool = multiprocessing.Pool(min(workers, len(ranges)))
+            scans = pool.imap(
+                _scan_job,
+                [(path, start, end, options) + chunk_mode
+                 for (start, end), chunk_mode in zip(ranges, modes)],
+            )
+        else:
+            scans = (scan_chunk(buffer, start, end, options,
+                                mode=follower.emuState['position_mode'],
+                                e_mode=follower.getEPositionMode())
+                     for start, end in ranges)
+            # ^ Each chunk is scanned after the ones before it are
+            #   handled, so the modes are known.
+        rest = None  # Where the lines are yielded without scans
+        try:
+            for scan in scans:
+                mode = follower.emuState['position_mode']
+                e_mode = follower.getEPositionMode()
+                if ((scan.mode_sensitive and (mode != scan.mode))
+                        or (scan.e_mode_sensitive
+                            and (e_mode != scan.e_mode))):
+                    logger.info("The chunk at {} is scanned again since"
+                                " the position mode is {} and the"
+                                " extruder mode is {}."
+                                "".format(scan.start, mode, e_mode))
+                    scan = scan_chunk(buffer, scan.start, scan.end,
+                                      options, mode=mode, e_mode=e_mode)
+                for item in scan.items:
+                    if type(item) is tuple:
+                        start, end = item
+                    else:
+                        start, end = item.start, item.end
+                    if (stop is not None) and stop():
+                        rest = start
+                        break
+                    if (type(item) is not tuple) and \
+                            ((item.others is None)
+                             or not any([(function in registry)
+                                         for function in item.others])):
+                        yield item.start, item
+                        continue
+                    for line in _iter_lines(buffer, start, end):
+                        yield line
+                if rest is not None:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if rest is not None:
+            for line in _iter_lines(buffer, rest, size):
+                yield line
+
+
+def _iter_lines(buffer, start, end):
+    '''
+    Yield (offset, line) for each line of buffer from start to end.
+    '''
+    find = buffer.find
+    while start < end:
+        line_end = find(b"\n", start, end)
+        line_end = end if line_end < 0 else line_end + 1
+        yield start, buffer[start:line_end]
+        start = line_end
@@ -0,0 +1,1073 @@
+'''
+gcodepipeline
+-------------
+part of maniforge by Poikilos
+
+Process G-code in one pass through a chain of generators (stages):
+- A source (See read_lines) yields each line.
+- parse_lines yields a ParsedCommand for each line.
+- Each transformer yields the commands that it keeps, changes or
+  inserts. A stateful one (such as LevelTracker) is an object that is
+  called with the commands of the previous stage.
+- A tap (such as EstimateTap) yields every command unchanged after
+  looking at it.
+- A sink (See write_lines) writes the result.
+
+Each stage pulls one command at a time from the previous one, so any
+number of stages read and write the file only once, and a stage can
+read the state of an earlier stateful stage (such as the height of a
+LevelTracker), which is always up to date for the command it receives.
+
+Command-Line Interface (CLI) usage (such as for the post-processing
+scripts option of a slicer):
+python -m maniforge.gcodepipeline [options] < in.gcode > out.gcode
+python -m maniforge.gcodepipeline [options] <path>
+(With a path, the file is changed in place)
+
+Options:
+--arcs[=<mm>]       Replace runs of G1 segments on a circle with G2 or
+                    G3 arcs that are within this tolerance (default:
+                    0.05, See maniforge.gcodearc). The printer needs
+                    arc support (such as ARC_SUPPORT in Marlin).
+--estimate          Show the estimated print time (to stderr).
+--max-height=<Z>    Remove build moves after Z goes above this height
+                    (See Truncate).
+--minify            Remove comments, blank lines and anything that is
+                    already in effect such as an unchanged F (See
+                    maniforge.gcodeminify).
+--overlap-heating   Heat the bed and hotend at the same time and during
+                    homing in the start G-code (See
+                    maniforge.gcodestart).
+--precision[=<X,Y,Z,E>]
+                    Write X, Y, Z and E with the fewest decimal places
+                    that reach the same motor step at these steps per
+                    mm (default: 80,80,400,500, See
+                    maniforge.gcodeprecision).
+--preheat           Start heating before each M109 during the print
+                    (See Preheat).
+--simplify[=<mm>]   Merge G1 moves whose points are within this
+                    distance of a straight path (default: 0.02, See
+                    maniforge.gcodesimplify).
+--standby=<degrees> Keep the idle tool this much cooler than its
+                    printing temperature, and reheat it before the next
+                    tool change (See ToolStandby).
+--thermal           Estimate heating alongside motion (implies
+                    --estimate, See maniforge.gcodethermal).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import decimal
+import shutil
+import sys
+
+from collections import deque
+from decimal import Decimal
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodethermal import ThermalModel
+from maniforge.mfgcode import (
+    ParsedCommand,
+    iter_mapped_lines,
+)
+from maniforge.mfmath import getHMSMessageFromS
+
+logger = getLogger(__name__)
+
+MOVE_FUNCTIONS = ("G0", "G1")
+HOTEND_FUNCTIONS = ("M104", "M109")
+MODE_FUNCTIONS = ("G90", "G91", "M82", "M83")
+
+# Commands that don't move or change the feed rate (Any other command
+# makes the position and feed rate unknown, See MoveState.forget):
+KEEP_STATE_FUNCTIONS = (
+    "G4",
+    "M73",  # Set print progress
+    "M104",
+    "M105",
+    "M106",
+    "M107",
+    "M109",
+    "M117",
+    "M140",
+    "M190",
+    "M201",  # Set max acceleration
+    "M203",  # Set max feed rate
+    "M204",
+    "M205",
+    "M220",  # Set feed rate percentage (F stays the same)
+    "M221",  # Set flow percentage
+    "M400",
+)
+
+# Commands that move but don't change the modes (A tool change also
+# doesn't, but any other command, such as a Klipper-style macro, may):
+MOVING_FUNCTIONS = ("G28", "G29")
+
+END_RETRACTION_FLAG = "filament slightly"
+# ^ A retraction in the end G-code with this in its comment is kept
+#   after a tower ends (See Truncate and GCodeFollower.getDocumentation).
+
+
+def echo0(*args):
+    print(*args, file=sys.stderr)
+
+
+def read_lines(source):
+    '''
+    Yield each line of G-code (str) without the newline ("\\r\\n" or
+    "\\n").
+
+    Sequential arguments:
+    source -- A path (read using a memory map, See iter_mapped_lines) or
+        a stream of str or bytes lines (such as sys.stdin).
+    '''
+    if not hasattr(source, 'read'):
+        for _, original_bytes in iter_mapped_lines(source):
+            yield original_bytes.decode("utf-8").rstrip("\r\n")
+        return
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        yield line.rstrip("\r\n")
+
+
+def parse_lines(lines):
+    '''
+    Yield a ParsedCommand for each line (str without the newline).
+    '''
+    for line in lines:
+        yield ParsedCommand(line)
+
+
+def write_lines(commands, outs):
+    '''
+    Write each command as a line (This is the sink that pulls the
+    commands through every stage).
+
+    Sequential arguments:
+    commands -- ParsedCommand objects, such as from the last stage.
+    outs -- A text stream.
+
+    Returns:
+    int: The number of lines written.
+    '''
+    count = 0
+    write = outs.write
+    for command in commands:
+        write(command.line + "\n")
+        count += 1
+    return count
+
+
+def chain(commands, stages):
+    '''
+    Connect stages in order.
+
+    Sequential arguments:
+    commands -- The first commands, such as from parse_lines.
+    stages -- Callables that each accept commands and return an
+        iterable of commands (such as a generator function or a
+        LevelTracker).
+
+    Returns:
+    iterable: The commands of the last stage.
+    '''
+    for stage in stages:
+        commands = stage(commands)
+    return commands
+
+
+def run_pipeline(source, outs, stages=()):
+    '''
+    Read source (See read_lines), pass the commands through stages (See
+    chain) and write them to outs (See write_lines) in one pass.
+
+    Returns:
+    int: The number of lines written.
+    '''
+    return write_lines(chain(parse_lines(read_lines(source)), stages),
+                       outs)
+
+
+def get_decimal(command, key):
+    '''
+    Get the value of a parameter as a Decimal (None if not present, not
+    set, or not a number).
+    '''
+    try:
+        return command.get_decimal(key)
+    except decimal.InvalidOperation:
+        return None
+
+
+def is_build_move(command):
+    '''
+    Check whether a command prints or moves within a layer (like the
+    moves that _generateTower removes after the tower ends), as opposed
+    to homing or a move that only changes the height.
+    '''
+    if command.function not in MOVE_FUNCTIONS:
+        return False
+    if command.has("E"):
+        return True
+    if not command.has("X"):
+        return False
+    if command.has("Y") or command.has("Z"):
+        return True
+    x = command.get("X")
+    return (x is not None) and (x.strip("+-0.") != "")
+
+
+def is_tool_change(command):
+    '''
+    Check whether a command changes the tool (A Klipper-style macro
+    such as TIMELAPSE_TAKE_FRAME also starts with T but doesn't).
+    '''
+    function = command.function
+    return ((function is not None) and function.startswith("T")
+            and not command.is_macro())
+
+
+class MoveState(object):
+    '''
+    Track the XYZ position and the E position and modes (G90/G91,
+    M82/M83, G92, G28) for a stage that rewrites XY moves (such as
+    maniforge.gcodearc.ArcWelder). Call update after each command.
+
+    Public attributes:
+    position -- [x, y, z] (each None while unknown, such as after G28).
+    xy_relative -- The G91 mode is on.
+    e_relative -- E is relative (M83 or G91).
+    e_position -- The E position (None while unknown).
+    xy_mode_known, e_mode_known -- Whether xy_relative and e_relative
+        were set by the G-code (A previous print may have left any
+        mode, and after G90 following M83, E is absolute in Marlin but
+        not in Klipper).
+    m83 -- The last of M82 and M83 was M83 (unlike e_relative, G90
+        and G91 don't change it, since they don't in Klipper).
+    m83_known -- Whether m83 was set by the G-code.
+    '''
+    def __init__(self):
+        self.position = [None, None, None]
+        self.xy_relative = False
+        self.e_relative = False
+        self.e_position = None
+        self.xy_mode_known = False
+        self.e_mode_known = False
+        self.m83 = False
+        self.m83_known = False
+
+    def segment(self, command):
+        '''
+        Get (x, y, e) for a G1 that can be replaced along with the G1
+        moves next to it: one in absolute XY mode that moves in XY
+        without Z, I, J, R or a comment, from a known position (and in
+        known modes, See forget). The e is the distance extruded (None
+        if no E), and a move that retracts or has E without extruding
+        can't be replaced.
+
+        Returns:
+        tuple: (x, y, e) or None if command can't be replaced.
+        '''
+        position = self.position
+        if (command.function != "G1") or (";" in command.line):
+            return None
+        if self.xy_relative or not self.xy_mode_known or \
+                (position[0] is None) or (position[1] is None):
+            return None
+        if not (command.has('X') or command.has('Y')):
+            return None
+        for key in ('Z', 'I', 'J', 'R'):
+            if command.has(key):
+                return None
+        try:
+            x = command.get_float('X')
+            y = command.get_float('Y')
+            e = command.get_float('E')
+        except ValueError:
+            return None
+        x = position[0] if x is None else x
+        y = position[1] if y is None else y
+        if e is not None:
+            if not self.e_mode_known:
+                return None
+            if not self.e_relative:
+                if self.e_position is None:
+                    return None
+                e -= self.e_position
+            if e <= 0:
+                return None
+        if (x == position[0]) and (y == position[1]):
+            return None
+        return x, y, e
+
+    def update(self, command):
+        '''
+        Update the state for one command.
+        '''
+        function = command.function
+        if function in ("G90", "G91"):
+            was_e_absolute = self.e_mode_known and not self.e_relative
+            self.xy_relative = (function == "G91")
+            self.e_relative = self.xy_relative
+            self.xy_mode_known = True
+            self.e_mode_known = (self.xy_relative or was_e_absolute
+                                 or (self.m83_known and not self.m83))
+        elif function in ("M82", "M83"):
+            self.e_relative = (function == "M83")
+            self.m83 = self.e_relative
+            self.m83_known = True
+            self.e_mode_known = self.e_relative or (
+                self.xy_mode_known and not self.xy_relative
+            )
+            # ^ M82 doesn't make E absolute after G91 in Klipper.
+        elif function == "G28":
+            self.position = [None, None, None]
+        elif function in ("G0", "G1", "G2", "G3", "G92"):
+            offsets = self.xy_relative and (function != "G92")
+            for axis_i, axis in enumerate(('X', 'Y', 'Z')):
+                self.position[axis_i] = self._next(
+                    command, axis, self.position[axis_i], offsets,
+                )
+            self.e_position = self._next(
+                command, 'E', self.e_position,
+                self.e_relative and (function != "G92"),
+            )
+
+    def forget(self, command):
+        '''
+        Make the position unknown if command may move (any command that
+        is not in KEEP_STATE_FUNCTIONS and that update doesn't track),
+        and the modes unknown if it may also change them.
+
+        Returns:
+        bool: True if the position was forgotten.
+        '''
+        function = command.function
+        if (function is None) or (function in KEEP_STATE_FUNCTIONS) or \
+                (function in MODE_FUNCTIONS) or \
+                (function in MOVE_FUNCTIONS + ("G2", "G3", "G92")):
+            return False
+        self.position = [None, None, None]
+        self.e_position = None
+        if command.is_macro() or not ((function in MOVING_FUNCTIONS)
+                                      or is_tool_change(command)):
+            self.xy_mode_known = False
+            self.e_mode_known = False
+            self.m83_known = False
+        return True
+
+    @staticmethod
+    def _next(command, key, value, offsets):
+        # Get the position after command along one axis.
+        try:
+            new_value = command.get_float(key)
+        except ValueError:
+            return None
+        if new_value is None:
+            return value
+        if offsets:
+            if value is None:
+                return None
+            return value + new_value
+        return new_value
+
+
+class LevelTracker(object):
+    '''
+    Track the height (Z) and the level of a temperature tower as
+    commands pass through, the same way as GCodeFollower._generateTower
+    (See TemperatureSplicer and Truncate):
+    - The height is the Z of the last G0 or G1 with Z (even in relative
+      mode), and a Z without a value (homing) is height 0 and level 0.
+    - A level starts when the height reaches the start of the next
+      level, but only after the first temperature wait (start_prefix)
+      and not if the height is above the start of the level after that
+      (such as a wait or purge position).
+    - The tower ends (stopped) when the height changes on the last
+      level, or reaches the next level if it has no temperature (See
+      level_count). After that, the level doesn't change.
+
+    Keyword arguments:
+    heights -- The height where each level starts (such as
+        GCodeFollower.heights). If None, only the height is tracked.
+    level_count -- How many levels have a temperature (default: all of
+        heights).
+    start_prefix -- The start of a temperature wait line (such as
+        GCodeFollower.commands['set temperature and wait'] + " ").
+
+    Public attributes:
+    height -- The height after the current command (a Decimal, or None
+        until known).
+    layer -- How many times the height increased (-1 before the first).
+    level -- The current level.
+    level_changed -- The current command started a new level.
+    started -- The temperature wait was found.
+    stopped -- The tower ended (at the current command or before it).
+    '''
+    def __init__(self, heights=None, level_count=None,
+                 start_prefix="M109 "):
+        self.heights = None
+        if heights is not None:
+            self.heights = [Decimal(str(height)) for height in heights]
+            if level_count is None:
+                level_count = len(heights)
+        self.level_count = level_count
+        self.start_prefix = start_prefix
+        self.height = None
+        self.layer = -1
+        self.level = 0
+        self.level_changed = False
+        self.started = False
+        self.stopped = False
+
+    def __call__(self, commands):
+        for command in commands:
+            self.update(command)
+            yield command
+
+    def update(self, command):
+        '''
+        Update the state for one command.
+        '''
+        self.level_changed = False
+        if command.line[:len(self.start_prefix)] == self.start_prefix:
+            self.started = True
+            return
+        if (command.function not in MOVE_FUNCTIONS) or \
+                not command.has("Z"):
+            return
+        z = get_decimal(command, "Z")
+        if z is None:
+            if command.get("Z") is None:
+                # Homing
+                self.height = Decimal("0.00")
+                if not self.stopped:
+                    self.level = 0
+            return
+        if (self.height is None) or (z > self.height):
+            self.layer += 1
+        self.height = z
+        heights = self.heights
+        if (heights is None) or self.stopped:
+            return
+        next_level = self.level + 1
+        if next_level >= len(heights):
+            self.stopped = True
+        elif z >= heights[next_level]:
+            if next_level >= self.level_count:
+                self.stopped = True
+            elif not self.started:
+                pass  # It is presumably start G-code.
+            elif ((len(heights) > next_level + 1)
+                    and (z > heights[next_level + 1])):
+                pass  # It may be a wait or purge position.
+            else:
+                self.level = next_level
+                self.level_changed = True
+
+
+class TemperatureSplicer(object):
+    '''
+    Set the temperature of each level (See LevelTracker) the same way as
+    GCodeFollower._generateTower: Insert fmt with the temperature of the
+    level after each command that starts a level, and replace each
+    temperature wait (See LevelTracker start_prefix, such as the one in
+    the start G-code) with start_fmt with the temperature of the
+    current level.
+
+    Sequential arguments:
+    tracker -- A LevelTracker that is an earlier stage.
+    temperatures -- The temperature of each level (A level beyond the
+        last temperature is not changed).
+
+    Keyword arguments:
+    fmt -- The format of the inserted line.
+    start_fmt -- The format of a replaced temperature wait.
+    '''
+    def __init__(self, tracker, temperatures, fmt="M109 S{:.2f}",
+                 start_fmt="M109 S{:d}"):
+        self.tracker = tracker
+        self.temperatures = temperatures
+        self.fmt = fmt
+        self.start_fmt = start_fmt
+        self.new_line_count = 0
+
+    def __call__(self, commands):
+        tracker = self.tracker
+        temperatures = self.temperatures
+        prefix = tracker.start_prefix
+        for command in commands:
+            if tracker.level >= len(temperatures):
+                yield command
+                continue
+            if command.line[:len(prefix)] == prefix:
+                yield ParsedCommand(
+                    self.start_fmt.format(temperatures[tracker.level])
+                )
+                continue
+            yield command
+            if tracker.level_changed:
+                self.new_line_count += 1
+                yield ParsedCommand(
+                    self.fmt.format(temperatures[tracker.level])
+                )
+
+
+class Truncate(object):
+    '''
+    Remove the build moves once the tower ends (See LevelTracker
+    stopped) or the height goes above max_height, the same way as
+    GCodeFollower._generateTower, and keep the rest (such as end G-code
+    that turns off the heaters): After the command where it ends,
+    message is inserted, then each G command that would build (See
+    would_build), each fan_function and each blank line after a blank
+    line are removed.
+
+    Sequential arguments:
+    tracker -- A LevelTracker that is an earlier stage.
+
+    Keyword arguments:
+    max_height -- Also end after a command that goes above this Z.
+    message -- The line written where the print ends.
+    max_z_move -- A Z change this small or smaller is a build move
+        (like the max_z_build_movement setting of GCodeFollower).
+    end_retraction_flag -- A retraction with this in its comment is
+        kept (See END_RETRACTION_FLAG).
+    fan_function -- The command that sets the fan speed.
+
+    Public attributes:
+    stopped -- The message was inserted.
+    removed_count -- How many commands were removed.
+    '''
+    def __init__(self, tracker, max_height=None,
+                 message="; gcodepipeline says: stop_building",
+                 max_z_move="1.20", end_retraction_flag=None,
+                 fan_function="M106"):
+        self.tracker = tracker
+        self.max_height = None
+        if max_height is not None:
+            self.max_height = Decimal(str(max_height))
+        self.message = message
+        self.max_z_move = Decimal(str(max_z_move))
+        if end_retraction_flag is None:
+            end_retraction_flag = END_RETRACTION_FLAG
+        self.end_retraction_flag = end_retraction_flag
+        self.fan_function = fan_function
+        self.stopped = False
+        self.removed_count = 0
+        self._z = None  # The last Z (of any command)
+        self._blank = False  # The last command written was blank.
+
+    def __call__(self, commands):
+        tracker = self.tracker
+        for command in commands:
+            previous_z = self._z
+            z = None
+            if command.pairs is not None:
+                z = get_decimal(command, "Z")
+                if z is not None:
+                    self._z = z
+            if self.stopped and self.removes(command, z, previous_z):
+                self.removed_count += 1
+                continue
+            yield command
+            self._blank = (command.line.strip() == "")
+            if self.stopped:
+                continue
+            if tracker.stopped or (
+                (self.max_height is not None)
+                and (tracker.height is not None)
+                and (tracker.height > self.max_height)
+            ):
+                self.stopped = True
+                yield ParsedCommand(self.message)
+
+    def removes(self, command, z, previous_z):
+        '''
+        Check whether command is removed after the tower ends.
+
+        Sequential arguments:
+        command -- A ParsedCommand.
+        z -- The Z of command (None if it has none).
+        previous_z -- The last Z before command (None if none).
+        '''
+        if command.pairs is None:
+            return self._blank and (command.line.strip() == "")
+        if command.is_macro():
+            return False
+        function = command.function
+        if function == self.fan_function:
+            return True
+        if not function.startswith("G"):
+            return False
+        return self.would_build(command, z, previous_z)
+
+    def would_build(self, command, z, previous_z):
+        '''
+        Check whether a G command (after the tower ends) only sets F,
+        extrudes or retracts (except with end_retraction_flag), moves in
+        X and Y (or X with Z, or X to anywhere but 0), or moves Z by
+        max_z_move or less (such as to the next layer).
+        '''
+        pairs = command.pairs
+        if (len(pairs) == 2) and (pairs[1][0] == "F"):
+            return True
+        e = get_decimal(command, "E")
+        if (e is not None) and not ((e < 0) and (
+                self.end_retraction_flag in command.line)):
+            return True
+        x = get_decimal(command, "X")
+        if (x is not None) and ((z is not None) or (x != 0)
+                                or (get_decimal(command, "Y")
+                                    is not None)):
+            return True
+        return ((z is not None) and (previous_z is not None)
+                and (abs(z - previous_z) <= self.max_z_move))
+
+
+class EstimateTap(object):
+    '''
+    Estimate the print time of the commands that pass through (unchanged)
+    using GCodeFollower.addSec.
+
+    Sequential arguments:
+    follower -- A GCodeFollower (Its _estS and diagnostics are updated).
+    '''
+    def __init__(self, follower):
+        self.follower = follower
+        self.line_number = 0  # The line at this point in the pipeline
+
+    def __call__(self, commands):
+        follower = self.follower
+        diagnostics = follower.diagnostics
+        for command in commands:
+            self.line_number += 1
+            diagnostics.line_number = self.line_number
+            follower.addSec(command)
+            yield command
+        diagnostics.line_number = None
+
+    @property
+    def seconds(self):
+        return self.follower._estS
+
+
+class Preheat(object):
+    '''
+    Replace each wait for the hotend (M109 with S) after printing
+    starts with a set temperature command (M104) inserted early enough
+    that the hotend is predicted to be ready (See
+    GCodeFollower.getToolSecRelTemp), using the estimated time of each
+    command before it. The M109 is kept (as a settle wait) only where
+    there isn't enough time before it, such as if another temperature
+    command (or max_lead seconds) is closer than the predicted heat-up
+    time.
+
+    Sequential arguments:
+    follower -- A GCodeFollower that estimates the commands (in their
+        original order) as they pass through (A ThermalModel is
+        installed on it if it doesn't have one, so that a Klipper macro
+        such as TIMELAPSE_TAKE_FRAME isn't a change to a cold tool).
+
+    Keyword arguments:
+    max_lead -- The most seconds to look back (The commands within this
+        time are held back until the next M109 or temperature command).
+    keep_wait -- Keep every M109 after its M104 anyway (in case the
+        prediction is too short).
+
+    Public attributes:
+    preheat_count -- How many M104 commands were inserted.
+    wait_count -- How many M109 commands were kept.
+    saved_seconds -- The estimated waiting time that was removed.
+    '''
+    def __init__(self, follower, max_lead=300.0, keep_wait=False):
+        self.follower = follower
+        if follower.thermalModel is None:
+            ThermalModel().install(follower)
+        self.max_lead = max_lead
+        self.keep_wait = keep_wait
+        self.preheat_count = 0
+        self.wait_count = 0
+        self.saved_seconds = 0.0
+
+    def __call__(self, commands):
+        follower = self.follower
+        pending = deque()  # (command, seconds) not yielded yet
+        pending_s = 0.0
+        printing = False
+        for command in commands:
+            function = command.function
+            if printing and (function == "M109"):
+                try:
+                    target = float(command.get("S"))
+                except (TypeError, ValueError):
+                    target = None
+                if target is not None:
+                    heat_s = follower.getToolSecRelTemp(target)
+                    # Find the earliest command to start heating after:
+                    lead_s = 0.0
+                    split = len(pending)
+                    while (split > 0) and (lead_s < heat_s):
+                        split -= 1
+                        lead_s += pending[split][1]
+                    for _ in range(split):
+                        yield pending.popleft()[0]
+                    self.preheat_count += 1
+                    yield ParsedCommand(
+                        "M104" + command.line.lstrip()[len(function):]
+                    )
+                    while pending:
+                        yield pending.popleft()[0]
+                    pending_s = 0.0
+                    if lead_s >= heat_s:
+                        self.saved_seconds += heat_s
+                        if self.keep_wait:
+                            self.wait_count += 1
+                            yield command
+                    else:
+                        self.saved_seconds += lead_s
+                        self.wait_count += 1
+                        yield command
+                    follower.addSec(command)
+                    continue
+            started_s = follower._estS
+            follower.addSec(command)
+            if (function in HOTEND_FUNCTIONS) or is_tool_change(command):
+                # Heating can't start before this (or a tool change),
+                # so don't hold back the commands before it.
+                while pending:
+                    yield pending.popleft()[0]
+                pending_s = 0.0
+                yield command
+                continue
+            if not printing:
+                printing = is_build_move(command) and command.has("E")
+            seconds = follower._estS - started_s
+            pending.append((command, seconds))
+            pending_s += seconds
+            while pending_s - pending[0][1] >= self.max_lead:
+                old, old_s = pending.popleft()
+                pending_s -= old_s
+                yield old
+        while pending:
+            yield pending.popleft()[0]
+
+
+class ToolStandby(object):
+    '''
+    Keep the idle tool of a multi-tool printer (such as T0 and T1) at a
+    standby temperature and reheat it before its next use, instead of
+    each tool change waiting for a full reheat:
+    - After each tool change, the tool that became idle is set (M104
+      with T) to standby_drop degrees below its printing temperature
+      (its target when it last extruded). Until the next extrusion, an
+      M104 that would set it lower (such as the slicer turning the
+      idle tool off) is removed.
+    - At each tool change, the new tool is set back to its printing
+      temperature early enough that it is predicted to be ready at the
+      tool change (using the estimated time of each command before it,
+      like Preheat, and its heater in the follower's ThermalModel). Any
+      wait after the tool change (M109) is kept.
+
+    Sequential arguments:
+    follower -- A GCodeFollower that estimates the commands as they pass
+        through, including the inserted ones (A ThermalModel is
+        installed on it if it doesn't have one, See its
+        tool_change_seconds).
+
+    Keyword arguments:
+    standby_drop -- How many degrees below the printing temperature to
+        keep an idle tool.
+    max_lead -- The most seconds to look back (The commands within this
+        time since the last tool change or hotend command are held back
+        until the next tool change).
+
+    Public attributes:
+    standby_count -- How many standby commands were inserted.
+    reheat_count -- How many reheat commands were inserted.
+    saved_seconds -- The estimated reheating time at tool changes that
+        was moved to before them.
+    '''
+    def __init__(self, follower, standby_drop=40.0, max_lead=300.0):
+        self.follower = follower
+        if follower.thermalModel is None:
+            ThermalModel().install(follower)
+        self.standby_drop = standby_drop
+        self.max_lead = max_lead
+        self.standby_count = 0
+        self.reheat_count = 0
+        self.saved_seconds = 0.0
+
+    def _get_lead(self, pending, heater, target, now):
+        # Get (split, lead_s, needed_s) where split is the index in
+        # pending to start reheating before so that heater is ready at
+        # now (or 0), and needed_s is the heating time from there.
+        lead_s = 0.0
+        split = len(pending)
+        while True:
+            needed_s = ((target - heater.temperature_at(now - lead_s))
+                        * heater.sec_per_degree)
+            if (lead_s >= needed_s) or (split == 0):
+                return split, lead_s, needed_s
+            split -= 1
+            lead_s += pending[split][1]
+
+    def __call__(self, commands):
+        follower = self.follower
+        model = follower.thermalModel
+        printing = {}  # The printing temperature of each tool
+        pending = deque()  # (command, seconds) not yielded yet
+        pending_s = 0.0
+        idle = None  # (tool, standby) until the next extrusion
+        for command in commands:
+            function = command.function
+            old_tool = follower.emuState['tool']
+            if (idle is not None) and (function == "M104") and \
+                    (command.get('T') is not None) and \
+                    ("T" + command.get('T') == idle[0]):
+                try:
+                    target = float(command.get('S'))
+                except (TypeError, ValueError):
+                    target = None
+                if (target is not None) and (target < idle[1]):
+                    continue
+            if is_tool_change(command) and (function != old_tool):
+                now = follower._estS
+                target = printing.get(function)
+                heater = model.heater(function)
+                if (target is not None) and (heater.target < target):
+                    full_s = ((target - heater.temperature_at(now))
+                              * heater.sec_per_degree)
+                    split, lead_s, needed_s = self._get_lead(
+                        pending, heater, target, now,
+                    )
+                    for _ in range(split):
+                        yield pending.popleft()[0]
+                    reheat = ParsedCommand(
+                        "M104 {} S{:g}".format(function, target)
+                    )
+                    yield reheat
+                    self.reheat_count += 1
+                    heater.set_target(target, now - lead_s)
+                    self.saved_seconds += (full_s
+                                           - max(0.0, needed_s - lead_s))
+                while pending:
+                    yield pending.popleft()[0]
+                pending_s = 0.0
+                follower.addSec(command)
+                yield command
+                standby = printing.get(old_tool)
+                if standby is not None:
+                    standby -= self.standby_drop
+                if (standby is not None) and \
+                        (model.heater(old_tool).target > standby):
+                    standby_command = ParsedCommand(
+                        "M104 {} S{:g}".format(old_tool, standby)
+                    )
+                    follower.addSec(standby_command)
+                    self.standby_count += 1
+                    idle = (old_tool, standby)
+                    yield standby_command
+                continue
+            started_s = follower._estS
+            follower.addSec(command)
+            if (function in HOTEND_FUNCTIONS) or is_tool_change(command):
+                # Don't reheat before a command that may set the heater.
+                while pending:
+                    yield pending.popleft()[0]
+                pending_s = 0.0
+                yield command
+                continue
+            if (function in MOVE_FUNCTIONS) and command.has("E"):
+                tool = follower.emuState['tool']
+                printing[tool] = model.heater(tool).target
+                idle = None
+            seconds = follower._estS - started_s
+            pending.append((command, seconds))
+            pending_s += seconds
+            while pending_s - pending[0][1] >= self.max_lead:
+                old, old_s = pending.popleft()
+                pending_s -= old_s
+                yield old
+        while pending:
+            yield pending.popleft()[0]
+
+
+def usage():
+    echo0(__doc__)
+
+
+def main():
+    path = None
+    arc_tolerance = None
+    estimate = False
+    max_height = None
+    minify = False
+    preheat = False
+    precision_steps = None
+    simplify_tolerance = None
+    overlap_heating = False
+    standby_drop = None
+    thermal = False
+    for arg in sys.argv[1:]:
+        if arg == "--help":
+            usage()
+            return 0
+        elif arg == "--estimate":
+            estimate = True
+        elif arg == "--arcs":
+            arc_tolerance = 0.05
+        elif arg.startswith("--arcs="):
+            arc_tolerance = float(arg[len("--arcs="):])
+        elif arg == "--simplify":
+            simplify_tolerance = 0.02
+        elif arg.startswith("--simplify="):
+            simplify_tolerance = float(arg[len("--simplify="):])
+        elif arg == "--minify":
+            minify = True
+        elif arg == "--precision":
+            precision_steps = ()
+        elif arg.startswith("--precision="):
+            precision_steps = [float(value) for value
+                               in arg[len("--precision="):].split(",")]
+            if len(precision_steps) != 4:
+                usage()
+                logger.error("{} needs steps per mm for X, Y, Z and E."
+                             "".format(arg))
+                return 1
+        elif arg == "--preheat":
+            preheat = True
+        elif arg == "--overlap-heating":
+            overlap_heating = True
+        elif arg == "--thermal":
+            estimate = True
+            thermal = True
+        elif arg.startswith("--standby="):
+            standby_drop = float(arg[len("--standby="):])
+        elif arg.startswith("--max-height="):
+            max_height = float(arg[len("--max-height="):])
+        elif arg.startswith("--"):
+            usage()
+            logger.error("The argument {} is invalid.".format(arg))
+            return 1
+        elif path is None:
+            path = arg
+        else:
+            usage()
+            logger.error("There were too many arguments.")
+            return 1
+    stages = []
+    if max_height is not None:
+        tracker = LevelTracker()
+        stages += [tracker, Truncate(tracker, max_height=max_height)]
+    if estimate or preheat or overlap_heating or \
+            (standby_drop is not None):
+        from maniforge.gcodefollower import GCodeFollower
+    overlap = None
+    if overlap_heating:
+        from maniforge.gcodestart import HeaterOverlap
+        overlap = HeaterOverlap(GCodeFollower(echo_callback=echo0))
+        stages.append(overlap)
+    standby = None
+    if standby_drop is not None:
+        standby = ToolStandby(GCodeFollower(echo_callback=echo0),
+                              standby_drop=standby_drop)
+        stages.append(standby)
+    preheater = None
+    if preheat:
+        preheater = Preheat(GCodeFollower(echo_callback=echo0))
+        stages.append(preheater)
+    welder = None
+    if arc_tolerance is not None:
+        from maniforge.gcodearc import ArcWelder
+        welder = ArcWelder(tolerance=arc_tolerance)
+        stages.append(welder)
+    simplifier = None
+    if simplify_tolerance is not None:
+        from maniforge.gcodesimplify import Simplifier
+        simplifier = Simplifier(tolerance=simplify_tolerance)
+        stages.append(simplifier)
+    minifier = None
+    if minify:
+        from maniforge.gcodeminify import Minifier
+        minifier = Minifier()
+        stages.append(minifier)
+    trimmer = None
+    if precision_steps is not None:
+        from maniforge.gcodeprecision import PrecisionTrimmer
+        if precision_steps:
+            trimmer = PrecisionTrimmer(steps_per_unit=precision_steps)
+        else:
+            trimmer = PrecisionTrimmer()
+        stages.append(trimmer)
+    tap = None
+    if estimate:
+        follower = GCodeFollower(echo_callback=echo0)
+        if thermal:
+            from maniforge.gcodethermal import ThermalModel
+            ThermalModel().install(follower)
+        tap = EstimateTap(follower)
+        stages.append(tap)
+    if path is None:
+        run_pipeline(sys.stdin, sys.stdout, stages)
+    else:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as outs:
+            run_pipeline(path, outs, stages)
+        shutil.move(tmp_path, path)
+    if overlap is not None:
+        echo0("moved {} wait(s) and started {} heater(s) early saving"
+              " about {}"
+              "".format(overlap.moved_count, overlap.started_count,
+                        getHMSMessageFromS(overlap.saved_seconds)))
+    if standby is not None:
+        echo0("set an idle tool to standby {} time(s) and reheated {}"
+              " time(s) early saving about {}"
+              "".format(standby.standby_count, standby.reheat_count,
+                        getHMSMessageFromS(standby.saved_seconds)))
+    if preheater is not None:
+        echo0("preheated {} time(s) (kept {} M109) saving about {}"
+              "".format(preheater.preheat_count, preheater.wait_count,
+                        getHMSMessageFromS(preheater.saved_seconds)))
+    if welder is not None:
+        echo0("welded {} G1 command(s) into {} arc(s): {} to {} lines"
+              " ({} to {} bytes)"
+              "".format(welder.welded_count, welder.arc_count,
+                        welder.input_count, welder.output_count,
+                        welder.input_bytes, welder.output_bytes))
+    if simplifier is not None:
+        echo0("merged {} G1 command(s): {} to {} lines ({} to {} bytes)"
+              "".format(simplifier.removed_count, simplifier.input_count,
+                        simplifier.output_count, simplifier.input_bytes,
+                        simplifier.output_bytes))
+    if minifier is not None:
+        for line in minifier.report():
+            echo0("minify {}".format(line))
+        echo0("minified {} to {} lines ({} to {} bytes)"
+              "".format(minifier.input_count, minifier.output_count,
+                        minifier.input_bytes, minifier.output_bytes))
+    if trimmer is not None:
+        echo0("trimmed {} value(s) (carried {}): {} to {} bytes"
+              "".format(trimmer.trimmed_count, trimmer.carried_count,
+                        trimmer.input_bytes, trimmer.output_bytes))
+    if tap is not None:
+        tap.follower.diagnostics.report(echo=echo0)
+        echo0("estimated print time: {}"
+              "".format(getHMSMessageFromS(tap.seconds)))
+        model = tap.follower.thermalModel
+        if model is not None:
+            echo0("waiting for tools to heat after {} tool change(s): {}"
+                  "".format(model.tool_change_count,
+                            getHMSMessageFromS(model.tool_change_seconds)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,595 @@
+'''
+gcodeplan
+---------
+part of maniforge by Poikilos
+
+Save what GCodeFollower._generateTower did to a template (a "tower
+plan") so that generating the tower again with a different temperature
+range doesn't require parsing the template again.
+
+Only the number of temperatures (not the temperatures) affects where
+the levels start, which line is the initial temperature command, and
+where the tower is truncated, so a plan is saved for each number of
+temperatures, and the temperatures are filled in when it is applied.
+'''
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import json
+import mmap
+import os
+import sys
+
+from decimal import Decimal
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodeindex import (
+    file_sha1,
+    stat_mtime_ns,
+)
+from maniforge.mfgcode import (
+    ParsedCommand,
+    map_gcode_file,
+)
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20  # Copy this many bytes at a time (See copy_range)
+
+_copy_file_range = getattr(os, 'copy_file_range', None)
+_sendfile = getattr(os, 'sendfile', None)
+
+# Commands where the estimated time depends on the temperature (or
+# tool) state, which may differ for each temperature range:
+TEMPERATURE_FUNCTIONS = ("M104", "M109", "M140", "M190", "G28")
+
+
+def tower_plan_path(path):
+    '''
+    Get the path of the sidecar file where the tower plans for a
+    template are saved.
+    '''
+    return path + ".tower.json"
+
+
+def is_temperature_command(function):
+    if function is None:
+        return False
+    return (function in TEMPERATURE_FUNCTIONS) or function.startswith("T")
+
+
+class TowerPlan(object):
+    '''
+    The output of _generateTower and the parts of the estimate that
+    depend on the temperatures, for one template and one number of
+    temperatures.
+
+    Public attributes:
+    segments -- The output in order, where each segment is one of:
+        - ["copy", start, end]: Copy template bytes from start to end.
+        - ["lines", start, end, strip]: Copy the template lines from
+          start to end the way they are written unchanged (See
+          normalize_line), such as if the template has "\r\n"
+          newlines.
+        - ["text", text]: Write text.
+        - ["slot", level, fmt]: Write fmt.format(temperatures[level]).
+    events -- Replay these to estimate the print time:
+        - ["sec", seconds]: Add time that doesn't depend on temperature.
+        - ["line", line]: Pass the line to addSec.
+        - ["slot", level, fmt]: Pass fmt.format(temperatures[level]) to
+          addSec.
+        - ["stop"]: The tower ends here (extrusion time is known).
+    new_line_count -- How many lines were inserted.
+    line_count -- How many lines the template has.
+    stats, stats_lines -- The follower's stats at the end (See
+        GCodeFollower.setStat), which don't depend on the temperatures.
+    emu_state -- The follower's emuState at the end (The temperatures
+        are set by replaying events instead, See restore).
+    '''
+    def __init__(self, segments=None, events=None, new_line_count=0,
+                 line_count=-1, stats=None, stats_lines=None,
+                 emu_state=None):
+        self.segments = segments if segments is not None else []
+        self.events = events if events is not None else []
+        self.new_line_count = new_line_count
+        self.line_count = line_count
+        self.stats = stats if stats is not None else {}
+        self.stats_lines = stats_lines if stats_lines is not None else {}
+        self.emu_state = emu_state
+
+    def to_dict(self):
+        return {
+            'segments': self.segments,
+            'events': self.events,
+            'new_line_count': self.new_line_count,
+            'line_count': self.line_count,
+            'stats': {name: encode_stat(value)
+                      for name, value in self.stats.items()},
+            'stats_lines': self.stats_lines,
+            'emu_state': self.emu_state,
+        }
+
+    @staticmethod
+    def from_dict(meta):
+        return TowerPlan(
+            segments=meta['segments'],
+            events=meta['events'],
+            new_line_count=meta.get('new_line_count', 0),
+            line_count=meta.get('line_count', -1),
+            stats={name: decode_stat(value)
+                   for name, value in meta.get('stats', {}).items()},
+            stats_lines=meta.get('stats_lines'),
+            emu_state=meta.get('emu_state'),
+        )
+
+    def record(self, follower):
+        '''
+        Save the stats and emuState of follower at the end of the tower
+        (See restore).
+        '''
+        self.stats = dict(follower.stats)
+        self.stats_lines = dict(follower.stats_lines)
+        self.emu_state = copy.deepcopy(follower.emuState)
+
+    def restore(self, follower):
+        '''
+        Set the stats and emuState of follower to what they were at the
+        end of the tower that this plan was recorded from. Call estimate
+        first, since the temperatures (and the tool) are kept from
+        replaying the temperature commands with the new temperatures.
+        '''
+        follower.stats = dict(self.stats)
+        follower.stats_lines = dict(self.stats_lines)
+        if self.emu_state is None:
+            return
+        replayed = follower.emuState
+        emu_state = copy.deepcopy(self.emu_state)
+        emu_state['bed_temperature'] = replayed.get('bed_temperature')
+        emu_state['tool'] = replayed['tool']
+        tools = emu_state['tools']
+        for tool, tool_state in replayed['tools'].items():
+            if tool not in tools:
+                tools[tool] = {}
+            tools[tool]['temperature'] = tool_state.get('temperature')
+        for tool_state in tools.values():
+            if 'offsets' in tool_state:
+                tool_state['offsets'] = tuple(tool_state['offsets'])
+                # ^ a list if loaded from JSON
+        follower.emuState = emu_state
+
+    def stops(self):
+        '''
+        Check whether the tower is truncated (See "stop" in events).
+        '''
+        for event in self.events:
+            if event[0] == "stop":
+                return True
+        return False
+
+    def write(self, template_path, outs, temperatures):
+        '''
+        Write the tower to outs using the template and temperatures.
+        '''
+        with map_gcode_file(template_path) as buffer:
+            for segment in self.segments:
+                kind = segment[0]
+                if kind == "copy":
+                    outs.write(
+                        buffer[segment[1]:segment[2]].decode("utf-8")
+                    )
+                elif kind == "lines":
+                    outs.write(normalize_lines(
+                        buffer[segment[1]:segment[2]], segment[3]
+                    ).decode("utf-8"))
+                elif kind == "text":
+                    outs.write(segment[1])
+                else:
+                    outs.write(segment[2].format(temperatures[segment[1]]))
+
+    def write_file(self, template_path, path, temperatures):
+        '''
+        Write the tower to a new file at path. The parts copied from the
+        template are copied by the OS (See copy_range) rather than
+        decoded and written line by line, so only the changed lines are
+        handled by Python (and "lines" segments are only read and
+        normalized as bytes).
+
+        If the platform's text mode changes newlines (Windows), the
+        tower is written in text mode instead (See write) so the output
+        is the same as if each line were written separately.
+        '''
+        if os.linesep != "\n":
+            with open(path, 'w') as outs:
+                self.write(template_path, outs, temperatures)
+            return
+        pending = []  # Changed lines (bytes) not written yet
+        with open(template_path, 'rb') as ins:
+            with open(path, 'wb', buffering=0) as outs:
+                for segment in self.segments:
+                    kind = segment[0]
+                    if kind == "copy":
+                        if pending:
+                            write_all(outs.fileno(), b"".join(pending))
+                            pending = []
+                        copy_range(ins.fileno(), outs.fileno(),
+                                   segment[1], segment[2] - segment[1])
+                    elif kind == "lines":
+                        ins.seek(segment[1])
+                        pending.append(normalize_lines(
+                            ins.read(segment[2] - segment[1]), segment[3]
+                        ))
+                    elif kind == "text":
+                        pending.append(segment[1].encode("utf-8"))
+                    else:
+                        pending.append(
+                            segment[2].format(temperatures[segment[1]])
+                            .encode("utf-8")
+                        )
+                if pending:
+                    write_all(outs.fileno(), b"".join(pending))
+
+    def estimate(self, follower, temperatures):
+        '''
+        Add the estimated time to follower._estS (and set
+        follower._extrudeS at the end of the tower) the same way as
+        _generateTower.
+        '''
+        for event in self.events:
+            kind = event[0]
+            if kind == "sec":
+                follower._estS += event[1]
+            elif kind == "line":
+                follower.addSec(event[1])
+            elif kind == "slot":
+                follower.addSec(event[2].format(temperatures[event[1]]))
+            else:
+                follower._extrudeS = follower._estS
+
+
+def normalize_line(data, strip):
+    '''
+    Get a line of the template (bytes) the way _generateTower writes it
+    unchanged: With "\r\n" written as "\n" (as in text mode), or if
+    strip, without trailing whitespace and with "\n" at the end.
+    '''
+    if strip:
+        return data.rstrip() + b"\n"
+    if data.endswith(b"\r\n"):
+        return data[:-2] + b"\n"
+    return data
+
+
+def normalize_lines(data, strip):
+    '''
+    Normalize each line of data (bytes of whole template lines, See
+    normalize_line).
+    '''
+    results = []
+    start = 0
+    size = len(data)
+    while start < size:
+        end = data.find(b"\n", start)
+        end = size if end < 0 else end + 1
+        results.append(normalize_line(data[start:end], strip))
+        start = end
+    return b"".join(results)
+
+
+def line_segment(text, start, original_bytes):
+    '''
+    Get the segment (See TowerPlan) that writes text for the template
+    line original_bytes at offset start: A "copy" or "lines" segment if
+    text is the line written unchanged, otherwise a "text" segment.
+    '''
+    data = text.encode("utf-8")
+    end = start + len(original_bytes)
+    if data == original_bytes:
+        return ["copy", start, end]
+    for strip in (True, False):
+        if data == normalize_line(original_bytes, strip):
+            return ["lines", start, end, strip]
+    return ["text", text]
+
+
+def add_segment(segments, segment):
+    '''
+    Append segment to segments (See TowerPlan), or extend the last
+    segment if segment continues it.
+    '''
+    previous = segments[-1] if segments else None
+    if (previous is not None) and (previous[0] == segment[0]):
+        if segment[0] == "text":
+            previous[1] += segment[1]
+            return
+        elif ((segment[0] in ("copy", "lines"))
+                and (previous[2] == segment[1])
+                and (previous[3:] == segment[3:])):
+            previous[2] = segment[2]
+            return
+    segments.append(list(segment))
+
+
+def encode_stat(value):
+    '''
+    Get a stat value (See GCodeFollower.setStat) in a form that can be
+    saved as JSON, such as {"Decimal": "0.2"} for a Decimal.
+    '''
+    if isinstance(value, Decimal):
+        return {'Decimal': str(value)}
+    return value
+
+
+def decode_stat(value):
+    '''
+    Get a stat value saved by encode_stat.
+    '''
+    if isinstance(value, dict):
+        return Decimal(value['Decimal'])
+    return value
+
+
+def write_all(fd, data):
+    '''
+    Write all of data to the file descriptor fd (at its position).
+    '''
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    '''
+    Copy count bytes starting at offset in src_fd to the position of
+    dst_fd (and move that position forward) without reading them into
+    Python if possible: os.copy_file_range (Linux, Python 3.8+) is
+    tried first, then os.sendfile, then a memory map of src_fd is
+    written (in CHUNK_SIZE slices).
+    '''
+    global _copy_file_range
+    global _sendfile
+    end = offset + count
+    if _copy_file_range is not None:
+        try:
+            while offset < end:
+                copied = _copy_file_range(src_fd, dst_fd, end - offset,
+                                          offset)
+                if copied == 0:
+                    break  # The source is shorter than expected.
+                offset += copied
+            if offset >= end:
+                return
+        except OSError as ex:
+            # such as EXDEV (on Linux < 5.3 if on different file
+            # systems) or ENOSYS
+            logger.info("copy_file_range isn't usable so sendfile will"
+                        " be tried: {}".format(ex))
+            _copy_file_range = None
+    if _sendfile is not None:
+        try:
+            while offset < end:
+                copied = _sendfile(dst_fd, src_fd, offset, end - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            if offset >= end:
+                return
+        except OSError as ex:
+            logger.info("sendfile isn't usable so the file will be"
+                        " copied by slices: {}".format(ex))
+            _sendfile = None
+    if offset >= end:
+        return
+    buffer = mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(buffer)
+        try:
+            while offset < end:
+                chunk_end = min(offset + CHUNK_SIZE, end)
+                write_all(dst_fd, view[offset:chunk_end])
+                offset = chunk_end
+        finally:
+            view.release()
+    finally:
+        buffer.close()
+
+
+class TowerPlanRecorder(object):
+    '''
+    Record a TowerPlan of what is written (and write it to stream if
+    not None).
+
+    Call source before writing each line of the template so that a line
+    written unchanged is recorded as a copy of the template.
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.plan = TowerPlan()
+        self._offset = None
+        self._original = None
+        self._mark = 0.0
+
+    def source(self, offset, original_bytes):
+        self._offset = offset
+        self._original = original_bytes
+
+    def write(self, text):
+        if self.stream is not None:
+            self.stream.write(text)
+        if self._original is not None:
+            segment = line_segment(text, self._offset, self._original)
+            if segment[0] != "text":
+                self._original = None  # Only copy the source line once.
+        else:
+            segment = ["text", text]
+        add_segment(self.plan.segments, segment)
+
+    def write_segments(self, segments):
+        '''
+        Write output that is already in the form of TowerPlan segments
+        ("copy", "lines" or "text", such as from a
+        maniforge.gcodeparallel.LineRun). It can't be written to stream
+        since the template isn't available here.
+        '''
+        if self.stream is not None:
+            raise ValueError("write_segments can't write to a stream.")
+        self._original = None
+        for segment in segments:
+            add_segment(self.plan.segments, segment)
+
+    def write_slot(self, text, level, fmt):
+        '''
+        Write a temperature line (text) that is fmt.format(temperature)
+        where temperature is the temperature of the level.
+        '''
+        if self.stream is not None:
+            self.stream.write(text)
+        self.plan.segments.append(["slot", level, fmt])
+
+    def add_sec(self, follower, gcodeLine, slot=None):
+        '''
+        Call follower.addSec and record the change to the estimate.
+
+        Keyword arguments:
+        slot -- (level, fmt) if gcodeLine is the temperature of a level
+            (See TowerPlan).
+        '''
+        if isinstance(gcodeLine, ParsedCommand):
+            meta = gcodeLine
+        else:
+            meta = ParsedCommand(gcodeLine.strip())
+        if (slot is None) and not is_temperature_command(meta.function):
+            follower.addSec(meta)
+            return
+        self._flush_sec(follower)
+        follower.addSec(meta)
+        if slot is not None:
+            self.plan.events.append(["slot", slot[0], slot[1]])
+        else:
+            self.plan.events.append(["line", meta.line])
+        self._mark = follower._estS
+
+    def stop(self, follower):
+        '''
+        Record that the tower ends here (See TowerPlan).
+        '''
+        self._flush_sec(follower)
+        self.plan.events.append(["stop"])
+
+    def finish(self, follower, new_line_count, line_count=-1):
+        self._flush_sec(follower)
+        self.plan.new_line_count = new_line_count
+        self.plan.line_count = line_count
+        self.plan.record(follower)
+        return self.plan
+
+    def _flush_sec(self, follower):
+        seconds = follower._estS - self._mark
+        if seconds:
+            self.plan.events.append(["sec", seconds])
+        self._mark = follower._estS
+
+
+class TowerPlans(object):
+    '''
+    The TowerPlan for each number of temperatures that was generated
+    from a template (See tower_plan_path).
+
+    Public attributes:
+    key -- Settings that affect every plan (such as heights).
+    plans -- A dict where the key is the number of temperatures (as a
+        str since it is saved as JSON) and the value is a TowerPlan.
+    size, mtime_ns, sha1 -- The template these are for.
+    '''
+    VERSION = 2
+
+    def __init__(self, key, size=None, mtime_ns=None, sha1=None,
+                 plans=None):
+        self.key = key
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.sha1 = sha1
+        self.plans = plans if plans is not None else {}
+
+    def get(self, temperature_count):
+        return self.plans.get(str(temperature_count))
+
+    def set(self, temperature_count, plan):
+        self.plans[str(temperature_count)] = plan
+
+    def to_dict(self):
+        return {
+            'version': TowerPlans.VERSION,
+            'key': self.key,
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'sha1': self.sha1,
+            'plans': {count: plan.to_dict()
+                      for count, plan in self.plans.items()},
+        }
+
+    @staticmethod
+    def from_dict(meta):
+        if meta.get('version') != TowerPlans.VERSION:
+            return None
+        return TowerPlans(
+            meta['key'],
+            size=meta.get('size'),
+            mtime_ns=meta.get('mtime_ns'),
+            sha1=meta.get('sha1'),
+            plans={count: TowerPlan.from_dict(plan)
+                   for count, plan in meta['plans'].items()},
+        )
+
+
+def load_tower_plans(path, key):
+    '''
+    Load the saved tower plans for the template at path if they were
+    made with the same key and the template didn't change (by size and
+    modified time, otherwise by content hash). Otherwise, get new empty
+    TowerPlans for the template.
+    '''
+    stat = os.stat(path)
+    plans = None
+    plans_path = tower_plan_path(path)
+    if os.path.isfile(plans_path):
+        try:
+            with open(plans_path, 'r') as ins:
+                plans = TowerPlans.from_dict(json.load(ins))
+        except (ValueError, KeyError, IndexError) as ex:
+            logger.warning('WARNING: "{}" will be replaced since it is not'
+                           ' readable: {}'.format(plans_path, ex))
+    sha1 = None
+    if (plans is not None) and (plans.key == key) and \
+            (plans.size == stat.st_size):
+        if plans.mtime_ns == stat_mtime_ns(stat):
+            return plans
+        sha1 = file_sha1(path)
+        if sha1 == plans.sha1:
+            plans.mtime_ns = stat_mtime_ns(stat)
+            return plans
+    if sha1 is None:
+        sha1 = file_sha1(path)
+    return TowerPlans(key, size=stat.st_size, mtime_ns=stat_mtime_ns(stat),
+                      sha1=sha1)
+
+
+def save_tower_plans(path, plans):
+    '''
+    Save the tower plans for the template at path next to it (See
+    tower_plan_path). If that is not possible, only log a warning.
+    '''
+    plans_path = tower_plan_path(path)
+    try:
+        with open(plans_path, 'w') as outs:
+            json.dump(plans.to_dict(), outs)
+    except (IOError, OSError) as ex:
+        logger.warning('WARNING: The tower plan could not be saved to'
+                       ' "{}": {}'.format(plans_path, ex))
+        return False
+    return True
@@ -0,0 +1,451 @@
+'''
+gcodeplanner
+------------
+part of maniforge by Poikilos
+
+Estimate the print time of a G-code file by modeling the motion planner
+of the firmware (acceleration, junction deviation or jerk, and the
+lookahead buffer) instead of assuming each move runs at full speed, and
+get the limits from the Marlin configuration (See
+PlannerLimits.from_marlininfo).
+
+The forward and backward planner passes are done for the whole file at
+once using numpy: Each pass limits the entry speed of a block to what is
+reachable from the next (or previous) block, which for the squared speed
+is v[i] = min(limit[i], v[i+1] + 2*a*d) (a min-plus recurrence), so
+subtracting the running sum of 2*a*d turns it into a running minimum
+(numpy.minimum.accumulate).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodearc import arc_lengths
+from maniforge.gcodeestimate import add_event_sec
+from maniforge.mfgcode import (
+    GCodeTable,
+    np,
+    parse_gcode_table,
+)
+
+logger = getLogger(__name__)
+
+AXES = ("X", "Y", "Z", "E")
+
+PLANNED_MOVE_FUNCTIONS = ("G0", "G1") + GCodeTable.ARC_FUNCTIONS
+# ^ An arc is planned as one block with its arc length as the distance
+#   (The firmware splits it into short segments, so the speed at each
+#   junction with it is only approximated from its chord).
+
+# Functions after which the planner is empty (The next move starts from
+# a stop):
+SYNC_FUNCTIONS = ("G4", "G28", "G29", "M0", "M1", "M109", "M190", "M400")
+
+# The minimum junction speed in Marlin (Configuration_adv.h):
+MINIMUM_PLANNER_SPEED = 0.05
+
+# Marlin starts with this feed rate (mm/min) until F is set:
+DEFAULT_FEED_RATE = 1500.0
+
+
+def parse_c_number(value):
+    '''
+    Get a float from a C #define value such as "2000", "0.013f", or
+    "(60*60)", or None if the value is not a number.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).split("//")[0].strip()
+    if value.endswith(("f", "F")):
+        value = value[:-1]
+    value = value.strip("() ")
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = value.split("*")
+    if len(parts) < 2:
+        return None
+    result = 1.0
+    for part in parts:
+        number = parse_c_number(part)
+        if number is None:
+            return None
+        result *= number
+    return result
+
+
+def parse_c_array(value):
+    '''
+    Get a list of floats from a C array #define value such as
+    "{ 200, 200, 5, 25 }", or None if any element is not a number.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        parts = value
+    else:
+        value = str(value).split("//")[0].strip()
+        if not (value.startswith("{") and value.endswith("}")):
+            return None
+        parts = value[1:-1].split(",")
+    results = []
+    for part in parts:
+        number = parse_c_number(part)
+        if number is None:
+            return None
+        results.append(number)
+    return results
+
+
+class PlannerLimits(object):
+    '''
+    The motion limits that the planner estimate uses. The defaults are
+    the defaults from Marlin 2's Configuration.h and
+    Configuration_adv.h.
+
+    Public attributes:
+    max_feed_rate -- The maximum speed of X, Y, Z & E in mm/s
+        (DEFAULT_MAX_FEEDRATE).
+    max_acceleration -- The maximum acceleration of X, Y, Z & E in
+        mm/s^2 (DEFAULT_MAX_ACCELERATION).
+    acceleration -- The acceleration for printing moves
+        (DEFAULT_ACCELERATION).
+    retract_acceleration -- The acceleration for moves that only move E
+        (DEFAULT_RETRACT_ACCELERATION).
+    travel_acceleration -- The acceleration for moves that don't move E
+        (DEFAULT_TRAVEL_ACCELERATION).
+    junction_deviation -- The junction deviation in mm
+        (JUNCTION_DEVIATION_MM), or None to use jerk.
+    jerk -- The maximum instant change in speed of X, Y, Z & E in mm/s
+        (DEFAULT_XJERK etc., only used if junction_deviation is None).
+    block_buffer_size -- How many moves the planner looks ahead
+        (BLOCK_BUFFER_SIZE).
+    minimum_planner_speed -- The lowest junction speed in mm/s
+        (MINIMUM_PLANNER_SPEED).
+    '''
+    def __init__(self):
+        self.max_feed_rate = [300.0, 300.0, 5.0, 25.0]
+        self.max_acceleration = [3000.0, 3000.0, 100.0, 10000.0]
+        self.acceleration = 3000.0
+        self.retract_acceleration = 3000.0
+        self.travel_acceleration = 3000.0
+        self.junction_deviation = 0.013
+        self.jerk = [10.0, 10.0, 0.3, 5.0]
+        self.block_buffer_size = 16
+        self.minimum_planner_speed = MINIMUM_PLANNER_SPEED
+
+    @staticmethod
+    def from_marlininfo(marlininfo):
+        '''
+        Get the limits from a Marlin configuration. Any setting that is
+        not defined (or not a number) keeps the Marlin default.
+
+        Sequential arguments:
+        marlininfo -- A maniforge.marlininfo.MarlinInfo (or any object
+            with the same get_cached_c and optionally get_cached_c_a
+            methods).
+        '''
+        limits = PlannerLimits()
+
+        def get(name, adv=False):
+            get_cached = marlininfo.get_cached_c
+            if adv:
+                get_cached = getattr(marlininfo, 'get_cached_c_a', None)
+                if get_cached is None:
+                    return None
+            v, line_n, got_name, err = get_cached(name)
+            if err is not None:
+                # Such as if the #define is commented.
+                return None
+            return v
+
+        def get_axes(name, default):
+            values = parse_c_array(get(name))
+            if values is None:
+                return default
+            if len(values) < len(AXES):
+                logger.warning("WARNING: {} only has {} value(s)."
+                               "".format(name, len(values)))
+                return default
+            return values[:len(AXES)]
+            # ^ Marlin uses the first E value for any extruder unless
+            #   DISTINCT_E_FACTORS is enabled.
+
+        def get_number(name, default, adv=False):
+            value = parse_c_number(get(name, adv=adv))
+            if value is None:
+                return default
+            return value
+
+        limits.max_feed_rate = get_axes('DEFAULT_MAX_FEEDRATE',
+                                        limits.max_feed_rate)
+        limits.max_acceleration = get_axes('DEFAULT_MAX_ACCELERATION',
+                                           limits.max_acceleration)
+        limits.acceleration = get_number('DEFAULT_ACCELERATION',
+                                         limits.acceleration)
+        limits.retract_acceleration = get_number(
+            'DEFAULT_RETRACT_ACCELERATION',
+            limits.retract_acceleration,
+        )
+        limits.travel_acceleration = get_number(
+            'DEFAULT_TRAVEL_ACCELERATION',
+            limits.travel_acceleration,
+        )
+        limits.jerk = [
+            get_number('DEFAULT_{}JERK'.format(axis), limits.jerk[i])
+            for i, axis in enumerate(AXES)
+        ]
+        if get('CLASSIC_JERK') is not None:
+            limits.junction_deviation = None
+        else:
+            limits.junction_deviation = get_number(
+                'JUNCTION_DEVIATION_MM',
+                limits.junction_deviation,
+                adv=True,
+            )
+            limits.junction_deviation = get_number(
+                'JUNCTION_DEVIATION_MM',
+                limits.junction_deviation,
+            )
+            # ^ Configuration.h in Marlin 2.1, otherwise
+            #   Configuration_adv.h.
+        limits.block_buffer_size = int(get_number(
+            'BLOCK_BUFFER_SIZE',
+            limits.block_buffer_size,
+            adv=True,
+        ))
+        limits.minimum_planner_speed = get_number(
+            'MINIMUM_PLANNER_SPEED',
+            limits.minimum_planner_speed,
+            adv=True,
+        )
+        return limits
+
+
+def _positions(table, is_move, relative):
+    '''
+    Get the position of each axis (See AXES) after each row of table as
+    a (rows, 4) array. G92 sets a position without moving.
+
+    Sequential arguments:
+    table -- A GCodeTable.
+    is_move -- A mask of rows that move.
+    relative -- A (rows, 4) mask where each axis is in relative mode.
+    '''
+    row_count = len(table)
+    is_set = table.function_mask("G92")
+    rows = np.arange(row_count)
+    results = np.empty((row_count, len(AXES)))
+    for axis_i, axis in enumerate(AXES):
+        values = table.column(axis)
+        present = ~np.isnan(values)
+        offsets = present & is_move & relative[:, axis_i]
+        absolute = present & (is_set | (is_move & ~relative[:, axis_i]))
+        total = np.cumsum(np.where(offsets, values, 0.0))
+        last_set = np.where(absolute, rows, -1)
+        np.maximum.accumulate(last_set, out=last_set)
+        base = np.where(last_set >= 0,
+                        values[last_set] - total[last_set], 0.0)
+        results[:, axis_i] = base + total
+    return results
+
+
+def _modes(table, relative_functions, absolute_functions):
+    '''
+    Get a mask of rows after which the mode is relative.
+    '''
+    mode = np.full(len(table), np.nan)
+    mode[table.function_mask(*absolute_functions)] = 0.0
+    mode[table.function_mask(*relative_functions)] = 1.0
+    return GCodeTable.forward_fill(mode, initial=0.0) == 1.0
+
+
+def plan_table(table, limits):
+    '''
+    Estimate how long each move in table takes using a trapezoidal
+    speed profile (accelerate, cruise, decelerate) for each block like
+    the planner in Marlin does.
+
+    Sequential arguments:
+    table -- A GCodeTable (See parse_gcode_table).
+    limits -- A PlannerLimits.
+
+    Returns:
+    numpy.ndarray: The seconds for each row (0 for rows that don't
+        move).
+    '''
+    row_count = len(table)
+    is_move = table.function_mask(*PLANNED_MOVE_FUNCTIONS)
+    relative = np.empty((row_count, len(AXES)), dtype=bool)
+    xyz_relative = _modes(table, ("G91",), ("G90",))
+    # ^ The mode is for the following rows, but G90 & G91 don't move.
+    for axis_i in range(3):
+        relative[:, axis_i] = xyz_relative
+    relative[:, 3] = _modes(table, ("G91", "M83"), ("G90", "M82"))
+    positions = _positions(table, is_move, relative)
+    deltas = np.diff(positions, axis=0, prepend=np.zeros((1, len(AXES))))
+    xyz = np.sqrt(np.sum(deltas[:, :3] ** 2, axis=1))
+    arcs = np.flatnonzero(table.function_mask(*GCodeTable.ARC_FUNCTIONS))
+    if len(arcs):
+        ends = positions[arcs]
+        starts = ends - deltas[arcs]
+        xyz[arcs] = np.nan_to_num(arc_lengths(
+            starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1],
+            table.I[arcs], table.J[arcs], table.R[arcs],
+            table.function_mask("G2")[arcs], deltas[arcs, 2],
+        ))
+    e_only = (xyz == 0) & (deltas[:, 3] != 0)
+    block_rows = np.flatnonzero(is_move & ((xyz > 0) | e_only))
+    seconds = np.zeros(row_count)
+    if not len(block_rows):
+        return seconds
+
+    # Each block:
+    d = deltas[block_rows]
+    e_only = e_only[block_rows]
+    distance = np.where(e_only, np.abs(d[:, 3]), xyz[block_rows])
+    abs_d = np.abs(d)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        units = d / distance[:, None]
+        units[~e_only, 3] = 0.0
+        # ^ Like Marlin, the direction of a move is only XYZ unless
+        #   the move only moves E.
+        feed = GCodeTable.forward_fill(
+            np.where(is_move, table.F, np.nan),
+            initial=DEFAULT_FEED_RATE,
+        )[block_rows] / 60.0
+        axis_time = abs_d / np.array(limits.max_feed_rate)
+        nominal = np.minimum(feed, distance / np.max(axis_time, axis=1))
+        # ^ Limit the speed so that no axis exceeds its maximum.
+        acceleration = np.where(
+            e_only,
+            limits.retract_acceleration,
+            np.where(d[:, 3] == 0, limits.travel_acceleration,
+                     limits.acceleration),
+        )
+        axis_limits = (np.array(limits.max_acceleration)
+                       * distance[:, None] / abs_d)
+        acceleration = np.minimum(acceleration, np.min(axis_limits, axis=1))
+
+    # The maximum (squared) entry speed of each block at the junction
+    # with the previous block:
+    count = len(block_rows)
+    previous_units = np.vstack((np.zeros((1, len(AXES))), units[:-1]))
+    previous_nominal = np.concatenate(([0.0], nominal[:-1]))
+    minimum_sq = limits.minimum_planner_speed ** 2
+    if limits.junction_deviation is not None:
+        cos_theta = -np.sum(previous_units * units, axis=1)
+        sin_theta_d2 = np.sqrt(
+            0.5 * (1.0 - np.clip(cos_theta, -0.999999, 0.999999))
+        )
+        junction_sq = (acceleration * limits.junction_deviation
+                       * sin_theta_d2 / (1.0 - sin_theta_d2))
+        junction_sq = np.where(cos_theta > 0.999999, minimum_sq,
+                               np.maximum(junction_sq, minimum_sq))
+    else:
+        # Classic jerk: The speed at which the instant change in the
+        # speed of any axis is its jerk.
+        change = np.abs(previous_units - units)
+        with np.errstate(divide='ignore'):
+            junction = np.min(np.array(limits.jerk) / change, axis=1)
+        junction_sq = np.maximum(junction, limits.minimum_planner_speed) ** 2
+    junction_sq = np.minimum(junction_sq,
+                             np.minimum(previous_nominal, nominal) ** 2)
+
+    # The planner stops at the start and at commands that wait:
+    syncs = np.cumsum(table.function_mask(*SYNC_FUNCTIONS))[block_rows]
+    starts = np.ones(count, dtype=bool)
+    starts[1:] = syncs[1:] != syncs[:-1]
+    junction_sq[starts] = 0.0
+
+    # The most the speed (squared) can change during each block:
+    change_sq = 2.0 * acceleration * distance
+    totals = np.concatenate(([0.0], np.cumsum(change_sq)))
+
+    # The lookahead buffer: The planner can only plan to stop by the end
+    # of the last buffered block.
+    buffer_size = max(limits.block_buffer_size, 1)
+    ends = np.minimum(np.arange(count) + buffer_size, count)
+    entry_sq = np.minimum(junction_sq, totals[ends] - totals[:-1])
+
+    # Backward pass: entry_sq[i] <= entry_sq[i+1] + change_sq[i], with
+    # the last block ending stopped.
+    after = totals[-1] - totals  # The sum of change_sq from i onward.
+    limited = np.append(entry_sq - after[:-1], 0.0)
+    entry_sq = (np.minimum.accumulate(limited[::-1])[::-1]
+                + after)[:-1]
+    # Forward pass: entry_sq[i+1] <= entry_sq[i] + change_sq[i]
+    before = totals[:-1]  # The sum of change_sq before i.
+    entry_sq = np.minimum.accumulate(entry_sq - before) + before
+    entry_sq = np.maximum(entry_sq, 0.0)
+    # ^ (Negative values are only rounding errors)
+    exit_sq = np.append(entry_sq[1:], 0.0)
+
+    # The time of each trapezoid (or triangle if the block is too short
+    # to reach the nominal speed):
+    nominal_sq = nominal ** 2
+    accelerate = (nominal_sq - entry_sq) / (2.0 * acceleration)
+    decelerate = (nominal_sq - exit_sq) / (2.0 * acceleration)
+    cruise = distance - accelerate - decelerate
+    entry = np.sqrt(entry_sq)
+    exit = np.sqrt(exit_sq)
+    peak = np.where(
+        cruise >= 0,
+        nominal,
+        np.sqrt(np.maximum(
+            (change_sq + entry_sq + exit_sq) / 2.0,
+            np.maximum(entry_sq, exit_sq),
+        )),
+    )
+    times = ((peak - entry) / acceleration + (peak - exit) / acceleration
+             + np.maximum(cruise, 0.0) / nominal)
+    seconds[block_rows] = times
+    return seconds
+
+
+def estimate_planned_table(follower, table, data, limits):
+    '''
+    Estimate the print time of the commands in table using the planner
+    model (See plan_table) for moves. Commands that don't move but take
+    time, such as heating (See
+    maniforge.gcodeestimate.add_event_sec), are passed to
+    follower.addSec in order, so only the temperatures and the tool in
+    follower.emuState are changed.
+
+    Sequential arguments:
+    follower -- A GCodeFollower.
+    table -- A GCodeTable (See parse_gcode_table).
+    data -- The G-code (bytes) that table was parsed from.
+    limits -- A PlannerLimits.
+
+    Returns:
+    float: The estimated seconds (also added to follower._estS).
+    '''
+    started_s = follower._estS
+    seconds = plan_table(table, limits)
+    if follower.thermalModel is not None:
+        add_event_sec(follower, table, data, row_seconds=seconds)
+    else:
+        add_event_sec(follower, table, data)
+        follower._estS += float(np.sum(seconds))
+    return follower._estS - started_s
+
+
+def estimate_planned_file(follower, path, limits):
+    '''
+    Estimate a whole G-code file (See estimate_planned_table).
+    '''
+    with open(path, 'rb') as ins:
+        data = ins.read()
+    return estimate_planned_table(follower, parse_gcode_table(data), data,
+                                  limits)
@@ -0,0 +1,313 @@
+'''
+gcodeprecision
+--------------
+part of maniforge by Poikilos
+
+Trim coordinates to the resolution of the machine: The firmware turns
+each position into a whole number of motor steps (like LROUND(position
+* steps_per_mm) in Marlin's planner), so any decimal places beyond what
+changes that step are only bytes to send. PrecisionTrimmer (a stage,
+See gcodepipeline) writes each X, Y, Z and E with the fewest decimal
+places that reach the same step as the original, using the
+steps-per-mm of the printer (DEFAULT_AXIS_STEPS_PER_UNIT, See
+PrecisionTrimmer.from_marlininfo).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import math
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodepipeline import (
+    MOVE_FUNCTIONS,
+    MoveState,
+)
+from maniforge.gcodeplanner import parse_c_array
+from maniforge.mfgcode import (
+    ParsedCommand,
+    meta_to_cmd,
+)
+from maniforge.mfmath import (
+    round_nearest,
+    show_fewest,
+)
+
+logger = getLogger(__name__)
+
+AXES = ("X", "Y", "Z", "E")
+
+DEFAULT_STEPS_PER_UNIT = (80.0, 80.0, 400.0, 500.0)
+# ^ The Marlin 2 default DEFAULT_AXIS_STEPS_PER_UNIT
+
+STEP_MARGIN = 0.01
+# ^ How far (as a fraction of a step) a trimmed position must be from
+#   halfway between two steps, so that the firmware (which uses 32-bit
+#   floats) rounds it to the same step.
+
+
+def get_step(position, steps_per_unit):
+    '''
+    Get the step that the firmware moves to for a position (rounding
+    half away from 0 like LROUND).
+    '''
+    return round_nearest(position * steps_per_unit)
+
+
+def decimal_places(value):
+    '''
+    Get the number of decimal places written in a value (str), or None
+    if it is written in scientific notation.
+    '''
+    if "e" in value.lower():
+        return None
+    dot = value.find(".")
+    if dot < 0:
+        return 0
+    return len(value) - dot - 1
+
+
+def step_places(steps_per_unit, margin=STEP_MARGIN):
+    '''
+    Get how many decimal places are enough to write a position within
+    a tenth of margin (a fraction of a step) of any position, such as 5
+    for 80 steps per mm.
+    '''
+    return max(0, int(math.ceil(math.log10(steps_per_unit * 10.0
+                                           / margin))))
+
+
+def trim_value(target, base, steps_per_unit, places,
+               margin=STEP_MARGIN):
+    '''
+    Get the value with the fewest decimal places (at most places) that
+    moves to the same step as target when added to base.
+
+    Sequential arguments:
+    target -- The position (mm) that the original value moves to.
+    base -- The position that the new value is added to (0 for an
+        absolute position, or the position so far in relative mode).
+    steps_per_unit -- The steps per mm of the axis.
+    places -- The most decimal places to use.
+
+    Keyword arguments:
+    margin -- See STEP_MARGIN.
+
+    Returns:
+    float: The value, or None if none with places decimal places
+        reaches the step. A value with fewer places is only used if it
+        is at least margin away from halfway between two steps (or as
+        far as target is).
+    '''
+    goal = get_step(target, steps_per_unit)
+    exact = target - base
+    limit = max(0.5 - margin, abs(target * steps_per_unit - goal))
+    value = None
+    for places_i in range(places + 1):
+        value = round_nearest(exact, places_i) + 0.0  # never -0.0
+        steps = (base + value) * steps_per_unit
+        if (round_nearest(steps) == goal) and \
+                (abs(steps - goal) <= limit):
+            return value
+    if (value is not None) and \
+            (get_step(base + value, steps_per_unit) == goal):
+        return value  # as close to target as places allows
+    return None
+
+
+class PrecisionTrimmer(object):
+    '''
+    Write X, Y, Z and E of each G0 and G1 with the fewest decimal
+    places that move to the same step as the original value (See
+    trim_value), such as "X10.0125" as "X10.01" at 80 steps per mm.
+    Other parameters (such as F) and other commands are unchanged.
+
+    In relative mode (G91, M83), each value is chosen so that the
+    position written so far is on the same step as the original
+    position so far, so the difference (always less than half a step)
+    is carried into the next value instead of adding up (even if that
+    value is not shorter, See step_places). A relative value is only
+    trimmed after the position is set (such as by G92 E0 or an absolute
+    move), and any value is only trimmed after the mode is set (such as
+    by G90 or M83, See MoveState). While the position is unknown (such
+    as after a Klipper-style macro), the difference carried so far stays
+    the same until the position is set again.
+
+    The steps are the same as the original unless the firmware changes
+    the position before it is turned into steps, such as for mesh
+    leveling or skew correction (by less than a step).
+
+    Keyword arguments:
+    steps_per_unit -- The steps per mm of X, Y, Z & E
+        (DEFAULT_AXIS_STEPS_PER_UNIT).
+    margin -- See STEP_MARGIN.
+
+    Public attributes:
+    trimmed_count -- How many values were written shorter.
+    carried_count -- How many relative values were changed (but not
+        shortened) to carry the difference of the values before them.
+    input_bytes, output_bytes -- The size of the lines read and written
+        (including newlines).
+    '''
+    def __init__(self, steps_per_unit=DEFAULT_STEPS_PER_UNIT,
+                 margin=STEP_MARGIN):
+        if len(steps_per_unit) < len(AXES):
+            raise ValueError("steps_per_unit must have a value for each"
+                             " of {}".format(AXES))
+        self.steps_per_unit = [float(value) for value
+                               in steps_per_unit[:len(AXES)]]
+        self.margin = margin
+        self.trimmed_count = 0
+        self.carried_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._state = MoveState()
+        self._written = [None, None, None, None]
+        # ^ The position of each axis that the written values move to
+        #   (None while unknown).
+
+    @staticmethod
+    def from_marlininfo(marlininfo, **kwargs):
+        '''
+        Get a PrecisionTrimmer for the DEFAULT_AXIS_STEPS_PER_UNIT of a
+        Marlin configuration (or the Marlin default if it is not
+        defined).
+
+        Sequential arguments:
+        marlininfo -- A maniforge.marlininfo.MarlinInfo (or any object
+            with the same get_cached_c method).
+
+        Keyword arguments:
+        (Any other keyword arguments of PrecisionTrimmer)
+        '''
+        name = 'DEFAULT_AXIS_STEPS_PER_UNIT'
+        v, line_n, got_name, err = marlininfo.get_cached_c(name)
+        values = None
+        if err is None:
+            values = parse_c_array(v)
+        if values is None:
+            values = DEFAULT_STEPS_PER_UNIT
+        elif len(values) < len(AXES):
+            logger.warning("WARNING: {} only has {} value(s)."
+                           "".format(name, len(values)))
+            values = DEFAULT_STEPS_PER_UNIT
+        # ^ Marlin uses the first E value for any extruder unless
+        #   DISTINCT_E_FACTORS is enabled.
+        return PrecisionTrimmer(steps_per_unit=values, **kwargs)
+
+    def __call__(self, commands):
+        for command in commands:
+            self.input_bytes += len(command.line) + 1
+            result = self.trim(command)
+            self._update(command)
+            self.output_bytes += len(result.line) + 1
+            yield result
+
+    def trim(self, command):
+        '''
+        Get command with each axis trimmed in the current state if it
+        is a G0 or G1 (This doesn't update the state, See __call__).
+        '''
+        function = command.function
+        if function not in MOVE_FUNCTIONS + ("G2", "G3"):
+            return command
+        pairs = list(command.pairs)
+        changed = False
+        written = list(self._written)
+        for pair_i in range(1, len(pairs)):
+            pair = pairs[pair_i]
+            if (len(pair) != 2) or (pair[0] not in AXES):
+                continue
+            axis_i = AXES.index(pair[0])
+            value = self._trim_axis(axis_i, pair[1], written,
+                                    function in MOVE_FUNCTIONS)
+            if value is None:
+                continue
+            if len(value) < len(pair[1]):
+                self.trimmed_count += 1
+            else:
+                self.carried_count += 1
+            pairs[pair_i] = (pair[0], value)
+            changed = True
+        self._next_written = written
+        if not changed:
+            return command
+        line = meta_to_cmd(pairs)
+        if command.comment is not None:
+            line += " " + command.comment
+        return ParsedCommand(line)
+
+    def _trim_axis(self, axis_i, text, written, enable):
+        # Get a shorter value (str) for one axis (or None to keep text,
+        # such as if not enable), and set written[axis_i] to where the
+        # result moves.
+        state = self._state
+        if axis_i == 3:
+            known = state.e_mode_known
+            relative = state.e_relative
+            position = state.e_position
+        else:
+            known = state.xy_mode_known
+            relative = state.xy_relative
+            position = state.position[axis_i]
+        places = decimal_places(text)
+        try:
+            value = float(text)
+        except ValueError:
+            places = None
+        if (places is None) or not known:
+            written[axis_i] = None
+            return None
+        base = 0.0
+        target = value
+        if relative:
+            base = written[axis_i]
+            if (position is None) or (base is None):
+                written[axis_i] = None
+                return None
+            target = position + value
+        if enable:
+            steps_per_unit = self.steps_per_unit[axis_i]
+            if relative:
+                places = max(places, step_places(steps_per_unit,
+                                                 margin=self.margin))
+            trimmed = trim_value(target, base, steps_per_unit, places,
+                                 margin=self.margin)
+            if trimmed is not None:
+                result = show_fewest(trimmed)
+                if (len(result) < len(text)) or \
+                        (relative and (trimmed != value)):
+                    # ^ In relative mode, also carry the difference if
+                    #   the value is not shorter.
+                    written[axis_i] = base + trimmed
+                    return result
+        written[axis_i] = base + value
+        return None
+
+    def _update(self, command):
+        # Track the state after command (whether or not it was trimmed).
+        function = command.function
+        state = self._state
+        if function in MOVE_FUNCTIONS + ("G2", "G3"):
+            self._written = self._next_written
+        elif function == "G92":
+            for axis_i, axis in enumerate(AXES):
+                if command.has(axis):
+                    try:
+                        self._written[axis_i] = command.get_float(axis)
+                    except ValueError:
+                        self._written[axis_i] = None
+        if state.forget(command):
+            self._written = [None, None, None, None]
+            return
+        state.update(command)
+        if function in MOVE_FUNCTIONS + ("G2", "G3"):
+            if not state.xy_mode_known:
+                state.position = [None, None, None]
+            if not state.e_mode_known:
+                state.e_position = None
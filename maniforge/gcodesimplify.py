@@ -0,0 +1,452 @@
+'''
+gcodesimplify
+-------------
+part of maniforge by Poikilos
+
+Remove the points of a path that are within a tolerance of a straight
+line between the points kept (Douglas-Peucker), such as collinear or
+nearly collinear micro-segments that a slicer or a mesh export wrote as
+separate G1 commands. Each removed command is merged into the next one
+kept (with the E of both), so the total E of each run is unchanged.
+
+Everything is found using numpy for a whole GCodeTable at once (See
+simplify_table): simplify_gcode does a whole file in memory, and the
+Simplifier stage (See gcodepipeline) does one layer at a time.
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodepipeline import (
+    MODE_FUNCTIONS,
+    MOVE_FUNCTIONS,
+    MoveState,
+)
+from maniforge.mfgcode import (
+    GCodeTable,
+    ParsedCommand,
+    np,
+    parse_gcode_table,
+)
+from maniforge.mfmath import show_places
+
+logger = getLogger(__name__)
+
+UNKNOWN = float("inf")
+# ^ A tracked position that isn't known (NaN means "not set here").
+
+MODES = ("xy_relative", "e_relative", "xy_mode_known", "e_mode_known")
+# ^ The attributes of MoveState that simplify_table tracks for each row.
+
+
+def segment_distances(px, py, ax, ay, bx, by):
+    '''
+    Get the distance from each point (px, py) to the line segment from
+    (ax, ay) to (bx, by) (each argument is a numpy array).
+    '''
+    dx = bx - ax
+    dy = by - ay
+    squared = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = ((px - ax) * dx + (py - ay) * dy) / squared
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+    # ^ 0 (the distance to a) if the segment has no length.
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+
+def simplify_runs(x, y, starts, ends, tolerance):
+    '''
+    Simplify many polylines at once (Douglas-Peucker): Each pass finds
+    the farthest point from the segment between the ends of every range
+    that is still being split, and splits the ranges where it is
+    farther than tolerance at that point.
+
+    Sequential arguments:
+    x, y -- The points of all of the polylines (one after another).
+    starts, ends -- The index of the first and last point of each
+        polyline.
+    tolerance -- The farthest (in mm) that a removed point may be from
+        the polyline.
+
+    Returns:
+    numpy.ndarray: A mask of the points to keep (including each start
+        and end).
+    '''
+    keep = np.zeros(len(x), dtype=bool)
+    low = np.asarray(starts, dtype=np.int64)
+    high = np.asarray(ends, dtype=np.int64)
+    keep[low] = True
+    keep[high] = True
+    while len(low):
+        inner = high - low - 1
+        has_inner = inner > 0
+        low = low[has_inner]
+        high = high[has_inner]
+        inner = inner[has_inner]
+        if not len(low):
+            break
+        # The index of each inner point and of the range it is in:
+        owner = np.repeat(np.arange(len(low)), inner)
+        offsets = np.cumsum(inner) - inner
+        points = low[owner] + 1 + (np.arange(len(owner)) - offsets[owner])
+        distances = segment_distances(
+            x[points], y[points],
+            x[low][owner], y[low][owner],
+            x[high][owner], y[high][owner],
+        )
+        farthest = np.maximum.reduceat(distances, offsets)
+        at_max = np.flatnonzero(distances == farthest[owner])
+        _, first = np.unique(owner[at_max], return_index=True)
+        split = farthest > tolerance
+        middle = points[at_max[first]][split]
+        keep[middle] = True
+        low, high = (np.concatenate((low[split], middle)),
+                     np.concatenate((middle, high[split])))
+    return keep
+
+
+def _modes(table, state):
+    # Get whether each mode of MoveState (See MODES) is on before each
+    # row, and the rows where MoveState.forget makes the position
+    # unknown (such as G28, G29, M600 or a Klipper-style macro). The
+    # modes of state are changed to the modes after the last row.
+    forgets = np.zeros(len(table), dtype=bool)
+    events = np.zeros(len(table), dtype=bool)
+    commands = {}
+    for function_i, function in enumerate(table.functions):
+        command = ParsedCommand(function)
+        rows = table.function_id == function_i
+        if function not in MODE_FUNCTIONS:
+            if not MoveState().forget(command):
+                continue
+            forgets |= rows
+        events |= rows
+        commands[function_i] = command
+    values = np.full((len(MODES), len(table) + 1), np.nan)
+    values[:, 0] = [getattr(state, name) for name in MODES]
+    for row in np.flatnonzero(events).tolist():
+        command = commands[int(table.function_id[row])]
+        if not state.forget(command):
+            state.update(command)
+        values[:, row + 1] = [getattr(state, name) for name in MODES]
+    modes = [GCodeTable.forward_fill(column)[:-1] == 1.0
+             for column in values]
+    return modes, forgets
+
+
+def _track(values, sets, offsets, resets, initial):
+    # Get the position before and after each row along one axis (See
+    # UNKNOWN). A relative move makes it UNKNOWN (This only needs the
+    # positions for moves in absolute mode).
+    present = ~np.isnan(values)
+    after = np.full(len(values) + 1, np.nan)
+    after[1:][present & sets] = values[present & sets]
+    after[1:][present & offsets] = UNKNOWN
+    after[1:][resets] = UNKNOWN
+    filled = GCodeTable.forward_fill(
+        after,
+        initial=UNKNOWN if initial is None else initial,
+    )
+    return filled[:-1], filled[1:]
+
+
+def _known(value):
+    if np.isnan(value) or (value == UNKNOWN):
+        return None
+    return float(value)
+
+
+def simplify_table(table, data, tolerance, state=None):
+    '''
+    Find the G1 moves in table that can be merged into the next one
+    (See Simplifier).
+
+    Sequential arguments:
+    table -- A GCodeTable (See parse_gcode_table).
+    data -- The G-code (bytes) that table was parsed from.
+    tolerance -- The farthest (in mm) that a removed point may be from
+        the new path.
+
+    Keyword arguments:
+    state -- A MoveState with the modes and position before the first
+        row (It is changed to the state after the last row).
+
+    Returns:
+    tuple: (removed, merged) where removed is an array of the rows
+        to remove, and merged is a list of (row, e, F) for each kept
+        row that the removed rows before it are merged into. The e is
+        the total extruded (relative) E (None if there is no E), and F
+        is the feed rate if any of the merged rows has F (else None).
+    '''
+    if state is None:
+        state = MoveState()
+    row_count = len(table)
+    if not row_count:
+        return np.zeros(0, dtype=np.int64), []
+    modes, resets = _modes(table, state)
+    xy_relative, e_relative, xy_known, e_known = modes
+    xy_offsets = xy_relative | ~xy_known
+    e_offsets = e_relative | ~e_known
+    # ^ A move in an unknown mode makes the position unknown.
+    moves = table.function_mask(*(MOVE_FUNCTIONS + ("G2", "G3")))
+    is_set = table.function_mask("G92")
+    before = []
+    after = []
+    for axis_i, values in enumerate((table.X, table.Y, table.Z)):
+        axis_before, axis_after = _track(
+            values,
+            is_set | (moves & ~xy_offsets),
+            moves & xy_offsets,
+            resets,
+            state.position[axis_i],
+        )
+        before.append(axis_before)
+        after.append(axis_after)
+    e_before, e_after = _track(
+        table.E,
+        is_set | (moves & ~e_offsets),
+        moves & e_offsets,
+        resets,
+        state.e_position,
+    )
+
+    # The end of each line (to find G1 commands with comments):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.append(np.flatnonzero(raw == ord("\n")), len(raw))
+    line_ends = newlines[np.searchsorted(newlines, table.byte_offset)]
+    semicolons = np.flatnonzero(raw == ord(";"))
+    has_comment = (np.searchsorted(semicolons, line_ends)
+                   > np.searchsorted(semicolons, table.byte_offset))
+
+    # Each G1 that can be merged (like MoveState.segment):
+    with np.errstate(invalid='ignore'):
+        de = np.where(e_relative, table.E, table.E - e_before)
+        extrudes = de > 0
+    candidate = (
+        table.function_mask("G1") & ~xy_offsets & ~has_comment
+        & (~np.isnan(table.X) | ~np.isnan(table.Y))
+        & np.isnan(table.Z) & np.isnan(table.I) & np.isnan(table.J)
+        & np.isnan(table.R)
+        & (before[0] != UNKNOWN) & (before[1] != UNKNOWN)
+        & ((after[0] != before[0]) | (after[1] != before[1]))
+        & (np.isnan(table.E) | (extrudes & e_known))
+    )
+
+    # A run continues on the next line if the modal F and whether it
+    # extrudes are the same:
+    F = GCodeTable.forward_fill(np.where(moves, table.F, np.nan))
+    links = np.zeros(row_count, dtype=bool)
+    if row_count > 1:
+        links[1:] = (
+            candidate[1:] & candidate[:-1]
+            & (table.line_number[1:] == table.line_number[:-1] + 1)
+            & ((F[1:] == F[:-1]) | (np.isnan(F[1:]) & np.isnan(F[:-1])))
+            & (np.isnan(table.E[1:]) == np.isnan(table.E[:-1]))
+        )
+    firsts = candidate & ~links
+    run_id = np.cumsum(firsts) - 1
+    run_sizes = np.bincount(run_id[candidate], minlength=1)
+    rows = np.flatnonzero(candidate & (run_sizes[np.maximum(run_id, 0)]
+                                       >= 2))
+
+    # The state at the end (for the next table):
+    state.position = [_known(values[-1]) for values in after]
+    state.e_position = _known(e_after[-1])
+
+    if not len(rows):
+        return np.zeros(0, dtype=np.int64), []
+
+    # The points of each run are its start and the end of each row:
+    run_of_row = run_id[rows]
+    is_first = np.ones(len(rows), dtype=bool)
+    is_first[1:] = run_of_row[1:] != run_of_row[:-1]
+    point_of_row = np.arange(len(rows)) + np.cumsum(is_first)
+    starts = point_of_row[is_first] - 1
+    ends = np.append(point_of_row[np.flatnonzero(is_first)[1:] - 1],
+                     point_of_row[-1])
+    x = np.empty(len(rows) + len(starts))
+    y = np.empty(len(x))
+    x[point_of_row] = after[0][rows]
+    y[point_of_row] = after[1][rows]
+    x[starts] = before[0][rows[is_first]]
+    y[starts] = before[1][rows[is_first]]
+    kept = simplify_runs(x, y, starts, ends, tolerance)[point_of_row]
+
+    # Each removed row belongs to the next kept row:
+    group = np.cumsum(kept) - kept
+    e_totals = np.bincount(group, weights=np.nan_to_num(de[rows]))
+    has_F = np.bincount(group, weights=~np.isnan(table.F[rows])) > 0
+    sizes = np.bincount(group)
+    kept_rows = rows[kept]
+    merged = []
+    for group_i in np.flatnonzero(sizes > 1).tolist():
+        row = int(kept_rows[group_i])
+        e = None
+        if e_relative[row] and not np.isnan(table.E[row]):
+            e = float(e_totals[group_i])
+        merged.append((
+            row,
+            float(after[0][row]),
+            float(after[1][row]),
+            e,
+            float(F[row]) if has_F[group_i] else None,
+        ))
+    return rows[~kept], merged
+
+
+def merge_line(line, x, y, e=None, F=None, xy_places=3, e_places=5):
+    '''
+    Get the G1 that replaces line and the moves merged into it (See
+    simplify_table).
+
+    Sequential arguments:
+    line -- The G1 that is kept.
+    x, y -- Its end (used where line doesn't have X or Y).
+
+    Keyword arguments:
+    e -- The new relative E (None to keep the E of line).
+    F -- The feed rate (None to keep the F of line).
+    '''
+    command = ParsedCommand(line)
+    parts = ["G1"]
+    for key, value in (('X', x), ('Y', y)):
+        text = command.get(key)
+        if text is None:
+            text = show_places(value, xy_places)
+        parts.append(key + text)
+    if e is not None:
+        parts.append("E" + show_places(e, e_places))
+    elif command.has('E'):
+        parts.append("E" + command.get('E'))
+    text = command.get('F')
+    if (text is None) and (F is not None):
+        text = show_places(F, 3)
+    if text is not None:
+        parts.append("F" + text)
+    return " ".join(parts)
+
+
+def simplify_gcode(data, tolerance=0.02, state=None):
+    '''
+    Simplify G-code (bytes or str) all at once (See simplify_table).
+    Only the lines that are merged are decoded, so it is much faster
+    than the Simplifier stage but needs the whole file in memory.
+
+    Returns:
+    tuple: (bytes, count) where count is how many moves were removed.
+    '''
+    if not isinstance(data, bytes):
+        data = data.encode("utf-8")
+    table = parse_gcode_table(data)
+    removed, merged = simplify_table(table, data, tolerance, state=state)
+    raw = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.append(np.flatnonzero(raw == ord("\n")), len(raw) - 1)
+    merged_rows = np.array([row for row, _, _, _, _ in merged],
+                           dtype=np.int64)
+    rows = np.concatenate((removed, merged_rows))
+    starts = table.byte_offset[rows]
+    ends = newlines[np.searchsorted(newlines, starts)] + 1
+    # Drop the bytes of those lines (marked using a running sum):
+    marks = np.zeros(len(raw) + 1, dtype=np.int64)
+    np.add.at(marks, starts, 1)
+    np.add.at(marks, ends, -1)
+    kept = np.cumsum(marks[:-1]) == 0
+    chunks = []
+    position = 0
+    for (row, x, y, e, F), start, end in zip(
+            merged, starts[len(removed):].tolist(),
+            ends[len(removed):].tolist()):
+        chunks.append(raw[position:start][kept[position:start]].tobytes())
+        line = data[start:end].decode("utf-8").rstrip("\r\n")
+        line = merge_line(line, x, y, e=e, F=F).encode("utf-8")
+        if data[end - 1:end] == b"\n":
+            line += b"\n"
+        chunks.append(line)
+        position = end
+    chunks.append(raw[position:][kept[position:]].tobytes())
+    return b"".join(chunks), len(removed)
+
+
+class Simplifier(object):
+    '''
+    Merge each G1 move that is within tolerance of the path that
+    remains into the next one kept (See simplify_runs). A run is
+    consecutive G1 moves that MoveState.segment would accept with the
+    same F that either all extrude or all don't have E. The kept move
+    gets the E of the moves merged into it (In absolute E mode, its E
+    is already the total) and their F. A command that MoveState.forget
+    would forget (such as G28, G29 or a Klipper-style macro) makes the
+    position unknown until a move sets it, and moves are only merged
+    while the modes are known (See MoveState).
+
+    The commands are collected until the height changes (or max_lines)
+    then simplified at once (See simplify_table).
+
+    Keyword arguments:
+    tolerance -- The farthest (in mm) that a removed point may be from
+        the new path.
+    max_lines -- The most lines to collect if the layer doesn't change.
+
+    Public attributes:
+    removed_count -- How many G1 commands were merged into others.
+    input_count, output_count -- How many lines were read and written.
+    input_bytes, output_bytes -- The size of the lines read and written
+        (including newlines).
+    '''
+    def __init__(self, tolerance=0.02, max_lines=100000):
+        self.tolerance = tolerance
+        self.max_lines = max_lines
+        self.removed_count = 0
+        self.input_count = 0
+        self.output_count = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._state = MoveState()
+
+    def __call__(self, commands):
+        layer = []
+        for command in commands:
+            self.input_count += 1
+            self.input_bytes += len(command.line) + 1
+            layer.append(command)
+            if (len(layer) >= self.max_lines) or \
+                    ((command.function in MOVE_FUNCTIONS)
+                     and command.has('Z')):
+                for result in self._simplify(layer):
+                    yield result
+                layer = []
+        for result in self._simplify(layer):
+            yield result
+
+    def _simplify(self, layer):
+        if not layer:
+            return
+        data = "\n".join([command.line for command in layer])
+        data = data.encode("utf-8")
+        table = parse_gcode_table(data)
+        removed, merged = simplify_table(table, data, self.tolerance,
+                                         state=self._state)
+        self.removed_count += len(removed)
+        lines = dict()
+        for row in removed.tolist():
+            lines[int(table.line_number[row]) - 1] = None
+        for row, x, y, e, F in merged:
+            index = int(table.line_number[row]) - 1
+            lines[index] = ParsedCommand(merge_line(
+                layer[index].line, x, y, e=e, F=F,
+            ))
+        for index, command in enumerate(layer):
+            if index in lines:
+                command = lines[index]
+                if command is None:
+                    continue
+            self.output_count += 1
+            self.output_bytes += len(command.line) + 1
+            yield command
@@ -0,0 +1,309 @@
+'''
+gcodestart
+----------
+part of maniforge by Poikilos
+
+Rewrite the start G-code so that the heaters heat at the same time and
+during homing instead of one after the other: Many start sequences wait
+for the bed (M190) and then for the hotend (M109) before homing. The
+HeaterOverlap stage (See gcodepipeline) starts each heater (M140, M104)
+as early as it safely can, and moves each wait down to just before the
+command that needs the temperature (such as the purge line), so that
+homing and both heaters overlap.
+
+Probing may need the bed to be at its temperature first (See
+HeaterOverlap.from_marlininfo, which reads the BLTouch settings such as
+in marlininfo.BLTOUCH_C_VALUES).
+'''
+from __future__ import print_function
+from __future__ import division
+
+import copy
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodepipeline import (
+    MOVE_FUNCTIONS,
+    is_tool_change,
+)
+from maniforge.gcodethermal import (
+    BED,
+    ThermalModel,
+)
+from maniforge.mfgcode import ParsedCommand
+
+logger = getLogger(__name__)
+
+WAIT_FUNCTIONS = {"M109": "M104", "M190": "M140"}
+# ^ Each wait and the command that sets the same heater without waiting.
+SET_FUNCTIONS = ("M104", "M140")
+
+# Commands that a wait can be moved after, since they don't need the
+# temperature (Moves are also allowed if they don't extrude, and a
+# heater command is allowed if it is for another heater):
+SETUP_FUNCTIONS = (
+    "G4",  # Dwell (such as the delay after deploying a BLTouch)
+    "G28",  # Auto-home (See HeaterOverlap bed_before_probing)
+    "G29",  # Bed leveling (See HeaterOverlap bed_before_probing)
+    "G90",
+    "G91",
+    "G92",
+    "M82",
+    "M83",
+    "M106",
+    "M107",
+    "M117",
+    "M280",  # Servo (such as BLTouch alarm release)
+    "M420",  # Restore the bed leveling mesh (See is_probing)
+)
+
+
+def get_heater(command, tool):
+    '''
+    Get the heater that a temperature command is for (BED or a tool
+    such as "T0"), or None if it isn't one.
+
+    Sequential arguments:
+    command -- A ParsedCommand.
+    tool -- The current tool (used unless the command has T).
+    '''
+    function = command.function
+    if function in ("M140", "M190"):
+        return BED
+    if function in ("M104", "M109"):
+        index = command.get('T')
+        if index is not None:
+            return "T" + index
+        return tool
+    return None
+
+
+class HeaterOverlap(object):
+    '''
+    Rewrite the start G-code (the commands before the first one that
+    extrudes) so the heaters overlap with each other and with homing:
+    - Each wait (M190, M109) is moved down past the setup commands
+      after it (See SETUP_FUNCTIONS) until a command needs the
+      temperature, such as a move that extrudes, another command for
+      the same heater, another wait, a tool change or an unknown
+      command (such as a Klipper macro).
+    - Then the heater of each wait (with S) is started (M140, M104
+      with the same parameters) before the first command after the
+      previous command for that heater (or the beginning), unless that
+      command already sets the same temperature.
+
+    Sequential arguments:
+    follower -- A GCodeFollower that estimates the start G-code before
+        and after the change (A ThermalModel is installed on it if it
+        doesn't have one, since the savings are from heating at the
+        same time).
+
+    Keyword arguments:
+    bed_before_probing -- Don't move a bed wait past probing (so that
+        the bed is at its temperature for G29 and for G28 if the probe
+        homes Z) or past M420 (which enables a mesh that was probed
+        with the bed at its temperature).
+    probe_homes_z -- G28 probes (like USE_PROBE_FOR_Z_HOMING). This is
+        True by default so that a bed wait is only moved past G28 if the
+        configuration is known not to probe (See from_marlininfo).
+    preheat_before_leveling -- G29 waits for the bed itself (like
+        PREHEAT_BEFORE_LEVELING), so a bed wait can be moved past it.
+    probing_heaters_off -- The heaters are paused while probing (like
+        PROBING_HEATERS_OFF), so homing doesn't count as heating time
+        (only used if the ThermalModel is installed here).
+    max_lines -- The most lines to treat as the start G-code if nothing
+        extrudes.
+
+    Public attributes:
+    started_count -- How many M140 or M104 commands were inserted.
+    moved_count -- How many waits were moved.
+    saved_seconds -- The estimated time saved (See the follower's
+        ThermalModel).
+    '''
+    def __init__(self, follower, bed_before_probing=True,
+                 probe_homes_z=True, preheat_before_leveling=False,
+                 probing_heaters_off=False, max_lines=1000):
+        self.follower = follower
+        self.bed_before_probing = bed_before_probing
+        self.probe_homes_z = probe_homes_z
+        self.preheat_before_leveling = preheat_before_leveling
+        self.max_lines = max_lines
+        if follower.thermalModel is None:
+            ThermalModel(
+                probing_heaters_off=probing_heaters_off,
+            ).install(follower)
+        self.started_count = 0
+        self.moved_count = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def from_marlininfo(marlininfo, follower, **kwargs):
+        '''
+        Get the probing constraints from a Marlin configuration (such
+        as BLTOUCH_C_VALUES). Other keyword arguments are passed to
+        HeaterOverlap.
+
+        Sequential arguments:
+        marlininfo -- A maniforge.marlininfo.MarlinInfo (or any object
+            with the same get_cached_c method).
+        follower -- See HeaterOverlap.
+        '''
+        def defined(name):
+            v, line_n, got_name, err = marlininfo.get_cached_c(name)
+            return err is None
+            # ^ err is set such as if the #define is commented.
+
+        return HeaterOverlap(
+            follower,
+            probe_homes_z=defined('USE_PROBE_FOR_Z_HOMING'),
+            preheat_before_leveling=defined('PREHEAT_BEFORE_LEVELING'),
+            probing_heaters_off=defined('PROBING_HEATERS_OFF'),
+            **kwargs
+        )
+
+    def is_probing(self, command):
+        '''
+        Check whether a bed wait has to stay before command.
+        '''
+        if not self.bed_before_probing:
+            return False
+        if command.function == "G29":
+            return not self.preheat_before_leveling
+        if command.function == "G28":
+            return self.probe_homes_z
+        return command.function == "M420"
+
+    def _can_pass(self, heater, command, command_heater):
+        # Check whether wait (for heater) can be moved after command.
+        function = command.function
+        if function is None:
+            return True
+        if function in WAIT_FUNCTIONS:
+            return False
+        if function in SET_FUNCTIONS:
+            return command_heater != heater
+        if function in MOVE_FUNCTIONS:
+            return not command.has("E")
+        if function not in SETUP_FUNCTIONS:
+            return False
+        return not ((heater == BED) and self.is_probing(command))
+
+    def rewrite(self, commands):
+        '''
+        Get the rewritten start G-code (See HeaterOverlap).
+
+        Sequential arguments:
+        commands -- A list of ParsedCommand objects (the start G-code).
+        '''
+        # [command, heater] (The heater of each command is found in the
+        # original order so that tool changes apply):
+        rows = []
+        tool = self.follower.emuState['tool']
+        for command in commands:
+            if is_tool_change(command):
+                tool = command.function
+            rows.append([command, get_heater(command, tool)])
+
+        # Move the waits down, starting with the last, so that each
+        # stops before the next wait in the original order:
+        for index in reversed(range(len(rows))):
+            wait, heater = rows[index]
+            if wait.function not in WAIT_FUNCTIONS:
+                continue
+            end = index
+            while (end + 1 < len(rows)) and \
+                    self._can_pass(heater, *rows[end + 1]):
+                end += 1
+            # Stay after the last command that isn't a comment or blank:
+            while (end > index) and (rows[end][0].function is None):
+                end -= 1
+            if end > index:
+                rows.insert(end, rows.pop(index))
+                self.moved_count += 1
+
+        # Start each heater as early as possible before its wait:
+        index = 0
+        while index < len(rows):
+            wait, heater = rows[index]
+            if (wait.function not in WAIT_FUNCTIONS) or \
+                    (wait.get('S') is None):
+                index += 1
+                continue
+            start = index
+            while start > 0:
+                command, command_heater = rows[start - 1]
+                if (command_heater == heater) or \
+                        ((heater != BED) and is_tool_change(command)):
+                    if command.get('S') == wait.get('S'):
+                        start = None  # It already sets the temperature.
+                    break
+                start -= 1
+            if start is not None:
+                # Don't start it before the leading comments.
+                while (start < index) and (rows[start][0].function is None):
+                    start += 1
+            if (start is not None) and (start < index):
+                function = WAIT_FUNCTIONS[wait.function]
+                code = wait.line.split(";", 1)[0].strip()
+                # ^ without the comment, which may say that it waits
+                started = ParsedCommand(
+                    function + code[len(wait.function):]
+                )
+                rows.insert(start, [started, heater])
+                self.started_count += 1
+                index += 1
+            index += 1
+        return [row[0] for row in rows]
+
+    def _estimate(self, commands, keep=False):
+        # Get the seconds for commands, then restore the state of the
+        # follower and its ThermalModel unless keep is True.
+        follower = self.follower
+        model = follower.thermalModel
+        started_s = follower._estS
+        emuState = copy.deepcopy(follower.emuState)
+        heaters = copy.deepcopy(model.heaters)
+        waited_seconds = model.waited_seconds
+        for command in commands:
+            follower.addSec(command)
+        seconds = follower._estS - started_s
+        if not keep:
+            follower._estS = started_s
+            follower.emuState = emuState
+            model.heaters = heaters
+            model.waited_seconds = waited_seconds
+        return seconds
+
+    def __call__(self, commands):
+        start = []
+        for command in commands:
+            if start is None:
+                yield command
+                continue
+            if (command.function in MOVE_FUNCTIONS) and \
+                    command.has("E"):
+                for rewritten in self._finish(start):
+                    yield rewritten
+                start = None
+                yield command
+                continue
+            start.append(command)
+            if len(start) >= self.max_lines:
+                for rewritten in self._finish(start):
+                    yield rewritten
+                start = None
+        if start is not None:
+            for rewritten in self._finish(start):
+                yield rewritten
+
+    def _finish(self, start):
+        original_s = self._estimate(start)
+        rewritten = self.rewrite(start)
+        self.saved_seconds += original_s - self._estimate(rewritten,
+                                                          keep=True)
+        return rewritten
@@ -0,0 +1,309 @@
+'''
+gcodethermal
+------------
+part of maniforge by Poikilos
+
+Estimate heating alongside motion instead of one heater at a time: Each
+heater (each tool and the bed) ramps toward its target at its own rate
+from the time its target was set (See Heater), using the estimated time
+(GCodeFollower._estS) as the clock. Only the commands that wait (M109,
+M190 and G28) add time, and only until the heater they wait for is
+ready, so heating that was started earlier (M104, M140) overlaps with
+moves and with other heaters.
+
+To use it, install a ThermalModel on a GCodeFollower (It replaces the
+handlers of the temperature commands and tool changes, See
+gcodehandlers):
+ThermalModel().install(follower)
+'''
+from __future__ import print_function
+from __future__ import division
+
+import sys
+
+if sys.version_info.major >= 3:
+    from logging import getLogger
+else:
+    # Python 2
+    from hierosoft.logging2 import getLogger
+
+from maniforge.gcodediagnostics import ERROR
+
+logger = getLogger(__name__)
+
+BED = "bed"  # The name of the bed heater (Tools are named such as T0).
+
+
+class Heater(object):
+    '''
+    A heater that changes temperature at a constant rate toward its
+    target (the same linear model as GCodeFollower.getToolSecRelTemp).
+
+    Public attributes:
+    name -- Such as "T0" or BED.
+    sec_per_degree -- Seconds to change one degree (C).
+    temperature -- The temperature at time.
+    time -- When the target was last set (in estimated seconds), or
+        when a pause ends (See pause).
+    target -- The temperature it is changing toward.
+    '''
+    def __init__(self, name, sec_per_degree, temperature, time=0.0):
+        self.name = name
+        self.sec_per_degree = sec_per_degree
+        self.temperature = temperature
+        self.time = time
+        self.target = temperature
+
+    def temperature_at(self, now):
+        elapsed = now - self.time
+        if elapsed <= 0:
+            return self.temperature
+        change = elapsed / self.sec_per_degree
+        if self.target >= self.temperature:
+            return min(self.target, self.temperature + change)
+        return max(self.target, self.temperature - change)
+
+    def set_target(self, target, now):
+        self.temperature = self.temperature_at(now)
+        self.time = max(now, self.time)
+        self.target = target
+
+    def pause(self, now, seconds):
+        '''
+        Keep the current temperature for seconds, then continue toward
+        the target.
+        '''
+        self.temperature = self.temperature_at(now)
+        self.time = max(now, self.time) + seconds
+
+    def seconds_to(self, temperature, now):
+        '''
+        Get the seconds from now until the heater reaches temperature
+        (None if it won't since the target is not that far).
+        '''
+        current = self.temperature_at(now)
+        if temperature == current:
+            return 0.0
+        if (temperature > current) != (self.target > current):
+            return None
+        if abs(temperature - current) > abs(self.target - current):
+            return None
+        paused_s = max(0.0, self.time - now)
+        return abs(temperature - current) * self.sec_per_degree + paused_s
+
+
+class ThermalModel(object):
+    '''
+    The heaters of a printer (See Heater) and the commands that set or
+    wait for them.
+
+    Keyword arguments:
+    tool_sec_per_degree -- The rate of each tool's heater (default: the
+        TOOL_SEC_PER_DEGREE of the follower it is installed on).
+    bed_sec_per_degree -- The rate of the bed (default: the follower's
+        BED_SEC_PER_DEGREE).
+    ambient -- The temperature of a heater that was never set
+        (default: the follower's roomTemperature).
+    probing_heaters_off -- Pause every heater while G28 moves (like
+        PROBING_HEATERS_OFF in Marlin when the probe homes Z).
+    tool_rates -- The rate of specific tools that differ from
+        tool_sec_per_degree, such as {"T1": 0.7}.
+
+    Public attributes:
+    heaters -- The Heater for each name that was used.
+    waited_seconds -- The total time added by commands that wait.
+    tool_change_count -- How many times the tool changed.
+    tool_change_seconds -- The part of waited_seconds spent waiting for
+        a tool to heat after a tool change (by the first M109 for the
+        new tool after the change).
+    '''
+    def __init__(self, tool_sec_per_degree=None, bed_sec_per_degree=None,
+                 ambient=None, probing_heaters_off=False, tool_rates=None):
+        self.tool_sec_per_degree = tool_sec_per_degree
+        self.bed_sec_per_degree = bed_sec_per_degree
+        self.ambient = ambient
+        self.probing_heaters_off = probing_heaters_off
+        self.tool_rates = {} if tool_rates is None else tool_rates
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the heaters (such as when the estimate starts over at 0).
+        '''
+        self.heaters = {}
+        self.waited_seconds = 0.0
+        self.tool_change_count = 0
+        self.tool_change_seconds = 0.0
+        self._changed_tool = None
+
+    def install(self, follower):
+        '''
+        Use this model for the temperature commands of follower (See
+        GCodeFollower.thermalModel) by registering its handlers.
+        '''
+        if self.tool_sec_per_degree is None:
+            self.tool_sec_per_degree = follower.TOOL_SEC_PER_DEGREE
+        if self.bed_sec_per_degree is None:
+            self.bed_sec_per_degree = follower.BED_SEC_PER_DEGREE
+        if self.ambient is None:
+            self.ambient = float(follower.roomTemperature)
+        registry = follower.commandRegistry
+        registry.register_prefix("T", self._tool_change)
+        registry.register("M104", self._set_tool_temperature)
+        registry.register("M109", self._tool_heat_up)
+        registry.register("M140", self._set_bed_temperature)
+        registry.register("M190", self._bed_heat_up)
+        registry.register("G28", self._auto_home)
+        follower.thermalModel = self
+
+    def heater(self, name):
+        heater = self.heaters.get(name)
+        if heater is None:
+            if name == BED:
+                sec_per_degree = self.bed_sec_per_degree
+            else:
+                sec_per_degree = self.tool_rates.get(
+                    name,
+                    self.tool_sec_per_degree,
+                )
+            heater = Heater(name, sec_per_degree, self.ambient)
+            self.heaters[name] = heater
+        return heater
+
+    def set_target(self, name, target, now):
+        self.heater(name).set_target(target, now)
+
+    def pause(self, now, seconds):
+        for heater in self.heaters.values():
+            heater.pause(now, seconds)
+
+    def wait(self, name, now, cooling=False):
+        '''
+        Get the seconds from now until a heater reaches its target.
+
+        Keyword arguments:
+        cooling -- Also wait if the target is lower (like M109 R),
+            otherwise only wait while heating (like M109 S).
+        '''
+        heater = self.heater(name)
+        if (not cooling) and \
+                (heater.target <= heater.temperature_at(now)):
+            return 0.0
+        return heater.seconds_to(heater.target, now)
+
+    def _add_wait(self, follower, seconds):
+        self.waited_seconds += seconds
+        follower._estS += seconds
+
+    @staticmethod
+    def _get_target(follower, meta):
+        '''
+        Get (temperature, cooling) from S (or R, which also waits while
+        cooling), or None after adding a diagnostic if neither is set.
+        '''
+        cooling = False
+        value = meta.get('S')
+        if value is None:
+            value = meta.get('R')
+            cooling = value is not None
+        if value is None:
+            follower.diagnostics.add(
+                "no_S:" + meta.function,
+                'S is None in "{}"'.format(meta.pairs),
+                level=ERROR,
+            )
+            return None
+        return float(value), cooling
+
+    @staticmethod
+    def _get_tool(follower, meta):
+        index = meta.get('T')
+        if index is None:
+            return follower.emuState['tool']
+        return "T" + index
+
+    def _set_tool(self, follower, meta):
+        # Set the target (and the temperature the follower shows).
+        target = self._get_target(follower, meta)
+        if target is None:
+            return None
+        tool = self._get_tool(follower, meta)
+        self.set_target(tool, target[0], follower._estS)
+        if tool == follower.emuState['tool']:
+            follower.setToolTemperature(target[0])
+        return tool, target[1]
+
+    def _tool_change(self, follower, meta):
+        # such as {'T': '1'} (A Klipper-style macro such as
+        # TIMELAPSE_TAKE_FRAME also starts with T but isn't a tool
+        # change, and the heater of a new tool would be cold).
+        if meta.is_macro():
+            return
+        if meta.function != follower.emuState['tool']:
+            self.tool_change_count += 1
+            self._changed_tool = meta.function
+        follower.setTool(meta.function)
+
+    def _set_tool_temperature(self, follower, meta):
+        # such as {'M': '104', 'S': '210'}
+        self._set_tool(follower, meta)
+
+    def _tool_heat_up(self, follower, meta):
+        # such as {'M': '109', 'S': '210'}
+        result = self._set_tool(follower, meta)
+        if result is None:
+            return
+        tool, cooling = result
+        seconds = self.wait(tool, follower._estS, cooling=cooling)
+        if tool == self._changed_tool:
+            self.tool_change_seconds += seconds
+            self._changed_tool = None
+        self._add_wait(follower, seconds)
+
+    def _set_bed(self, follower, meta):
+        target = self._get_target(follower, meta)
+        if target is None:
+            return None
+        self.set_target(BED, target[0], follower._estS)
+        follower.setBedTemperature(target[0])
+        return target[1]
+
+    def _set_bed_temperature(self, follower, meta):
+        # such as {'M': '140', 'S': '60'}
+        self._set_bed(follower, meta)
+
+    def _bed_heat_up(self, follower, meta):
+        # such as {'M': '190', 'S': '60'}
+        cooling = self._set_bed(follower, meta)
+        if cooling is None:
+            return
+        self._add_wait(follower,
+                       self.wait(BED, follower._estS, cooling=cooling))
+
+    def _auto_home(self, follower, meta):
+        # Like GCodeFollower._emulateAutoHome, assume homing waits for
+        # the tool and bed to be at least autoHomeToolTemperature and
+        # autoHomeBedTemperature (unless None), but heat them at the
+        # same time.
+        now = follower._estS
+        waits = [0.0]
+        for name, minimum in (
+                (follower.emuState['tool'],
+                 follower.autoHomeToolTemperature),
+                (BED, follower.autoHomeBedTemperature)):
+            if minimum is None:
+                continue
+            minimum = float(minimum)
+            heater = self.heater(name)
+            if heater.target < minimum:
+                heater.set_target(minimum, now)
+            seconds = heater.seconds_to(minimum, now)
+            waits.append(seconds or 0.0)
+        self._add_wait(follower, max(waits))
+        follower.setToolTemperature(
+            self.heater(follower.emuState['tool']).target
+        )
+        follower.setBedTemperature(self.heater(BED).target)
+        if self.probing_heaters_off:
+            self.pause(follower._estS, follower.autoHomeMoveTime)
+        follower._estS += follower.autoHomeMoveTime
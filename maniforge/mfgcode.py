@@ -1,15 +1,30 @@
 from __future__ import print_function
 
+import mmap
+import re
 import sys
 
+from contextlib import contextmanager
 from decimal import Decimal
 if sys.version_info.major >= 3:
     from logging import getLogger
+    from sys import intern
 else:
     # Python 2
     from hierosoft.logging2 import getLogger
 
+try:
+    import numpy as np
+except ImportError:
+    # Only GCodeTable (See read_gcode_table) requires numpy.
+    np = None
+
 from maniforge import has_numbers
+from maniforge.gcodediagnostics import (
+    ERROR,
+    INFO,
+    get_default_diagnostics,
+)
 from maniforge.mfmath import show_fewest
 
 logger = getLogger(__name__)
@@ -92,104 +107,181 @@ def changed_cmd(cmd, key, value, precision=5):
     return meta_to_cmd(meta)
 
 
-def get_cmd_meta(cmd):
-    '''
-    Parse the g-code command to a set of lists such as:
-    [['G', '1'], ['X', '110'], ['E', '45'], ['F', '500.0']]
-    [['M', '117'], ['', 'Some message']]
-    '''
-    comment_i = None
+# Each whitespace-separated token is split after its first character,
+# such as "X110" to ('X', '110').
+_cmd_token_pattern = re.compile(r'(\S)(\S*)')
+
+
+def get_cmd_tuples(cmd):
     '''
-    commentMarks = [";", "//"]
-    for commentMark in commentMarks:
-      tryI = cmd.find(commentMark)
-      if tryI >= 0:
-          if (comment_i is None) or (tryI < comment_i):
-              comment_i = tryI
+    Parse the g-code command to a tuple of immutable pairs such as:
+    (('G', '1'), ('X', '110'), ('E', '45'), ('F', '500.0'))
+    (('M', '117'), ('', 'Some message'))
+    (('BED_MESH_PROFILE',), ('LOAD=', 'magnetic-enomaker'))
+
+    This is the tokenizer behind get_cmd_meta. It uses a single
+    precompiled pattern and does not check whether values are numbers
+    (The caller converts values only when they are needed), which makes
+    it about 2x as fast as the old one (See tests/benchmark_mfgcode.py).
+    A parameter with no value (such as X in "G28 X") is a 1-long tuple.
+
+    Returns:
+        tuple: The pairs, or None if the line is blank or only a
+            comment.
     '''
-    tryI = cmd.find(";")
-    if tryI >= 0:
-        # if (comment_i is None) or (tryI < comment_i):
-        comment_i = tryI
-    if cmd.strip().startswith("/"):
+    comment_i = cmd.find(";")
+    if comment_i >= 0:
+        cmd = cmd[:comment_i]
+    tokens = _cmd_token_pattern.findall(cmd)
+    if not tokens:
+        return None
+    k, v = tokens[0]
+    if k == "/":
         # ^ as per <https://www.cnccookbook.com/
         #   g-code-basics-program-format-structure-blocks/>
         # (also takes care of non-standard // comments)
-        comment_i = cmd.find("/")
-    if comment_i is not None:
-        cmd = cmd[0:comment_i]
+        return None
+    if not v[:1].isdigit():
+        function_str = k + v
+        if not has_numbers(function_str):
+            return _get_macro_tuples(function_str, tokens, cmd)
+    elif k == "M" and v == "117":
+        # The rest of the line is the message (See M117 in docstring).
+        return (
+            tokens[0],
+            ('', " ".join([k + v for k, v in tokens[1:]])),
+        )
+    for pair in tokens:
+        if not pair[1]:
+            break
+    else:
+        return tuple(tokens)
+    # There is a parameter with no value (such as: To home X, nothing is
+    # after 'G28 X'):
+    return tuple([pair if pair[1] else pair[:1] for pair in tokens])
+
+
+def _get_macro_tuples(function_str, tokens, cmd):
+    '''
+    Get the get_cmd_tuples result for a Klipper-style macro such as
+    TIMELAPSE_TAKE_FRAME, TIMELAPSE_RENDER, BED_MESH_PROFILE, etc.
+    NOTE: The key of each argument *includes* "=" as a special flag so
+    caller knows it is not a G-code command.
+    '''
+    results = [(function_str,)]
+    for k, v in tokens[1:]:
+        arg = k + v
+        klipperArgEndIdx = arg.find("=")
+        assert klipperArgEndIdx > 0, \
+            "misplaced macro {} in {}".format(repr(arg), repr(cmd))
+        results.append((
+            arg[:klipperArgEndIdx+1],  # +1 to *keep* '=' as flag
+            arg[klipperArgEndIdx+1:],
+        ))
+    return tuple(results)
 
-    cmd = cmd.strip()
-    # print("cmd={}".format(cmd))
-    if len(cmd) < 1:
+
+# These are the bytes versions of _cmd_token_pattern and the one used by
+# has_numbers (for get_cmd_tuples_bytes).
+_cmd_token_bytes_pattern = re.compile(br'(\S)(\S*)')
+_digit_bytes_pattern = re.compile(br'\d')
+
+
+def get_cmd_tuples_bytes(cmd):
+    '''
+    This is the bytes version of get_cmd_tuples, so that a line read in
+    binary mode (such as by iter_mapped_lines) doesn't have to be
+    decoded to be parsed. Each key and value is bytes such as:
+    ((b'G', b'1'), (b'X', b'110'), (b'E', b'45'))
+
+    Sequential arguments:
+    cmd -- A line as bytes (or a bytes-like object such as a
+        memoryview slice, which is copied).
+    '''
+    if not isinstance(cmd, bytes):
+        cmd = bytes(cmd)
+    comment_i = cmd.find(b";")
+    if comment_i >= 0:
+        cmd = cmd[:comment_i]
+    tokens = _cmd_token_bytes_pattern.findall(cmd)
+    if not tokens:
         return None
-    if cmd[0] == ";":
-        # comment
+    k, v = tokens[0]
+    if k == b"/":
         return None
-    parts = cmd.split()
-    cmd_meta = []
-    functionStr = None
-    macro = None
-    for i in range(len(parts)):
-        arg = parts[i]
-        if functionStr is None:
-            if len(arg) < 1:
-                functionStr = ""
-            else:
-                functionStr = arg
-        if macro is not None:
-            klipperArgEndIdx = arg.find("=")
-            # if klipperArgEndIdx > -1
-            assert klipperArgEndIdx > 0
-            # NOTE: *include* = as a special flag
-            #   so caller knows it is not a G-code
-            #   command.
-            cmd_meta.append([
-                arg[:klipperArgEndIdx+1], # +1 to *keep* '=' as flag
-                arg[klipperArgEndIdx+1:]
-            ])
-        elif not has_numbers(arg):
-            # arg.strip() == "TIMELAPSE_TAKE_FRAME":
-            # or TIMELAPSE_RENDER, BED_MESH_PROFILE, etc
-            assert i == 0, \
-                "misplaced macro {} in {}".format(repr(arg), parts)
-            print("Warning: allowing literal \"{}\""
-                  " (assuming it is a Klipper-style macro)"
-                  .format(arg))
-            cmd_meta.append([arg,])
-            macro = arg
-            # fn_strings = parts
-            # if len(fn_strings) == 1:
-            #     cmd_meta.append(fn_strings+[None])
-            # else:
-            #     cmd_meta.append(fn_strings)
-            # break
-        elif len(arg) > 1:
-            k, v = arg[0], arg[1:]
-            if functionStr == "M117":
-                displayStr = " ".join(parts[1:])
-                cmd_meta.append([k, v])
-                cmd_meta.append(['', displayStr])
-                # ^ See M117 in docstring
-                break
-            try:
-                fv = float(v)
-            except ValueError as ex:
-                logger.warning('WARNING: "{}" is not a number in "{}"'
-                               .format(v, cmd))
-            cmd_meta.append([k, v])
-        else:
-            # no value (such as: To home X, nothing is after 'G1 X'):
-            cmd_meta.append([arg[0]])
+    if not v[:1].isdigit():
+        function_str = k + v
+        if not _digit_bytes_pattern.search(function_str):
+            return _get_macro_tuples(function_str, tokens, cmd)
+    elif k == b"M" and v == b"117":
+        return (
+            tokens[0],
+            (b'', b" ".join([k + v for k, v in tokens[1:]])),
+        )
+    for pair in tokens:
+        if not pair[1]:
+            break
+    else:
+        return tuple(tokens)
+    return tuple([pair if pair[1] else pair[:1] for pair in tokens])
+
+
+def get_cmd_meta(cmd, diagnostics=None, line_number=None):
+    '''
+    Parse the g-code command to a set of lists such as:
+    [['G', '1'], ['X', '110'], ['E', '45'], ['F', '500.0']]
+    [['M', '117'], ['', 'Some message']]
+
+    This is a compatibility wrapper that provides the mutable (list)
+    shape used by modify_cmd_meta and reports values that are not
+    numbers. Use get_cmd_tuples instead where the result is only read.
+
+    Keyword arguments:
+    diagnostics -- Where to report problems (See
+        maniforge.gcodediagnostics; default: get_default_diagnostics()).
+    line_number -- The line number to report.
+    '''
+    cmd_tuples = get_cmd_tuples(cmd)
+    if cmd_tuples is None:
+        return None
+    if diagnostics is None:
+        diagnostics = get_default_diagnostics()
+    cmd_meta = [list(pair) for pair in cmd_tuples]
+    if len(cmd_meta[0]) == 1:
+        diagnostics.add(
+            "macro:" + cmd_meta[0][0],
+            "allowing literal \"{}\" (assuming it is a Klipper-style"
+            " macro)".format(cmd_meta[0][0]),
+            line_number=line_number,
+            level=INFO,
+        )
+        return cmd_meta
+    if cmd_meta[0][0] + cmd_meta[0][1] == "M117":
+        return cmd_meta
+    for pair in cmd_meta:
+        if len(pair) < 2:
+            continue
+        try:
+            float(pair[1])
+        except ValueError:
+            diagnostics.add(
+                "not_a_number",
+                '"{}" is not a number in "{}"'.format(pair[1], cmd),
+                line_number=line_number,
+                level=ERROR,
+            )
     return cmd_meta
 
 
-def cmd_meta_dict(cmd_meta):
+def cmd_meta_dict(cmd_meta, diagnostics=None, line_number=None):
     '''
     Change results of get_cmd_meta like
     [['G', '1'], ['X', '110'], ['E', '45'], ['F', '500.0']]
     to a dictionary like:
     {'function': 'G1', 'G': '1', 'X': '110', 'E': '45', 'F': '500.0'}
+
+    Keyword arguments:
+    diagnostics, line_number -- See get_cmd_meta.
     '''
     if cmd_meta is None:
         return None
@@ -197,9 +289,14 @@ def cmd_meta_dict(cmd_meta):
     for pair in cmd_meta:
         if metaD.get('function') is None:
             if len(pair) != 2:
-                logger.warning("WARNING: The G-code command doesn't have"
-                               " 2 parts: {} in {}"
-                               .format(pair, cmd_meta))
+                if diagnostics is None:
+                    diagnostics = get_default_diagnostics()
+                diagnostics.add(
+                    "function_not_2_parts",
+                    "The G-code command doesn't have 2 parts: {} in {}"
+                    "".format(pair, cmd_meta),
+                    line_number=line_number,
+                )
                 metaD['function'] = ''  # prevent gathering it again
             if len(pair) == 1:
                 # Klipper-style macro
@@ -216,3 +313,586 @@ def cmd_meta_dict(cmd_meta):
             k, v = pair[0], pair[1:]
         metaD[k] = v
     return metaD
+
+
+# The decimal places kept for each parameter in the fixed-point mode
+# (See to_fixed): microns for X, Y, Z and F, and 1e-5 mm for E.
+FIXED_PLACES = {
+    'X': 3,
+    'Y': 3,
+    'Z': 3,
+    'E': 5,
+    'F': 3,
+}
+DEFAULT_FIXED_PLACES = 5  # for any other parameter
+try:
+    from _decimal import Decimal as _CDecimal
+    FAST_DECIMAL = Decimal is _CDecimal
+    # ^ Only then is Decimal faster than to_fixed (See
+    #   tests/benchmark_gcodefollower.py). Otherwise (such as on Python
+    #   2 or PyPy) Decimal is implemented in Python and is much slower.
+except ImportError:
+    FAST_DECIMAL = False
+_FIXED_SCALES = [10 ** places for places in range(16)]
+
+
+def to_fixed(value, places):
+    '''
+    Convert a number string to an int in units of 10**-places (such as
+    microns if places is 3), so that it can be compared and subtracted
+    exactly without Decimal.
+
+    If the value has more decimal places than places (or is too long to
+    convert exactly through a float), it is returned as a Decimal in the
+    same units so the result is still exact.
+
+    Sequential arguments:
+    value -- A number string such as "103.931".
+    places -- The number of decimal places in each unit (See
+        FIXED_PLACES).
+
+    Raises:
+        decimal.InvalidOperation: If the value is not a number.
+    '''
+    dot = value.find(".")
+    if (((dot < 0) or (len(value) - dot - 1 <= places))
+            and (len(value) < 16)
+            and ("e" not in value) and ("E" not in value)):
+        # 15 digits or fewer always survive the float exactly enough
+        #   for rounding to get the exact number of units.
+        try:
+            return int(round(float(value) * _FIXED_SCALES[places]))
+        except (ValueError, OverflowError):
+            # such as "nan" or "inf" (Decimal can represent them) or
+            #   invalid (Decimal raises the error).
+            pass
+    return Decimal(value).scaleb(places)
+
+
+def from_fixed(value, places):
+    '''
+    Convert a value from to_fixed back to a Decimal in the original
+    units.
+    '''
+    return Decimal(value).scaleb(-places)
+
+
+class ParsedCommand(object):
+    '''
+    A G-code line that is tokenized once (See get_cmd_tuples) so that
+    every stage of processing can share the result instead of parsing
+    the same text again.
+
+    Public attributes:
+    line -- The source line (The caller should remove the newline).
+    pairs -- The result of get_cmd_tuples (None if the line has no
+        command such as if it is blank or only a comment).
+    function -- The command such as "G1", "T0" or a Klipper-style macro
+        such as "TIMELAPSE_TAKE_FRAME" (None if there is no command). It
+        is interned (See sys.intern).
+    comment_start -- The index where the comment starts in line (-1 if
+        there is no comment).
+    '''
+    __slots__ = (
+        'line',
+        'pairs',
+        'function',
+        'comment_start',
+        '_floats',
+        '_decimals',
+    )
+
+    def __init__(self, line):
+        self.line = line
+        self._floats = None
+        self._decimals = None
+        comment_start = line.find(";")
+        if comment_start < 0:
+            pairs = get_cmd_tuples(line)
+        else:
+            pairs = get_cmd_tuples(line[:comment_start])
+        self.pairs = pairs
+        if pairs is None:
+            self.function = None
+            if (comment_start < 0) and line.lstrip().startswith("/"):
+                comment_start = line.find("/")
+        else:
+            self.function = intern("".join(pairs[0]))
+            # ^ Interned so that looking it up (See gcodehandlers) or
+            #   comparing it to a literal is usually an identity check.
+        self.comment_start = comment_start
+
+    def __repr__(self):
+        return "ParsedCommand({})".format(repr(self.line))
+
+    @property
+    def keys(self):
+        '''
+        Get the parameter letters after the function, such as
+        ('X', 'Y', 'E') (A Klipper-style argument keeps its "=").
+        '''
+        if self.pairs is None:
+            return ()
+        return tuple([pair[0] for pair in self.pairs[1:]])
+
+    @property
+    def values(self):
+        '''
+        Get the raw value string of each key (None where the key has no
+        value, such as X in "G28 X").
+        '''
+        if self.pairs is None:
+            return ()
+        return tuple([(pair[1] if len(pair) > 1 else None)
+                      for pair in self.pairs[1:]])
+
+    @property
+    def comment(self):
+        '''
+        Get the comment including the comment mark (None if none).
+        '''
+        if self.comment_start < 0:
+            return None
+        return self.line[self.comment_start:]
+
+    @property
+    def comment_span(self):
+        '''
+        Get the (start, end) indices of the comment in line (None if
+        none).
+        '''
+        if self.comment_start < 0:
+            return None
+        return (self.comment_start, len(self.line))
+
+    def is_macro(self):
+        '''
+        Check whether the command is a Klipper-style macro (The function
+        has no number, such as TIMELAPSE_TAKE_FRAME).
+        '''
+        return (self.pairs is not None) and (len(self.pairs[0]) == 1)
+
+    def has(self, key):
+        '''
+        Check whether the parameter is present (with or without value).
+        '''
+        pairs = self.pairs
+        if pairs is None:
+            return False
+        for i in range(1, len(pairs)):
+            if pairs[i][0] == key:
+                return True
+        return False
+
+    def get(self, key, default=None):
+        '''
+        Get the raw value string of a parameter like cmd_meta_dict would
+        (None if the parameter has no value, default if not present).
+        '''
+        pairs = self.pairs
+        if pairs is None:
+            return default
+        for i in range(1, len(pairs)):
+            pair = pairs[i]
+            if pair[0] == key:
+                if len(pair) < 2:
+                    return None
+                return pair[1]
+        return default
+
+    def get_float(self, key):
+        '''
+        Get the value of a parameter as a float (None if not present or
+        not set). The result is cached.
+
+        Raises:
+            ValueError: If the value is not a number.
+        '''
+        floats = self._floats
+        if floats is None:
+            floats = self._floats = {}
+        elif key in floats:
+            return floats[key]
+        value = self.get(key)
+        if value is not None:
+            value = float(value)
+        floats[key] = value
+        return value
+
+    def get_decimal(self, key):
+        '''
+        Get the value of a parameter as a Decimal (None if not present
+        or not set). The result is cached.
+
+        Raises:
+            decimal.InvalidOperation: If the value is not a number.
+        '''
+        decimals = self._decimals
+        if decimals is None:
+            decimals = self._decimals = {}
+        elif key in decimals:
+            return decimals[key]
+        value = self.get(key)
+        if value is not None:
+            value = Decimal(value)
+        decimals[key] = value
+        return value
+
+
+@contextmanager
+def map_gcode_file(path):
+    '''
+    Memory-map a G-code file (read-only) for the duration of a with
+    statement, such as:
+    with map_gcode_file(path) as mapped:
+        for start, end in iter_line_spans(mapped):
+            line = memoryview(mapped)[start:end]
+
+    An empty file (which can't be mapped) is provided as b"".
+    '''
+    with open(path, 'rb') as ins:
+        try:
+            mapped = mmap.mmap(ins.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # "cannot mmap an empty file"
+            yield b""
+            return
+        try:
+            yield mapped
+        finally:
+            mapped.close()
+
+
+def iter_line_spans(buffer, start=0):
+    '''
+    Yield the (start, end) byte offsets of each line in buffer (such as
+    from map_gcode_file), where end is after the newline (so
+    buffer[start:end] is the line exactly as stored and the next line
+    starts at end).
+    '''
+    size = len(buffer)
+    find = buffer.find
+    while start < size:
+        end = find(b"\n", start)
+        if end < 0:
+            end = size
+        else:
+            end += 1
+        yield start, end
+        start = end
+
+
+def iter_mapped_lines(path, start=0):
+    '''
+    Yield (offset, line) for each line in a G-code file where offset is
+    the exact byte position where the line starts and line is bytes
+    (including the newline if any) read from a memory map.
+
+    Keyword arguments:
+    start -- Start at this byte offset, such as the start of a layer
+        from a LayerIndex (It must be the start of a line).
+    '''
+    with map_gcode_file(path) as mapped:
+        if start >= len(mapped):
+            return
+        mapped.seek(start)
+        offset = start
+        readline = mapped.readline
+        line = readline()
+        while line:
+            yield offset, line
+            offset += len(line)
+            line = readline()
+
+
+# Bytes that read_gcode_table accepts in a parameter value (others such
+# as in a Klipper-style argument like EXTRUDER=extruder make it NaN).
+_NUMBER_BYTES = b"0123456789.+-"
+
+# Gather this many tokens at a time in _gather_tokens to limit memory.
+_GATHER_CHUNK = 1 << 18
+
+
+def _gather_tokens(raw, starts, ends, width):
+    '''
+    Copy each token (raw[start:end]) into a row of a 2D uint8 array that
+    is width wide and padded with 0 (so it can be viewed as bytes).
+    '''
+    chars = np.zeros((len(starts), width), dtype=np.uint8)
+    offsets = np.arange(width)
+    last = len(raw) - 1
+    for i in range(0, len(starts), _GATHER_CHUNK):
+        chunk_starts = starts[i:i+_GATHER_CHUNK, None]
+        indices = chunk_starts + offsets
+        valid = indices < ends[i:i+_GATHER_CHUNK, None]
+        chars[i:i+_GATHER_CHUNK] = np.where(
+            valid,
+            raw[np.minimum(indices, last)],
+            0,
+        )
+    return chars
+
+
+def _tokens_to_floats(raw, starts, ends):
+    '''
+    Convert each value (raw[start:end]) to a float. A value that is
+    empty or not a number becomes NaN.
+    '''
+    results = np.full(len(starts), np.nan)
+    if not len(starts):
+        return results
+    lengths = ends - starts
+    width = int(lengths.max())
+    if width < 1:
+        return results
+    chars = _gather_tokens(raw, starts, ends, width)
+    numeric = np.isin(chars, np.frombuffer(_NUMBER_BYTES + b"\0",
+                                           dtype=np.uint8))
+    ok = numeric.all(axis=1) & (lengths > 0)
+    strings = chars[ok].view("S{}".format(width)).reshape(-1)
+    try:
+        results[ok] = strings.astype(np.float64)
+    except ValueError:
+        # Something such as "-" or "1.2.3" is not a number, so only
+        # skip those.
+        values = []
+        for string in strings:
+            try:
+                values.append(float(string))
+            except ValueError:
+                values.append(np.nan)
+        results[ok] = values
+    return results
+
+
+class GCodeTable(object):
+    '''
+    A columnar (struct-of-arrays) form of the commands in a G-code file
+    for analysis with vectorized numpy operations. Each row is one line
+    that has a command (blank lines & comments are skipped). Create it
+    using read_gcode_table or parse_gcode_table.
+
+    Public attributes:
+    functions -- A tuple of unique function names such as "G1" sorted
+        by name. The function_id column indexes this.
+    function_id -- The index in functions for each row (int32 array).
+    X, Y, Z, E, F -- The parameter value for each row (float64 arrays)
+        which are NaN where the command doesn't have the parameter.
+        The values are as written (relative or absolute depending on
+        the G90/G91/M82/M83 mode at the time).
+    I, J, R -- The center offsets and radius of arcs (See ARC_PARAMS),
+        which are only parsed if there is a G2 or G3 (otherwise NaN).
+    line_number -- The line number (counting from 1) for each row.
+    byte_offset -- The offset of the start of the line in the file.
+    '''
+    AXES = ('X', 'Y', 'Z', 'E', 'F')
+    ARC_PARAMS = ('I', 'J', 'R')
+    ARC_FUNCTIONS = ("G2", "G3")
+
+    def __init__(self, functions, function_id, columns, line_number,
+                 byte_offset):
+        self.functions = tuple(functions)
+        self.function_id = function_id
+        for axis in GCodeTable.AXES:
+            setattr(self, axis, columns[axis])
+        for name in GCodeTable.ARC_PARAMS:
+            column = columns.get(name)
+            if column is None:
+                column = np.full(len(function_id), np.nan)
+            setattr(self, name, column)
+        self.line_number = line_number
+        self.byte_offset = byte_offset
+
+    def __len__(self):
+        return len(self.function_id)
+
+    def column(self, name):
+        '''
+        Get a parameter column such as "X" by name.
+        '''
+        names = GCodeTable.AXES + GCodeTable.ARC_PARAMS
+        if name not in names:
+            raise KeyError("{} is not one of {}"
+                           "".format(repr(name), names))
+        return getattr(self, name)
+
+    def function_mask(self, *names):
+        '''
+        Get a boolean array that is True for each row where the command
+        is any of the given names (such as "G0", "G1").
+        '''
+        mask = np.zeros(len(self), dtype=bool)
+        for name in names:
+            if name in self.functions:
+                mask |= (self.function_id == self.functions.index(name))
+        return mask
+
+    def function_counts(self):
+        '''
+        Get a dict of how many times each function occurs.
+        '''
+        counts = np.bincount(self.function_id,
+                             minlength=len(self.functions))
+        return dict(zip(self.functions, counts.tolist()))
+
+    @staticmethod
+    def forward_fill(values, initial=float("nan")):
+        '''
+        Replace each NaN with the last value that is not NaN (or with
+        initial if there is no previous value) such as to get the modal
+        (current) feed rate or Z for every row.
+        '''
+        present = ~np.isnan(values)
+        indices = np.where(present, np.arange(len(values)), -1)
+        np.maximum.accumulate(indices, out=indices)
+        filled = values[np.maximum(indices, 0)]
+        if len(filled):
+            filled = np.where(indices < 0, initial, filled)
+        return filled
+
+    def layer_changes(self, max_layer_z=None):
+        '''
+        Detect layer changes from Z moves (G0/G1 with a Z parameter).
+
+        Keyword arguments:
+        max_layer_z -- Ignore Z moves higher than this (such as to skip
+            a Z lift at the end of the print).
+
+        Returns:
+            numpy.ndarray: The row index of each Z move that reaches a
+            height not reached before (such as for finding where each
+            layer starts).
+        '''
+        moves = np.flatnonzero(self.function_mask("G0", "G1")
+                               & ~np.isnan(self.Z))
+        z = self.Z[moves]
+        if max_layer_z is not None:
+            keep = z <= max_layer_z
+            moves = moves[keep]
+            z = z[keep]
+        if not len(z):
+            return moves
+        previous_max = np.maximum.accumulate(
+            np.concatenate(([-np.inf], z[:-1]))
+        )
+        return moves[z > previous_max]
+
+
+def parse_gcode_table(data):
+    '''
+    Parse G-code (bytes) to a GCodeTable using whole-buffer numpy
+    operations instead of making a Python object for each line.
+
+    The first token of each line is the function. Only X, Y, Z, E & F
+    parameters (and I, J & R if there are arcs) are kept (The value is
+    NaN if it is not a number, such as in a Klipper-style argument like
+    EXTRUDER=extruder). Anything after ";" is a comment, and a line
+    starting with "/" is skipped.
+    '''
+    if np is None:
+        raise ImportError("GCodeTable requires numpy.")
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    raw = np.frombuffer(data, dtype=np.uint8)
+    size = len(raw)
+    newlines = np.flatnonzero(raw == ord("\n"))
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [size]))
+    if line_starts[-1] >= size:
+        # The data ends with a newline (not an additional line).
+        line_starts = line_starts[:-1]
+        line_ends = line_ends[:-1]
+
+    # Mark comments: +1 at the first ";" of a line and -1 at the end of
+    # that line, so the running sum is 1 only inside of comments.
+    semicolons = np.flatnonzero(raw == ord(";"))
+    semicolon_lines = np.searchsorted(line_starts, semicolons,
+                                      side="right") - 1
+    first_semicolon = np.ones(len(semicolons), dtype=bool)
+    first_semicolon[1:] = semicolon_lines[1:] != semicolon_lines[:-1]
+    marks = np.zeros(size + 1, dtype=np.int8)
+    marks[semicolons[first_semicolon]] = 1
+    marks[line_ends[semicolon_lines[first_semicolon]]] -= 1
+    is_separator = np.cumsum(marks[:-1], dtype=np.int8) > 0
+    for separator in b" \t\r\n":
+        is_separator |= raw == separator
+
+    # Find tokens (runs of bytes that are not separators):
+    is_start = ~is_separator
+    is_start[1:] &= is_separator[:-1]
+    starts = np.flatnonzero(is_start)
+    separators = np.append(np.flatnonzero(is_separator), size)
+    ends = separators[np.searchsorted(separators, starts)]
+    token_lines = np.searchsorted(line_starts, starts, side="right") - 1
+    is_first = np.ones(len(starts), dtype=bool)
+    is_first[1:] = token_lines[1:] != token_lines[:-1]
+
+    # The first token of each line is the function (unless "/"):
+    function_starts = starts[is_first]
+    function_ends = ends[is_first]
+    rows_line = token_lines[is_first]
+    has_command = raw[function_starts] != ord("/")
+    function_starts = function_starts[has_command]
+    function_ends = function_ends[has_command]
+    rows_line = rows_line[has_command]
+    row_count = len(rows_line)
+    function_id = np.zeros(row_count, dtype=np.int32)
+    functions = []
+    if row_count:
+        lengths = function_ends - function_starts
+        short = lengths <= 8
+        chars = _gather_tokens(raw, function_starts[short],
+                               function_ends[short], 8)
+        short_names, short_ids = np.unique(
+            chars.view("S8").reshape(-1),
+            return_inverse=True,
+        )
+        names = [name.decode("utf-8") for name in short_names]
+        long_rows = np.flatnonzero(~short)
+        long_names = [
+            data[start:end].decode("utf-8")
+            for start, end in zip(function_starts[long_rows].tolist(),
+                                  function_ends[long_rows].tolist())
+        ]
+        functions = sorted(set(names) | set(long_names))
+        name_ids = dict((name, i) for i, name in enumerate(functions))
+        short_map = np.array([name_ids[name] for name in names],
+                             dtype=np.int32)
+        function_id[short] = short_map[short_ids.reshape(-1)]
+        function_id[long_rows] = [name_ids[name] for name in long_names]
+    row_of_line = np.full(len(line_starts), -1, dtype=np.int64)
+    row_of_line[rows_line] = np.arange(row_count)
+
+    # The other tokens are parameters:
+    letters = raw[starts]
+    columns = {}
+    names = GCodeTable.AXES
+    if set(GCodeTable.ARC_FUNCTIONS) & set(functions):
+        names += GCodeTable.ARC_PARAMS
+    for axis in names:
+        is_axis = ~is_first & (letters == ord(axis))
+        rows = row_of_line[token_lines[is_axis]]
+        on_row = rows >= 0
+        # ^ False if on a line without a command (such as after "/")
+        column = np.full(row_count, np.nan)
+        column[rows[on_row]] = _tokens_to_floats(
+            raw,
+            starts[is_axis][on_row] + 1,
+            ends[is_axis][on_row],
+        )
+        columns[axis] = column
+    return GCodeTable(
+        functions,
+        function_id,
+        columns,
+        rows_line + 1,
+        line_starts[rows_line],
+    )
+
+
+def read_gcode_table(path):
+    '''
+    Load a whole G-code file as a GCodeTable (See parse_gcode_table).
+    '''
+    with open(path, 'rb') as ins:
+        return parse_gcode_table(ins.read())
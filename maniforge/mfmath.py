@@ -6,17 +6,35 @@ import math
 
 def show_fewest(n):
     '''
-    Display only decimal places that are not 0.
+    Display only decimal places that are not 0 (such as "170" for
+    170.0, but not "17").
 
     Sequential arguments:
     n -- a float/Decimal value.
     '''
     s = "{}".format(n)
-    while s.endswith(".0") or s.endswith("0"):
-        s = s[:-1]
+    if ("." in s) and ("e" not in s.lower()):
+        s = s.rstrip("0").rstrip(".")
     return s
 
 
+def show_places(n, places):
+    '''
+    Display n rounded to a number of decimal places, but only decimal
+    places that are not 0 (and never "-0"), such as for a G-code
+    parameter.
+
+    Sequential arguments:
+    n -- a float/Decimal value.
+    places -- The most decimal places.
+    '''
+    s = "{:.{}f}".format(n, places)
+    if "." in s:
+        s = s.rstrip("0").rstrip(".")
+    if s in ("-0", ""):
+        return "0"
+    return s
+
 
 def round_up(n, decimals=0):
     # See <https://realpython.com/python-rounding/
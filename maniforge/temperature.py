@@ -45,6 +45,11 @@ def usage():
     print("  " + sys.argv[0] + " 190 210")
     # print(sys.argv[0] + " tower.gcode")
     print("  " + sys.argv[0] + " tower.gcode 190 210")
+    print("  " + sys.argv[0] + " tower.gcode --batch=190-210,230-250/10")
+    print("  (--batch makes a tower for each range, reading the template"
+          " once for each")
+    print("  different number of temperatures: twice here since the"
+          " ranges have 5 and 3)")
     print("")
 
 
@@ -57,6 +62,10 @@ class Application():
         gcode = GCodeFollower(echo_callback=self.echo,
                               enable_ui_callback=self.enableUI,
                               verbose=runParams.verbose)
+        gcode.collectMetrics = runParams.metrics
+        gcode.workers = runParams.workers
+        gcode.preheatLevels = runParams.preheat
+        gcode.overlapHeating = runParams.overlap_heating
 
         gcode.saveDocumentationOnce()
         if self.generateTimer is not None:
@@ -105,6 +114,8 @@ class Application():
             if not os.path.isfile(gcode._settingsPath):
                 gcode.saveSettings()
             return 3
+        if runParams.variants is not None:
+            return self.generateTowers(runParams.variants)
         return self.generateTower()
 
     def enableUI(self, enable):
@@ -130,6 +141,13 @@ class Application():
         self.generateTimer.start()
         return 0
 
+    def generateTowers(self, variants):
+        gcode.enableUI(False)
+        self.generateTimer = threading.Timer(0.01, gcode.generateTowers,
+                                             args=[variants])
+        self.generateTimer.start()
+        return 0
+
 
 def main():
     global runParams
@@ -74,6 +74,10 @@ class ConfigurationFrame(ttk.Frame):
         gcode = GCodeFollower(echo_callback=self.echo,
                               enable_ui_callback=self.enableUI,
                               verbose=runParams.verbose)
+        gcode.collectMetrics = runParams.metrics
+        gcode.workers = runParams.workers
+        gcode.preheatLevels = runParams.preheat
+        gcode.overlapHeating = runParams.overlap_heating
         gcode.loadSettings()
         gcode.saveDocumentationOnce()
         self.generateTimer = None
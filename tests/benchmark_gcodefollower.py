@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Compare the speed of GCodeFollower._generateTower with the fixed-point
+coordinate mode (See maniforge.mfgcode.to_fixed) to the Decimal mode
+on a generated template, and make sure both produce the same tower and
+stats. The parameter stage (what the mode changes) is also timed alone.
+
+Usage:
+python3 tests/benchmark_gcodefollower.py [layer_count]
+'''
+from __future__ import print_function
+from __future__ import division
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from decimal import Decimal
+
+if __name__ == "__main__":
+    # Allow import if ran directly
+    TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+    REPO_DIR = os.path.dirname(TESTS_DIR)
+    sys.path.insert(0, REPO_DIR)
+
+from maniforge.gcodefollower import GCodeFollower
+from maniforge.mfgcode import (
+    DEFAULT_FIXED_PLACES,
+    FAST_DECIMAL,
+    FIXED_PLACES,
+    from_fixed,
+    get_cmd_tuples,
+    to_fixed,
+)
+
+
+def write_template(path, layer_count):
+    '''
+    Write a sliced-looking tower (a square with infill on each layer).
+    '''
+    with open(path, 'w') as outs:
+        outs.write("M190 S60\nM109 S210\nG28\nG90\nM83\nG92 E0\n")
+        for layer in range(layer_count):
+            z = 0.2 + layer * 0.2
+            outs.write(";LAYER_CHANGE\n")
+            outs.write("G1 F1500 E-0.8\n")
+            outs.write("G1 Z{:.3f} F720\n".format(z))
+            outs.write("G0 F4200 X100.000 Y100.000\n")
+            outs.write("G1 F1500 E0.8\n")
+            outs.write("G1 F1200\n")
+            for i in range(40):
+                offset = (i % 20) * 0.5
+                outs.write("G1 X{:.3f} Y{:.3f} E{:.5f}\n".format(
+                    110.0 - offset, 100.0 + offset, 0.03215 + i * 1e-5))
+            outs.write("M106 S255\n")
+        outs.write("G1 E-2 F1800 ; retract filament slightly\n")
+        outs.write("G91\nG1 Z10\nG90\nM104 S0\nM140 S0\nM84\n")
+
+
+def decimal_params(pairs, max_z_move):
+    '''
+    Do what the Decimal mode does with each parameter: convert it,
+    keep the E total, and compare the Z delta to max_z_move.
+    '''
+    previous_z = None
+    net_e = Decimal(0)
+    build_moves = 0
+    for key, raw in pairs:
+        value = Decimal(raw)
+        if key == "E":
+            net_e += Decimal(value)
+        elif key == "Z":
+            if previous_z is not None:
+                if abs(value - previous_z) <= max_z_move:
+                    build_moves += 1
+            previous_z = value
+    return net_e, build_moves
+
+
+def fixed_params(pairs, max_z_move):
+    '''
+    Do the same as decimal_params in the fixed-point mode.
+    '''
+    max_z_move = to_fixed(str(max_z_move), FIXED_PLACES['Z'])
+    previous_z = None
+    net_e = 0
+    build_moves = 0
+    for key, raw in pairs:
+        value = to_fixed(raw, FIXED_PLACES.get(key, DEFAULT_FIXED_PLACES))
+        if key == "E":
+            net_e += value
+        elif key == "Z":
+            if previous_z is not None:
+                if abs(value - previous_z) <= max_z_move:
+                    build_moves += 1
+            previous_z = value
+    return from_fixed(net_e, FIXED_PLACES['E']), build_moves
+
+
+def time_fn(fn, *args):
+    '''
+    Get the best time (in seconds) and the result of 3 calls of fn.
+    '''
+    best = None
+    result = None
+    for _ in range(3):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best, result
+
+
+def run(mode, work_dir, template_name, temperatures):
+    follower = GCodeFollower(echo_callback=lambda msg: None)
+    follower.cacheTowerPlans = False
+    follower.coordinateMode = mode
+    follower.setVar("template_gcode_path", template_name)
+    follower.setRangeVars("temperature", *temperatures)
+    follower.checkSettings()
+    start = time.perf_counter()
+    follower.generateTower()
+    elapsed = time.perf_counter() - start
+    dst_path = os.path.join(
+        work_dir,
+        follower.getRangeString("temperature") + "_" + template_name
+    )
+    with open(dst_path, 'rb') as ins:
+        tower = ins.read()
+    return elapsed, tower, follower.stats
+
+
+def main():
+    layer_count = 800
+    if len(sys.argv) > 1:
+        layer_count = int(sys.argv[1])
+    temperatures = (180, 300)  # Enough for every level (no truncation)
+    work_dir = tempfile.mkdtemp()
+    prev_dir = os.getcwd()
+    try:
+        os.chdir(work_dir)  # _generateTower saves files in the cwd.
+        template_name = "benchmark.gcode"
+        write_template(template_name, layer_count)
+        pairs = []
+        with open(template_name, 'r') as ins:
+            for line in ins:
+                cmd_meta = get_cmd_tuples(line)
+                if cmd_meta is None:
+                    continue
+                for pair in cmd_meta[1:]:
+                    if len(pair) == 2:
+                        pairs.append(pair)
+        max_z_move = Decimal("1.20")
+        decimal_params_s, decimal_result = time_fn(decimal_params, pairs,
+                                                   max_z_move)
+        fixed_params_s, fixed_result = time_fn(fixed_params, pairs,
+                                               max_z_move)
+        if fixed_result != decimal_result:
+            raise AssertionError("{} != {}".format(fixed_result,
+                                                   decimal_result))
+        results = {}
+        for mode in ("decimal", "fixed"):
+            best = None
+            for _ in range(3):
+                elapsed, tower, stats = run(mode, work_dir, template_name,
+                                            temperatures)
+                if (best is None) or (elapsed < best):
+                    best = elapsed
+            results[mode] = (best, tower, stats)
+    finally:
+        os.chdir(prev_dir)
+        shutil.rmtree(work_dir)
+    decimal_s, decimal_tower, decimal_stats = results["decimal"]
+    fixed_s, fixed_tower, fixed_stats = results["fixed"]
+    if fixed_tower != decimal_tower:
+        raise AssertionError("The fixed mode changed the tower.")
+    if fixed_stats != decimal_stats:
+        raise AssertionError("The fixed mode changed the stats: {} != {}"
+                             "".format(fixed_stats, decimal_stats))
+    print("C decimal (FAST_DECIMAL): {}".format(FAST_DECIMAL))
+    print("layers: {}".format(layer_count))
+    print("parameters: {}".format(len(pairs)))
+    print("decimal parameters: {:.3f}s".format(decimal_params_s))
+    print("fixed parameters: {:.3f}s ({:.2f}x)"
+          "".format(fixed_params_s, decimal_params_s / fixed_params_s))
+    print("decimal tower: {:.3f}s".format(decimal_s))
+    print("fixed tower: {:.3f}s ({:.2f}x)"
+          "".format(fixed_s, decimal_s / fixed_s))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
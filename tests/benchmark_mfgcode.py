@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+'''
+Compare the speed of the G-code tokenizer in maniforge.mfgcode to the
+original split-based tokenizer (kept below as legacy_get_cmd_meta so
+results stay comparable across releases).
+
+The goal is TARGET_SPEEDUP, which is not reached yet: get_cmd_tuples is
+about 2-2.5x as fast, and most of what is left is making the (key,
+value) pairs themselves (A str.split or bytes.split of each line alone
+takes about as long), so a faster tokenizer of the same form won't
+reach it. The exit code is 1 while it isn't reached.
+
+Usage:
+python3 tests/benchmark_mfgcode.py [line_count]
+'''
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+
+if __name__ == "__main__":
+    # Allow import if ran directly
+    TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
+    REPO_DIR = os.path.dirname(TESTS_DIR)
+    sys.path.insert(0, REPO_DIR)
+
+from maniforge import has_numbers
+from maniforge.mfgcode import get_cmd_tuples
+
+
+def legacy_get_cmd_meta(cmd):
+    '''
+    The tokenizer as it was before get_cmd_tuples (without the
+    warnings, so console output does not affect the timing).
+    '''
+    comment_i = None
+    tryI = cmd.find(";")
+    if tryI >= 0:
+        comment_i = tryI
+    if cmd.strip().startswith("/"):
+        comment_i = cmd.find("/")
+    if comment_i is not None:
+        cmd = cmd[0:comment_i]
+    cmd = cmd.strip()
+    if len(cmd) < 1:
+        return None
+    if cmd[0] == ";":
+        return None
+    parts = cmd.split()
+    cmd_meta = []
+    functionStr = None
+    macro = None
+    for i in range(len(parts)):
+        arg = parts[i]
+        if functionStr is None:
+            if len(arg) < 1:
+                functionStr = ""
+            else:
+                functionStr = arg
+        if macro is not None:
+            klipperArgEndIdx = arg.find("=")
+            assert klipperArgEndIdx > 0
+            cmd_meta.append([
+                arg[:klipperArgEndIdx+1],
+                arg[klipperArgEndIdx+1:]
+            ])
+        elif not has_numbers(arg):
+            assert i == 0, \
+                "misplaced macro {} in {}".format(repr(arg), parts)
+            cmd_meta.append([arg,])
+            macro = arg
+        elif len(arg) > 1:
+            k, v = arg[0], arg[1:]
+            if functionStr == "M117":
+                displayStr = " ".join(parts[1:])
+                cmd_meta.append([k, v])
+                cmd_meta.append(['', displayStr])
+                break
+            try:
+                fv = float(v)  # noqa: F841
+            except ValueError:
+                pass
+            cmd_meta.append([k, v])
+        else:
+            cmd_meta.append([arg[0]])
+    return cmd_meta
+
+
+TARGET_SPEEDUP = 4.0
+# ^ "several-fold" compared to legacy_get_cmd_meta
+
+# Roughly the mix of a sliced file (mostly extrusion moves, with a few
+# travel moves, retractions, comments and per-layer commands).
+SAMPLE_LINES = [
+    "G1 X103.931 Y57.516 E0.03215",
+    "G1 X104.251 Y57.836 E0.01512",
+    "G1 X104.571 Y58.156 E0.01512",
+    "G1 X104.891 Y58.476 E0.01512",
+    "G1 X110.125 Y58.476 E0.17203",
+    "G1 X110.125 Y63.710 E0.17203",
+    "G1 X104.891 Y63.710 E0.17203",
+    "G1 X104.891 Y58.796 E0.16152",
+    "G1 F1500 E-0.8 ; retract",
+    "G0 F4200 X103.451 Y57.996",
+    "G1 F1500 E0.8",
+    "G1 F1200 X103.771 Y58.316 E0.01512",
+    "G1 X104.091 Y58.636 E0.01512",
+    "G1 X104.411 Y58.956 E0.01512",
+    "G1 X109.645 Y58.956 E0.17203",
+    "G1 X109.645 Y63.230 E0.14047",
+    ";TYPE:WALL-OUTER",
+    "G1 Z0.32 F9000",
+    "M106 S255",
+    "TIMELAPSE_TAKE_FRAME",
+]
+
+
+def make_lines(count):
+    lines = []
+    sample_count = len(SAMPLE_LINES)
+    for i in range(count):
+        lines.append(SAMPLE_LINES[i % sample_count])
+    return lines
+
+
+def time_fn(fn, lines, repeat=3):
+    '''
+    Get the best time (in seconds) of calling fn on each line.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            fn(line)
+        elapsed = time.perf_counter() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    lines = make_lines(count)
+    for line in SAMPLE_LINES:
+        legacy = legacy_get_cmd_meta(line)
+        if legacy is not None:
+            legacy = [tuple(pair) for pair in legacy]
+        fast = get_cmd_tuples(line)
+        if fast is not None:
+            fast = list(fast)
+        if legacy != fast:
+            raise AssertionError("{} != {} for {}"
+                                 "".format(fast, legacy, repr(line)))
+    legacy_s = time_fn(legacy_get_cmd_meta, lines)
+    fast_s = time_fn(get_cmd_tuples, lines)
+    print("lines: {}".format(count))
+    print("legacy_get_cmd_meta: {:.3f}s".format(legacy_s))
+    speedup = legacy_s / fast_s
+    print("get_cmd_tuples: {:.3f}s ({:.1f}x)".format(fast_s, speedup))
+    if speedup < TARGET_SPEEDUP:
+        print("The target of {:.1f}x was not reached."
+              "".format(TARGET_SPEEDUP))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
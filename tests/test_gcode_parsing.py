@@ -1,6 +1,10 @@
+import io
 import os
+import shutil
 import sys
+import tempfile
 import unittest
+import math
 from decimal import Decimal
 
 
@@ -10,9 +14,67 @@ if __name__ == "__main__":
     REPO_DIR = os.path.dirname(TESTS_DIR)
     sys.path.insert(0, REPO_DIR)
 
-from gcodefollower import (
+from maniforge.gcodearc import ArcWelder
+from maniforge.gcodediagnostics import (
+    Diagnostics,
+    GCodeDiagnosticError,
+)
+from maniforge.gcodeestimate import estimate_gcode
+from maniforge.gcodefollower import GCodeFollower
+from maniforge.gcodeindex import (
+    build_layer_index,
+    get_layer_index,
+    layer_index_path,
+)
+from maniforge.gcodemetrics import GCodeMetrics
+from maniforge.gcodeminify import Minifier
+from maniforge.gcodeparallel import (
+    LineRun,
+    apply_line_run,
+    chunk_modes,
+    iter_scanned_lines,
+    scan_chunk,
+)
+from maniforge.gcodepipeline import (
+    EstimateTap,
+    LevelTracker,
+    Preheat,
+    TemperatureSplicer,
+    ToolStandby,
+    Truncate,
+    run_pipeline,
+)
+from maniforge.gcodeplan import (
+    TowerPlan,
+    TowerPlanRecorder,
+    normalize_lines,
+)
+from maniforge.gcodeplanner import (
+    PlannerLimits,
+    plan_table,
+)
+from maniforge.gcodeprecision import (
+    PrecisionTrimmer,
+    get_step,
+)
+from maniforge.gcodesimplify import (
+    Simplifier,
+    simplify_gcode,
+)
+from maniforge.gcodestart import HeaterOverlap
+from maniforge.gcodethermal import (
+    BED,
+    ThermalModel,
+)
+from maniforge.mfgcode import (
+    ParsedCommand,
     changed_cmd,
     get_cmd_meta,
+    get_cmd_tuples,
+    get_cmd_tuples_bytes,
+    iter_mapped_lines,
+    np,
+    parse_gcode_table,
 )
 
 
@@ -25,6 +87,8 @@ class Testing(unittest.TestCase):
         self.assertEqual(new, expected)
         new = changed_cmd(old, 'Z', .4)
         self.assertEqual(new, expected)
+        new = changed_cmd(old, 'Z', 170.0)
+        self.assertEqual(new, "G0 F9000 X27.781 Y32.781 Z170")
 
     def test_get_cmd_meta(self):
         self.assertEqual(
@@ -39,6 +103,949 @@ class Testing(unittest.TestCase):
             # ^ '=' is kept as a flag to denote it is not G-code
         )
 
+    def test_get_cmd_meta_m117(self):
+        self.assertEqual(
+            get_cmd_meta("M117 Printing  level 2 ; comment"),
+            [['M', '117'], ['', 'Printing level 2']]
+        )
+
+    def test_get_cmd_tuples(self):
+        self.assertEqual(
+            get_cmd_tuples(" G1 X110 E45 F500.0 ; move"),
+            (('G', '1'), ('X', '110'), ('E', '45'), ('F', '500.0'))
+        )
+        self.assertEqual(
+            get_cmd_tuples("G28 X Y"),
+            (('G', '28'), ('X',), ('Y',))
+        )
+        self.assertEqual(
+            get_cmd_tuples("TIMELAPSE_TAKE_FRAME"),
+            (('TIMELAPSE_TAKE_FRAME',),)
+        )
+        self.assertIsNone(get_cmd_tuples("  ; only a comment"))
+        self.assertIsNone(get_cmd_tuples("// non-standard comment"))
+        self.assertIsNone(get_cmd_tuples(""))
+
+    def test_parsed_command(self):
+        command = ParsedCommand("G1 X110 E45 F500.0 ; move")
+        self.assertEqual(command.function, "G1")
+        self.assertEqual(command.keys, ('X', 'E', 'F'))
+        self.assertEqual(command.values, ('110', '45', '500.0'))
+        self.assertEqual(command.comment, "; move")
+        self.assertEqual(command.get('E'), '45')
+        self.assertIsNone(command.get('Z'))
+        self.assertEqual(command.get_float('F'), 500.0)
+        self.assertEqual(command.get_decimal('X'), Decimal("110"))
+        command = ParsedCommand("G28 X")
+        self.assertTrue(command.has('X'))
+        self.assertIsNone(command.get('X'))
+        command = ParsedCommand("; only a comment")
+        self.assertIsNone(command.function)
+        self.assertEqual(command.comment_span, (0, 16))
+
+    def test_get_cmd_tuples_bytes(self):
+        self.assertEqual(
+            get_cmd_tuples_bytes(b" G1 X110 E45 F500.0 ; move"),
+            ((b'G', b'1'), (b'X', b'110'), (b'E', b'45'), (b'F', b'500.0'))
+        )
+
+    def test_iter_mapped_lines(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "offsets.gcode")
+            with open(path, 'wb') as outs:
+                outs.write(b"G28\r\n; comment\nG1 Z0.2")
+            self.assertEqual(
+                list(iter_mapped_lines(path)),
+                [(0, b"G28\r\n"), (5, b"; comment\n"), (15, b"G1 Z0.2")]
+            )
+            empty_path = os.path.join(tmp_dir, "empty.gcode")
+            with open(empty_path, 'wb') as outs:
+                pass
+            self.assertEqual(list(iter_mapped_lines(empty_path)), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_layer_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "layers.gcode")
+            with open(path, 'wb') as outs:
+                outs.write(
+                    b"G28\n"
+                    b"G1 Z0.2 F720\n"
+                    b"G1 X10 Y10 E1\n"
+                    b"G1 Z0.6\n"  # Z hop (no extrusion)
+                    b"G1 X20 Y20\n"
+                    b"G1 Z0.2\n"
+                    b"G1 X20 Y30 E2\n"
+                    b"G1 Zabc\n"  # skipped (See diagnostics)
+                    b"G1 Z0.4\n"
+                    b"G1 X30 Y30 E3\n"
+                )
+            diagnostics = Diagnostics()
+            index = build_layer_index(path, diagnostics=diagnostics)
+            self.assertEqual(diagnostics.get("not_a_number").line_numbers,
+                             [8])
+            self.assertEqual(index.source, "z")
+            self.assertEqual(index.heights, [0.2, 0.4])
+            self.assertEqual(index.line_numbers, [2, 9])
+            self.assertEqual(index.offsets, [4, 80])
+            self.assertEqual(index.extruded, [0.0, 2.0])
+            self.assertEqual(index.layer_at_height(0.3)[1], 9)
+            self.assertIsNone(index.layer_at_height(1.0))
+            self.assertFalse(os.path.isfile(layer_index_path(path)))
+            get_layer_index(path)
+            self.assertTrue(os.path.isfile(layer_index_path(path)))
+            self.assertEqual(get_layer_index(path).to_dict(),
+                             index.to_dict())
+            with open(path, 'ab') as outs:
+                outs.write(b";LAYER_CHANGE\nG1 Z0.6\nG1 X40 E4\n")
+            index = get_layer_index(path)
+            self.assertEqual(index.source, "marker")
+            self.assertEqual(index.heights, [0.6])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_tower_plan(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "plan.gcode")
+            with open(path, 'wb') as outs:
+                outs.write(b"G28\nM109 S210\nG1 Z0.2 \nG1 Z10\n"
+                           b"G1 X1 \r\n; note \r\nG1 X2\n")
+            stream = io.StringIO()
+            recorder = TowerPlanRecorder(stream)
+            recorder.source(0, b"G28\n")
+            recorder.write("G28\n")
+            recorder.source(4, b"M109 S210\n")
+            recorder.write_slot("M109 S200\n", 0, "M109 S{:d}\n")
+            recorder.source(14, b"G1 Z0.2 \n")
+            recorder.write("G1 Z0.2\n")
+            recorder.source(23, b"G1 Z10\n")
+            recorder.write("G1 Z10\n")
+            recorder.source(30, b"G1 X1 \r\n")
+            recorder.write("G1 X1\n")
+            recorder.source(38, b"; note \r\n")
+            recorder.write("; note \n")
+            recorder.source(47, b"G1 X2\n")
+            recorder.write("G1 X3\n")
+            recorder.write_slot("M109 S205.00\n", 1, "M109 S{:.2f}\n")
+            self.assertEqual(recorder.plan.segments, [
+                ["copy", 0, 4],
+                ["slot", 0, "M109 S{:d}\n"],
+                ["lines", 14, 23, True],
+                ["copy", 23, 30],
+                ["lines", 30, 38, True],
+                ["lines", 38, 47, False],
+                ["text", "G1 X3\n"],
+                ["slot", 1, "M109 S{:.2f}\n"],
+            ])
+            plan = TowerPlan.from_dict(recorder.plan.to_dict())
+            replayed = io.StringIO()
+            plan.write(path, replayed, [200, 205])
+            self.assertEqual(replayed.getvalue(), stream.getvalue())
+            replayed = io.StringIO()
+            plan.write(path, replayed, [190, 195])
+            self.assertEqual(
+                replayed.getvalue(),
+                "G28\nM109 S190\nG1 Z0.2\nG1 Z10\nG1 X1\n; note \n"
+                "G1 X3\nM109 S195.00\n"
+            )
+            out_path = os.path.join(tmp_dir, "out.gcode")
+            plan.write_file(path, out_path, [190, 195])
+            with open(out_path, 'rb') as ins:
+                self.assertEqual(ins.read().decode("utf-8"),
+                                 replayed.getvalue())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_generate_towers(self):
+        template = "G28\nM109 S200\n" + "".join([
+            "G1 Z{:.1f} F600\nG1 X10 Y{} E{} F1200\n".format(
+                z / 2.0, z, z
+            ) for z in range(1, 10)
+        ]) + "M104 S0\n"
+        variants = [{'temperature': [200, 210]},
+                    {'temperature': [220, 230]},
+                    {'temperature': [200, 215]}]
+
+        def new_follower():
+            follower = GCodeFollower(echo_callback=lambda msg: None)
+            follower.cacheTowerPlans = False
+            follower.setVar("template_gcode_path", "tower.gcode")
+            follower.setVar("level_count", 4)
+            follower.setVar("level_height", "1.0")
+            follower.setVar("special_heights[0]", "1.0")
+            return follower
+
+        old_dir = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp_dir)
+            with open("tower.gcode", 'w') as outs:
+                outs.write(template)
+            expected = []
+            for variant in variants:
+                follower = new_follower()
+                follower.setRangeVars("temperature", *variant['temperature'])
+                follower.checkSettings()
+                follower.generateTower()
+                with open(follower.getTowerPath(), 'r') as ins:
+                    expected.append((ins.read(), follower._estS))
+            follower = new_follower()
+            seconds = []
+
+            def finish_tower(tmp_path, dst_path, line_number):
+                seconds.append(follower._estS)
+                shutil.move(tmp_path, dst_path)
+
+            follower._finishTower = finish_tower
+            paths = follower.generateTowers(variants)
+            self.assertEqual(len(paths), 3)
+            for path, (text, estimate), actual_s in zip(paths, expected,
+                                                        seconds):
+                with open(path, 'r') as ins:
+                    self.assertEqual(ins.read(), text)
+                self.assertAlmostEqual(actual_s, estimate)
+            self.assertIn("M109 S230", expected[1][0])
+            self.assertIsNone(follower.getRangeVar("temperature", 0))
+        finally:
+            os.chdir(old_dir)
+            shutil.rmtree(tmp_dir)
+
+    def test_cached_tower_plan(self):
+        template = "G28\nM109 S200\nM140 S60\n" + "".join([
+            "G1 Z{:.1f} F600\nG1 X10 Y{} E{} F1200\n".format(
+                z / 2.0, z, z
+            ) for z in range(1, 10)
+        ]) + "M104 S0\n"
+
+        def home(follower, meta):
+            follower._estS += 100.0
+
+        def run(cache, temperatures, custom=False):
+            follower = GCodeFollower(echo_callback=lambda msg: None)
+            follower.cacheTowerPlans = cache
+            if custom:
+                follower.commandRegistry.register("G28", home)
+            follower.setVar("template_gcode_path", "tower.gcode")
+            follower.setVar("level_count", 4)
+            follower.setVar("level_height", "1.0")
+            follower.setVar("special_heights[0]", "1.0")
+            follower.setRangeVars("temperature", *temperatures)
+            follower.checkSettings()
+            follower.generateTower()
+            with open(follower.getTowerPath(), 'r') as ins:
+                return follower, ins.read()
+
+        old_dir = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp_dir)
+            with open("tower.gcode", 'w') as outs:
+                outs.write(template)
+            for temperatures in ([200, 210], [200, 210], [220, 230]):
+                expected, expected_text = run(False, temperatures)
+                cached, cached_text = run(True, temperatures)
+                self.assertEqual(cached_text, expected_text)
+                self.assertEqual(cached.stats, expected.stats)
+                self.assertEqual(cached.stats_lines, expected.stats_lines)
+                self.assertEqual(cached.emuState, expected.emuState)
+                self.assertAlmostEqual(cached._estS, expected._estS)
+            self.assertTrue(os.path.isfile("tower.gcode.tower.json"))
+            # A saved plan has the times of the default handlers, so it
+            # isn't used with a custom one:
+            expected, expected_text = run(False, [200, 210], custom=True)
+            cached, cached_text = run(True, [200, 210], custom=True)
+            self.assertFalse(cached.hasDefaultHandlers())
+            self.assertEqual(cached_text, expected_text)
+            self.assertAlmostEqual(cached._estS, expected._estS)
+            self.assertNotAlmostEqual(cached._estS,
+                                      run(True, [200, 210])[0]._estS)
+        finally:
+            os.chdir(old_dir)
+            shutil.rmtree(tmp_dir)
+
+    def test_is_build_move_bytes(self):
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        # Lines that aren't skipped are parsed by _generateTower (which
+        # may still discard them, such as X-only moves):
+        kept = (
+            b"G1 Z0.4 F600\n",
+            b"G1 X10 Y10 Z0.4 E1\n",
+            b"G1 F1200\n",
+            b"G1 E-2 F2400 ; retract filament slightly\n",
+            b"G1 X10 F3000\n",
+            b"G0 Y10\r\n",
+            b"G1 F1200 ; move to X10 Y10 E1\n",
+            b"G92 E0\n",
+            b"G28 X Y\n",
+            b"M104 S0 ; E1\n",
+            b"; G1 X10 Y10 E1\n",
+        )
+        dropped = (
+            b"G1 X10 Y10 E1.5\n",
+            b"G1 E.5 F300\n",
+            b"G1 E-2 F2400\n",
+            b"G1 X10 Y10 F3000\n",
+            b"G0 X-1 Y+2 ; travel\r\n",
+            b"  G01 X1 Y1\n",
+        )
+        for line in kept:
+            self.assertFalse(follower._isBuildMoveBytes(line), line)
+        for line in dropped:
+            self.assertTrue(follower._isBuildMoveBytes(line), line)
+
+    @unittest.skipIf(np is None, "GCodeTable requires numpy")
+    def test_parse_gcode_table(self):
+        table = parse_gcode_table(
+            b"G28 X\n"
+            b"G1 X10 Y2 E.5 ; Z5\n"
+            b"\n"
+            b"; comment\n"
+            b"TIMELAPSE_TAKE_FRAME\n"
+            b"G1 Z0.2 F720\n"
+            b"SET_HEATER_TEMPERATURE HEATER=extruder TARGET=200\n"
+            b"G1 Z0.4\n"
+        )
+        self.assertEqual(len(table), 6)
+        self.assertEqual(table.function_counts(), {
+            'G1': 3,
+            'G28': 1,
+            'SET_HEATER_TEMPERATURE': 1,
+            'TIMELAPSE_TAKE_FRAME': 1,
+        })
+        self.assertEqual(table.line_number.tolist(), [1, 2, 5, 6, 7, 8])
+        self.assertEqual(table.byte_offset.tolist()[:3], [0, 6, 36])
+        self.assertEqual(table.X[1], 10.0)
+        self.assertEqual(table.E[1], 0.5)
+        self.assertTrue(np.isnan(table.Z[1]))
+        # ^ Z5 is in the comment.
+        self.assertEqual(table.layer_changes().tolist(), [3, 5])
+
+    @unittest.skipIf(np is None, "GCodeTable requires numpy")
+    def test_estimate_gcode(self):
+        gcode = (
+            "M190 S60\n"
+            "M109 S210\n"
+            "G28\n"
+            "G92 E0\n"
+            "G1 Z0.2 F720\n"
+            "G1 X10 Y10 F1200\n"
+            "G1 X20 E1.5\n"  # No F (skipped by addSec)
+            "G1 E-0.8 F1800\n"
+            "M83\n"
+            "G1 E-0.5 F1800\n"
+            "G1 E0.75 F1800\n"
+            "M82\n"
+            "G1 E1 F300\n"
+            "G4 P500\n"
+            "G91\n"
+            "G1 Z5 F600\n"
+            "G1 X-3 Y4 F3000\n"
+            "G1 E-1 F1800\n"  # relative like G91 in Marlin
+            "G90\n"
+            "T1\n"
+            "G1 X0 Y0 F6000\n"
+            "G1 E0.2 F300\n"
+            "M104 S0\n"
+        )
+        expected = GCodeFollower(echo_callback=lambda msg: None)
+        for line in gcode.splitlines():
+            expected.addSec(line)
+        got = GCodeFollower(echo_callback=lambda msg: None)
+        seconds = estimate_gcode(got, gcode)
+        self.assertAlmostEqual(seconds, expected._estS)
+        self.assertAlmostEqual(got._estS, expected._estS)
+        self.assertEqual(list(got.emuState['position']),
+                         list(expected.emuState['position']))
+        for key in ('tools', 'servos', 'position_mode', 'tool',
+                    'bed_temperature'):
+            self.assertEqual(got.emuState[key], expected.emuState[key])
+        self.assertAlmostEqual(expected.getEPos(), 0.2)
+        self.assertEqual(expected.getEPositionMode(), 'absolute')
+        self.assertNotIn("not_emulated:M83", expected.diagnostics)
+
+    @unittest.skipIf(np is None, "GCodeTable requires numpy")
+    def test_plan_table(self):
+        class FakeMarlinInfo(object):
+            values = {
+                'DEFAULT_MAX_FEEDRATE': "{ 1000, 1000, 5, 25, 25 }",
+                'DEFAULT_MAX_ACCELERATION': "{ 1000, 1000, 200, 10000 }",
+                'DEFAULT_ACCELERATION': "1000",
+                'DEFAULT_TRAVEL_ACCELERATION': "1000",
+                'JUNCTION_DEVIATION_MM': "0.013 // (mm)",
+            }
+
+            def get_cached_c(self, name):
+                value = self.values.get(name)
+                if value is None:
+                    return None, -1, None, "not found"
+                return value, 1, name, None
+
+        limits = PlannerLimits.from_marlininfo(FakeMarlinInfo())
+        self.assertEqual(limits.max_feed_rate, [1000.0, 1000.0, 5.0, 25.0])
+        self.assertEqual(limits.junction_deviation, 0.013)
+        self.assertEqual(limits.retract_acceleration, 3000.0)  # default
+
+        def plan(gcode):
+            return float(np.sum(plan_table(parse_gcode_table(gcode),
+                                           limits)))
+
+        # Accelerate to 50 mm/s in 0.1s (2.5mm), cruise, then decelerate:
+        self.assertAlmostEqual(plan(b"G1 X100 F3000\n"), 2.05)
+        # A straight junction doesn't slow down:
+        self.assertAlmostEqual(plan(b"G1 X50 F3000\nG1 X100\n"), 2.05)
+        # A dwell empties the planner, so both moves stop:
+        self.assertAlmostEqual(plan(b"G1 X50 F3000\nG4 P0\nG1 X100\n"),
+                               2.1)
+        # A corner slows down (but doesn't stop):
+        corner = plan(b"G1 X50 F3000\nG1 Y50\n")
+        self.assertTrue(2.05 < corner < 2.1)
+        # Relative moves and a Z move limited by its maximum feed rate:
+        self.assertAlmostEqual(plan(b"G91\nG1 Z1 F3000\nG1 Z1\n"),
+                               0.4 + 5.0 / 200.0)
+
+    def test_command_registry(self):
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        frames = []
+
+        def take_frame(follower, meta):
+            frames.append(meta.line)
+
+        def arc(follower, meta):
+            follower._estS += 1.0
+
+        registry = follower.commandRegistry
+        registry.register("TIMELAPSE_TAKE_FRAME", take_frame)
+        registry.register("G2", arc)
+        follower._estS = 0.0
+        for line in ("T1", "TIMELAPSE_TAKE_FRAME", "G2 X1 Y1 I1 J0",
+                     "T0", "M83", "G4 S2"):
+            follower.addSec(line)
+        self.assertEqual(frames, ["TIMELAPSE_TAKE_FRAME"])
+        # ^ A registered command is used instead of the "T" prefix.
+        self.assertEqual(follower.emuState['tool'], "T0")
+        self.assertEqual(follower._estS, 3.0)
+        stats = registry.get_stats()
+        self.assertEqual(stats["T"][0], 2)
+        self.assertEqual(stats["G2"][0], 1)
+        self.assertEqual(stats["M83"][0], 1)
+        self.assertNotIn("T1", stats)
+        registry.unregister("G2")
+        self.assertNotIn("G2", registry)
+        self.assertIn("T5", registry)
+
+    def test_gcode_metrics(self):
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        follower.addSec("G4 S1")
+        self.assertIsNone(follower.metrics)
+        # ^ Nothing is collected unless collectMetrics is set.
+        metrics = follower.metrics = GCodeMetrics()
+        for _ in metrics.iter_timed(["G4 S1", "G90"], "read", "classify"):
+            metrics.lap("parse")
+        for line in ("G4 S1", "G4 P5", "G90", "; comment"):
+            follower.addSec(line)
+        metrics.stop()
+        meta = metrics.to_dict()
+        self.assertEqual(meta['counters'], {'G4': 2, 'G90': 1})
+        self.assertEqual(set(meta['stage_seconds']),
+                         set(GCodeMetrics.STAGES))
+        self.assertAlmostEqual(sum(meta['stage_seconds'].values()),
+                               meta['seconds'], places=2)
+
+    def test_diagnostics(self):
+        diagnostics = Diagnostics(max_lines=2)
+        for line_number in (3, 5, 8):
+            diagnostics.add("no_movement", "No movement.",
+                            line_number=line_number)
+        diagnostics.add_lines("no_movement", "No movement.", [9, 10])
+        diagnostic = diagnostics.get("no_movement")
+        self.assertEqual(diagnostic.count, 5)
+        self.assertEqual(diagnostic.line_numbers, [3, 5])
+        get_cmd_meta("TIMELAPSE_TAKE_FRAME", diagnostics=diagnostics)
+        self.assertIn("macro:TIMELAPSE_TAKE_FRAME", diagnostics)
+        messages = []
+        self.assertEqual(diagnostics.report(echo=messages.append), 2)
+        self.assertEqual(
+            messages[0],
+            "WARNING: No movement. (5 times, first on line(s) 3, 5)"
+        )
+        self.assertEqual(len(diagnostics), 0)
+
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        follower.addSec("M104")
+        self.assertIn("no_S:M104", follower.diagnostics)
+        follower.diagnostics.strict = True
+        follower.diagnostics.line_number = 7
+        with self.assertRaises(GCodeDiagnosticError) as caught:
+            follower.addSec("M109")
+        self.assertEqual(caught.exception.line_number, 7)
+
+    def test_iter_scanned_lines(self):
+        gcode = (
+            "G28\nG1 X10 Y10 F3000\n; wipe\r\nG1 X20 E1.5 \nG92 E0\n"
+            "G91\nG1 Z0.4 F600\nG1 X-5\nG90\nG4 P500\n"
+            "M104 S210\nG1 Y30 F1200\nM106 S255\nG1 E2 F300\n"
+            "M83\nG1 E-0.8 F1800\nG4 P100\nG1 X1 Y1 F3000\n"
+            "G1 E0.8 F1800\nG4 P100\nG1 E-0.5 F1800\n"
+        )
+        serial = GCodeFollower(echo_callback=lambda msg: None)
+        for line in gcode.splitlines():
+            serial.addSec(line)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "scan.gcode")
+            with open(path, 'wb') as outs:
+                outs.write(gcode.encode("utf-8"))
+            follower = GCodeFollower(echo_callback=lambda msg: None)
+            options = follower.getScanOptions()
+            line_number = 0
+            lines = []
+            for offset, item in iter_scanned_lines(follower, path, options,
+                                                   1, chunk_size=40):
+                if isinstance(item, LineRun):
+                    apply_line_run(follower, item, line_number)
+                    line_number += item.line_count
+                    for segment in item.segments:
+                        if segment[0] == "copy":
+                            lines.append(gcode[segment[1]:segment[2]])
+                        elif segment[0] == "lines":
+                            lines.append(normalize_lines(
+                                gcode[segment[1]:segment[2]].encode("utf-8"),
+                                segment[3]
+                            ).decode("utf-8"))
+                        else:
+                            lines.append(segment[1])
+                    continue
+                line_number += 1
+                lines.append(item.decode("utf-8").rstrip() + "\n")
+                follower.addSec(item.decode("utf-8").rstrip())
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(
+            "".join(lines),
+            "".join(line.rstrip() + "\n" for line in gcode.splitlines())
+        )
+        self.assertAlmostEqual(follower._estS, serial._estS)
+        self.assertEqual(follower.emuState['position'],
+                         serial.emuState['position'])
+        self.assertEqual(follower.getEPos(), serial.getEPos())
+        self.assertEqual(follower.getEPositionMode(), 'relative')
+        buffer = gcode.encode("utf-8")
+        start = buffer.index(b"G1 E0.8")
+        self.assertEqual(
+            chunk_modes(buffer, [(0, start), (start, len(buffer))],
+                        "absolute", "absolute"),
+            [("absolute", "absolute"), ("absolute", "relative")]
+        )
+        scan = scan_chunk(buffer, start, len(buffer), options)
+        self.assertTrue(scan.e_mode_sensitive)
+
+    def test_pipeline(self):
+        # The stages reproduce _generateTower: The Z1.5 move is before the
+        # temperature wait, Z5 is above the level after the next one, and
+        # the end G-code has blank lines, a fan command and a retraction.
+        template = (
+            "; tower\nM140 S60\nG28\r\nG1 Z1.5 F600\nM109 S200\n"
+            "G1 Z5 F3000\nG1 X0 Y0 E8 F1200 ; purge\n"
+        ) + "".join([
+            "G1 Z{:.1f} F600\nG1 X10 Y{} E{} F1200\n".format(
+                z / 2.0, z, z
+            ) for z in range(1, 10)
+        ]) + (
+            "M106 S0\n\n\n; end\nM104 S0\n"
+            "G1 E-2 F1800 ; retract the filament slightly\n"
+            "G1 E-8 F1800\nG1 F1200\nG1 Z4.7 F600\nG1 X0 Y200 F3000\n"
+            "G1 Z20 F600\nM84\n"
+        )
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        follower.cacheTowerPlans = False
+        follower.setVar("template_gcode_path", "tower.gcode")
+        follower.setVar("level_count", 4)
+        follower.setVar("level_height", "1.0")
+        follower.setVar("special_heights[0]", "1.0")
+        follower.setRangeVars("temperature", 200, 215)
+        old_dir = os.getcwd()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.chdir(tmp_dir)
+            with open("tower.gcode", 'w') as outs:
+                outs.write(template)
+            follower.checkSettings()
+            follower.generateTower()
+            with open(follower.getTowerPath(), 'r') as ins:
+                expected = ins.read()
+        finally:
+            os.chdir(old_dir)
+            shutil.rmtree(tmp_dir)
+        tracker = LevelTracker(heights=follower.heights,
+                               level_count=len(follower.temperatures))
+        splicer = TemperatureSplicer(tracker, follower.temperatures)
+        truncate = Truncate(
+            tracker, message=follower._stop_building_msg,
+            max_z_move=follower.getVar("max_z_build_movement"),
+        )
+        tap = EstimateTap(GCodeFollower(echo_callback=lambda msg: None))
+        outs = io.StringIO()
+        run_pipeline(io.StringIO(template), outs,
+                     [tracker, splicer, truncate, tap])
+        self.assertEqual(outs.getvalue(), expected)
+        self.assertIn("G1 Z5 F3000\nG1 X0 Y0", expected)
+        self.assertIn("M109 S{:.2f}\n".format(follower.temperatures[3]),
+                      expected)
+        self.assertNotIn("M106", expected)
+        self.assertIn("slightly\nG1 Z20 F600\nM84\n", expected)
+        self.assertEqual(tracker.level, 3)
+        self.assertEqual(splicer.new_line_count, 3)
+        self.assertTrue(truncate.stopped)
+        serial = GCodeFollower(echo_callback=lambda msg: None)
+        for line in outs.getvalue().splitlines():
+            serial.addSec(line)
+        self.assertEqual(tap.seconds, serial._estS)
+
+    def test_preheat(self):
+        moves = ["G1 X{} Y0 E{} F600".format(10 * (i % 2), i)
+                 for i in range(1, 7)]
+        # ^ 1 second each
+        gcode = "\n".join(["M109 S200"] + moves + ["M109 S205"]
+                          + moves[:1] + ["M109 S300", "M104 S0"])
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        preheat = Preheat(follower)
+        outs = io.StringIO()
+        run_pipeline(io.StringIO(gcode), outs, [preheat])
+        self.assertEqual(
+            outs.getvalue().splitlines(),
+            ["M109 S200"] + moves[:3] + ["M104 S205"] + moves[3:]
+            + ["M104 S300"] + moves[:1] + ["M109 S300", "M104 S0"]
+        )
+        self.assertEqual(preheat.preheat_count, 2)
+        self.assertEqual(preheat.wait_count, 1)
+        # 5 degrees (See getToolSecRelTemp) and the 1 second before S300:
+        self.assertAlmostEqual(preheat.saved_seconds,
+                               5 * 109.0 / 188.0 + 1.0)
+
+    def test_thermal_model(self):
+        moves = ["G1 X{} Y0 E{} F600".format(10 * (i % 2), i)
+                 for i in range(1, 7)]
+        # ^ 1 second each
+        lines = (["M140 S60", "M104 S200"] + moves
+                 + ["M190 S60", "M109 S200", "M109 S150"])
+        legacy = GCodeFollower(echo_callback=lambda msg: None)
+        for line in lines:
+            legacy.addSec(line)
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        model = ThermalModel(ambient=20.0)
+        model.install(follower)
+        for line in lines:
+            follower.addSec(line)
+        # Both heated during the moves, the tool was ready before the
+        # bed, and cooling to 150 (M109 S) doesn't wait:
+        bed_s = 40 * follower.BED_SEC_PER_DEGREE
+        self.assertAlmostEqual(model.waited_seconds, bed_s - 6.0)
+        self.assertAlmostEqual(follower._estS, bed_s)
+        self.assertLess(follower._estS, legacy._estS)
+        self.assertEqual(model.heater("T0").target, 150.0)
+        self.assertEqual(model.heater(BED).target, 60.0)
+        # The numpy estimator passes its clock to the model:
+        estimated = GCodeFollower(echo_callback=lambda msg: None)
+        ThermalModel(ambient=20.0).install(estimated)
+        seconds = estimate_gcode(estimated, "\n".join(lines))
+        self.assertAlmostEqual(seconds, follower._estS)
+
+    def test_heater_overlap(self):
+        start = ["M190 S60", "M109 S200 ; wait", "M280 P0 S160", "G28",
+                 "G29", "G92 E0", "G1 X10 Y10 F9000"]
+        purge = "G1 X60 E9 F1000"
+        gcode = "\n".join(start + [purge])
+
+        def rewrite(overlap):
+            outs = io.StringIO()
+            run_pipeline(io.StringIO(gcode), outs, [overlap])
+            return outs.getvalue().splitlines()
+
+        overlap = HeaterOverlap(GCodeFollower(echo_callback=lambda m: None))
+        # The bed has to be ready before G28 and G29 probe (by default):
+        self.assertEqual(
+            rewrite(overlap),
+            ["M104 S200", "M140 S60", "M280 P0 S160", "M190 S60", "G28",
+             "G29", "G92 E0", "G1 X10 Y10 F9000", "M109 S200 ; wait",
+             purge],
+        )
+        self.assertEqual(overlap.moved_count, 2)
+        overlap = HeaterOverlap(GCodeFollower(echo_callback=lambda m: None),
+                                probe_homes_z=False)
+        # Only G29 probes:
+        self.assertEqual(rewrite(overlap)[:5],
+                         ["M104 S200", "M140 S60", "M280 P0 S160", "G28",
+                          "M190 S60"])
+        self.assertEqual(overlap.started_count, 2)
+        self.assertGreater(overlap.saved_seconds, 0.0)
+
+        class MarlinInfo(object):
+            # The same return values as MarlinInfo.get_cached_c
+            def __init__(self, values):
+                self.values = values
+
+            def get_cached_c(self, name):
+                if name not in self.values:
+                    return None, None, None, "commented"
+                return self.values[name], None, name, None
+
+        marlininfo = MarlinInfo({'USE_PROBE_FOR_Z_HOMING': "",
+                                 'PREHEAT_BEFORE_LEVELING': ""})
+        overlap = HeaterOverlap.from_marlininfo(
+            marlininfo,
+            GCodeFollower(echo_callback=lambda m: None),
+        )
+        # G28 probes, but G29 waits for the bed itself:
+        self.assertEqual(rewrite(overlap)[:5],
+                         ["M104 S200", "M140 S60", "M280 P0 S160",
+                          "M190 S60", "G28"])
+
+        # Like the BLTouch start G-code of the R2X 14T (PrusaSlicer
+        # config), the bed wait stays before G28 and M420:
+        gcode = "\n".join(["M190 S60", "M109 S200", "M280 P0 S160",
+                           "G4 P100", "G28", "M420 S1", "G92 E0",
+                           "G1 X110 F9000", purge])
+        overlap = HeaterOverlap(GCodeFollower(echo_callback=lambda m: None))
+        self.assertEqual(
+            rewrite(overlap),
+            ["M104 S200", "M140 S60", "M280 P0 S160", "G4 P100",
+             "M190 S60", "G28", "M420 S1", "G92 E0", "G1 X110 F9000",
+             "M109 S200", purge],
+        )
+        overlap = HeaterOverlap(GCodeFollower(echo_callback=lambda m: None),
+                                probe_homes_z=False)
+        self.assertEqual(rewrite(overlap)[4:7],
+                         ["G28", "M190 S60", "M420 S1"])
+
+    def test_tool_standby(self):
+        moves = ["G1 X{} Y0 E{} F600".format(10 * (i % 2), i)
+                 for i in range(1, 101)]
+        # ^ 1 second each
+        gcode = "\n".join(["M109 T0 S200", "M109 T1 S210", "T0"] + moves
+                          + ["T1", "M104 T0 S0", "M109 S210"] + moves
+                          + ["T0", "M109 S200"] + moves[:2])
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        standby = ToolStandby(follower, standby_drop=40.0)
+        outs = io.StringIO()
+        run_pipeline(io.StringIO(gcode), outs, [standby])
+        # T0 cools to 160 instead of turning off, and reheats early
+        # enough (40 degrees, See getToolSecRelTemp) for the change back:
+        self.assertEqual(
+            outs.getvalue().splitlines(),
+            ["M109 T0 S200", "M109 T1 S210", "T0"] + moves
+            + ["T1", "M104 T0 S160", "M109 S210"] + moves[:76]
+            + ["M104 T0 S200"] + moves[76:]
+            + ["T0", "M104 T1 S170", "M109 S200"] + moves[:2]
+        )
+        self.assertEqual(standby.standby_count, 2)
+        self.assertEqual(standby.reheat_count, 1)
+        self.assertAlmostEqual(standby.saved_seconds, 40 * 109.0 / 188.0)
+        model = follower.thermalModel
+        self.assertEqual(model.tool_change_count, 2)
+        self.assertEqual(model.tool_change_seconds, 0.0)
+
+    def test_arc_welder(self):
+        # A circle of 36 segments (10 mm radius) around (100, 100):
+        lines = ["G90", "M83", "G1 X110 Y100 F1200"]
+        for step in range(1, 37):
+            angle = math.radians(step * 10)
+            lines.append("G1 X{:.3f} Y{:.3f} E0.05 F1200".format(
+                100 + 10 * math.cos(angle), 100 + 10 * math.sin(angle)
+            ))
+        welder = ArcWelder(tolerance=0.05)
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [welder])
+        got = outs.getvalue().splitlines()
+        # All but the last segment (which would close the circle):
+        self.assertEqual(got[:3], lines[:3])
+        self.assertTrue(got[3].startswith("G3 X109.848 Y98.264 I-10 J"))
+        self.assertTrue(got[3].endswith(" E1.75 F1200"))
+        self.assertEqual(got[4:], lines[-1:])
+        self.assertEqual(welder.arc_count, 1)
+        self.assertEqual(welder.welded_count, 35)
+        self.assertEqual(welder.output_count, 5)
+        self.assertLess(welder.output_bytes, welder.input_bytes / 5)
+
+        # The arc is estimated by its length (instead of the chords of
+        # 35 segments of 10 degrees) the same way by addSec and by the
+        # whole-file estimate:
+        segmented = GCodeFollower(echo_callback=lambda msg: None)
+        for line in lines:
+            segmented.addSec(line)
+        follower = GCodeFollower(echo_callback=lambda msg: None)
+        for line in got:
+            follower.addSec(line)
+        longer = 35 * 10 * (math.radians(10) - 2 * math.sin(math.radians(5)))
+        self.assertAlmostEqual(follower._estS - segmented._estS,
+                               longer / 20.0, places=3)
+        estimated = GCodeFollower(echo_callback=lambda msg: None)
+        self.assertAlmostEqual(estimate_gcode(estimated, "\n".join(got)),
+                               follower._estS)
+        self.assertEqual(estimated.emuState['position'],
+                         follower.emuState['position'])
+
+        # A tool change or a macro may move the head, so the segments
+        # after it are welded from where the first move after it goes
+        # (and not at all after a macro, which may change the modes):
+        segments = ["G1 X{:.3f} Y{:.3f} E0.1".format(
+            10 * math.cos(math.radians(step * 10)),
+            10 * math.sin(math.radians(step * 10)),
+        ) for step in range(1, 8)]
+        for other, welded in (("T1", True), ("PARK_AND_RETURN", False)):
+            lines = ["G90", "M83", "G1 X10 Y0 F1200", other] + segments
+            got = [command.line for command in ArcWelder()(
+                [ParsedCommand(line) for line in lines]
+            )]
+            self.assertEqual(got[:5], lines[:5])
+            if welded:
+                self.assertEqual(got[5:], [
+                    "G3 X3.42 Y9.397 I-9.849 J-1.737 E0.6",
+                ])
+            else:
+                self.assertEqual(got, lines)
+
+        # Lines are not welded:
+        lines = ["G90", "G1 X0 Y0 F600"] + [
+            "G1 X{} Y0".format(x) for x in range(1, 6)
+        ]
+        welder = ArcWelder()
+        self.assertEqual(
+            [command.line for command in welder(
+                [ParsedCommand(line) for line in lines]
+            )],
+            lines,
+        )
+
+    def test_simplifier(self):
+        lines = ["G90", "M83", "G1 Z0.2 F600", "G1 X0 Y0 F1200"]
+        # Nearly collinear (within 0.01 mm):
+        lines += ["G1 X{} Y{:g} E0.1".format(x, 0.01 * (x % 2))
+                  for x in range(1, 11)]
+        lines += ["G1 X10 Y10 E1", "G1 X10 Y20 E1", "; comment",
+                  "G1 X10 Y30 E1", "G1 X10 Y40 E1", "G1 Z0.4",
+                  "G1 X0 Y40 E0.5 F900", "G1 X-10 Y40 E0.5"]
+        expected = ["G90", "M83", "G1 Z0.2 F600", "G1 X0 Y0 F1200",
+                    "G1 X10 Y0 E1", "G1 X10 Y20 E2", "; comment",
+                    "G1 X10 Y40 E2", "G1 Z0.4",
+                    "G1 X-10 Y40 E1 F900"]
+        simplifier = Simplifier(tolerance=0.02)
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [simplifier])
+        self.assertEqual(outs.getvalue().splitlines(), expected)
+        self.assertEqual(simplifier.removed_count, 12)
+        self.assertEqual(simplifier.input_count, len(lines))
+        self.assertEqual(simplifier.output_count, len(expected))
+        data, count = simplify_gcode("\n".join(lines), tolerance=0.02)
+        self.assertEqual(data.decode("utf-8").splitlines(), expected)
+        self.assertEqual(count, 12)
+
+        # A smaller tolerance keeps the points that are farther, and
+        # absolute E (the E of each kept move) stays the same:
+        lines = ["G90", "M82", "G92 E0", "G1 X0 Y0 F1200"]
+        lines += ["G1 X{} Y{:g} E{}".format(x, 0.01 * (x % 2), x)
+                  for x in range(1, 5)]
+        data, count = simplify_gcode("\n".join(lines), tolerance=0.005)
+        self.assertEqual(count, 0)
+        data, count = simplify_gcode("\n".join(lines), tolerance=0.02)
+        self.assertEqual(data.decode("utf-8").splitlines(),
+                         lines[:4] + ["G1 X4 Y0 E4"])
+
+        # The position after G29 (or anything else that MoveState.forget
+        # forgets) is unknown, so the first move after it is kept, and
+        # nothing is merged after a macro until the modes are set:
+        moves = ["G1 X{} Y{:g} E0.1".format(x, 0.001 * (x % 2))
+                 for x in range(1, 6)]
+        lines = ["G90", "M83", "G1 X0 Y0 F1800", "G29"] + moves
+        data, count = simplify_gcode("\n".join(lines))
+        self.assertEqual(data.decode("utf-8").splitlines(),
+                         lines[:5] + ["G1 X5 Y0.001 E0.4"])
+        lines[3] = "PRINT_START"
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [Simplifier()])
+        self.assertEqual(outs.getvalue().splitlines(), lines)
+
+    def test_minifier(self):
+        lines = [
+            "; generated", "G90", "M82", "G90", "G28 ; home", "",
+            "G1 Z0.2 F720", "G1 X10 Y10 F9000", "G1 X10 Y20 F9000",
+            "G1   X20  Y20", "G1 X20 Y20 E0.8 F2100", "G1 X20 Y20 E0.8",
+            "M106 S255", "M106", "M107", "M107",
+            "G91", "G1 Z0", "G1 Z1 F720", "M83", "G90",
+            "G1 X20 Y20 E1", "T1", "G1 X20 Y20", "G1 X20 Y20",
+        ]
+        minifier = Minifier()
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [minifier])
+        # The modes are unknown until set, M83 after G91 is kept since
+        # Klipper keeps E relative after G90 if it is, G90 after M83
+        # doesn't show whether E is absolute (in both Marlin and
+        # Klipper), and a tool change makes the position unknown:
+        self.assertEqual(outs.getvalue().splitlines(), [
+            "G90", "M82", "G28", "G1 Z0.2 F720", "G1 X10 Y10 F9000",
+            "G1 Y20", "G1 X20", "G1 E0.8 F2100", "M106 S255", "M107",
+            "G91", "G1 Z1 F720", "M83", "G90", "G1 E1", "T1",
+            "G1 X20 Y20",
+        ])
+        self.assertEqual(minifier.removed_lines["comments"], 1)
+        self.assertEqual(minifier.saved_bytes["comments"], 19)
+        self.assertEqual(minifier.removed_lines["modes"], 1)
+        self.assertEqual(minifier.removed_lines["fan"], 2)
+        self.assertEqual(minifier.saved_bytes["modal_F"], 6)
+        self.assertEqual(minifier.removed_lines["zero_length"], 3)
+        self.assertEqual(minifier.input_bytes - minifier.output_bytes,
+                         sum(minifier.saved_bytes.values()))
+        # A fan without P is the fan of the current tool (in Marlin if
+        # each extruder has one), which may also be a fan with P:
+        for lines in (["M106 S255", "T1", "M106 S255"],
+                      ["M106 S255", "M106 P0 S0", "M106 S255"],
+                      ["M106 P1 S0", "M106 S255", "M106 P1 S0"]):
+            outs = io.StringIO()
+            run_pipeline(io.StringIO("\n".join(lines)), outs, [Minifier()])
+            self.assertEqual(outs.getvalue().splitlines(), lines)
+        # M83 is only removed if M83 is already in effect:
+        lines = ["G90", "M83", "G91", "M83", "G90", "M83", "M83"]
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [Minifier()])
+        self.assertEqual(outs.getvalue().splitlines(),
+                         ["G90", "M83", "G91", "G90", "M83"])
+
+    def test_precision_trimmer(self):
+        class MarlinInfo(object):
+            # The same return values as MarlinInfo.get_cached_c
+            def get_cached_c(self, name):
+                if name != 'DEFAULT_AXIS_STEPS_PER_UNIT':
+                    return None, None, None, "commented"
+                return "{ 80, 80, 400, 93 }", None, name, None
+
+        lines = ["G1 X1.23456", "G90", "M83", "G92 E0",
+                 "G1 X10.0125 Y20.00001 Z0.2000 F1800.000 ; start"]
+        lines += ["G1 X{} E0.03327".format(20 + i) for i in range(30)]
+        trimmer = PrecisionTrimmer.from_marlininfo(MarlinInfo())
+        self.assertEqual(trimmer.steps_per_unit, [80.0, 80.0, 400.0, 93.0])
+        outs = io.StringIO()
+        run_pipeline(io.StringIO("\n".join(lines)), outs, [trimmer])
+        results = outs.getvalue().splitlines()
+        # Nothing is trimmed before the mode is known, and F is kept:
+        self.assertEqual(results[:5], [
+            "G1 X1.23456", "G90", "M83", "G92 E0",
+            "G1 X10.01 Y20 Z0.2 F1800.000 ; start",
+        ])
+        # E is shorter (except where the total is near halfway between
+        # two steps), and the difference is carried so that the total is
+        # always on the same step as the original total:
+        e = 0.0
+        new_e = 0.0
+        for line in results[5:]:
+            e += 0.03327
+            new_e += ParsedCommand(line).get_float('E')
+            self.assertEqual(get_step(new_e, 93.0), get_step(e, 93.0))
+        self.assertEqual(trimmer.trimmed_count, 32)
+        self.assertEqual(trimmer.carried_count, 1)
+        self.assertLess(trimmer.output_bytes, trimmer.input_bytes)
 
 
 if __name__ == '__main__':